@@ -18,6 +18,8 @@ from AWSIoTPythonSDK.core.util.providers import CertificateCredentialsProvider
 from AWSIoTPythonSDK.core.util.providers import IAMCredentialsProvider
 from AWSIoTPythonSDK.core.util.providers import EndpointProvider
 from AWSIoTPythonSDK.core.protocol.mqtt_core import MqttCore
+from AWSIoTPythonSDK.core.protocol.internal.stores import InMemoryMessageStore
+from AWSIoTPythonSDK.core.protocol.internal.stores import MappedFileMessageStore
 import AWSIoTPythonSDK.core.shadow.shadowManager as shadowManager
 import AWSIoTPythonSDK.core.shadow.deviceShadow as deviceShadow
 
@@ -30,6 +32,21 @@ MQTTv3_1_1 = 4
 DROP_OLDEST = 0
 DROP_NEWEST = 1
 
+# - Lane policies for publishes made while draining:
+LANE_BACKLOG_FIRST = 0
+LANE_LIVE_FIRST = 1
+LANE_WEIGHTED = 2
+
+# - Publish priorities:
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+
+# - Message store sync policies:
+SYNC_NONE = 0
+SYNC_ALWAYS = 1
+SYNC_BATCHED = 2
+
 
 class AWSIoTMQTTClient:
 
@@ -265,12 +282,14 @@ class AWSIoTMQTTClient:
         """
         self._mqtt_core.configure_reconnect_back_off(baseReconnectQuietTimeSecond, maxReconnectQuietTimeSecond, stableConnectionTimeSecond)
 
-    def configureOfflinePublishQueueing(self, queueSize, dropBehavior=DROP_NEWEST):
+    def configureOfflinePublishQueueing(self, queueSize, dropBehavior=DROP_NEWEST, queueSizeBytes=-1):
         """
         **Description**
 
         Used to configure the queue size and drop behavior for the offline requests queueing. Should be
         called before connect. Queueable offline requests include publish, subscribe and unsubscribe.
+        Publish requests queued up from the message store, see :code:`configureMessageStore`, are moved to the
+        newly configured queue. Those that do not fit into it are dropped, also from the store.
 
         **Syntax**
 
@@ -281,6 +300,8 @@ class AWSIoTMQTTClient:
           # Configure the offline queue for publish requests to be 20 in size and drop the oldest
            request when the queue is full.
           myAWSIoTMQTTClient.configureOfflinePublishQueueing(20, AWSIoTPyMQTT.DROP_OLDEST)
+          # Configure an unlimited number of offline requests holding at most 1 MB of publish payloads in total
+          myAWSIoTMQTTClient.configureOfflinePublishQueueing(-1, AWSIoTPyMQTT.DROP_OLDEST, 1024 * 1024)
 
         **Parameters**
 
@@ -291,19 +312,60 @@ class AWSIoTMQTTClient:
          Could be :code:`AWSIoTPythonSDK.core.util.enums.DropBehaviorTypes.DROP_OLDEST` or
          :code:`AWSIoTPythonSDK.core.util.enums.DropBehaviorTypes.DROP_NEWEST`.
 
+        *queueSizeBytes* - Maximum total size in bytes of the payloads of the queued publish requests, applied on
+         top of *queueSize*. With :code:`DROP_OLDEST`, as many of the oldest requests as needed are dropped to make room.
+         A single payload larger than this limit is always dropped. If set to -1, there is no byte limit.
+
         **Returns**
 
         None
 
         """
-        self._mqtt_core.configure_offline_requests_queue(queueSize, dropBehavior)
+        self._mqtt_core.configure_offline_requests_queue(queueSize, dropBehavior, queueSizeBytes)
 
-    def configureDrainingFrequency(self, frequencyInHz):
+    def configureOfflinePublishConflation(self, topicFilters, keepPosition=True):
+        """
+        **Description**
+
+        Used to keep only the newest offline queued publish request per topic, for topics that carry a state rather
+        than a series of events. A publish request on a topic that matches one of the topic filters replaces the
+        request queued on the same topic, if any, instead of being added to the offline requests queue. The
+        replaced message is dropped. Can be called at any time, and also applies to the requests already queued.
+
+        **Syntax**
+
+        .. code:: python
+
+          # Only send the latest queued status and temperature after a reconnect
+          myAWSIoTMQTTClient.configureOfflinePublishConflation(["device/status", "sensors/+/temperature"])
+          # Same, but send each latest value in the order it was published in
+          myAWSIoTMQTTClient.configureOfflinePublishConflation(["device/status"], keepPosition=False)
+          # Queue every publish request again
+          myAWSIoTMQTTClient.configureOfflinePublishConflation([])
+
+        **Parameters**
+
+        *topicFilters* - List of topics or topic filters, with MQTT wildcards, of the conflated publish requests.
+        Publishes on different topics matching the same filter are conflated per topic, not together. An empty list
+        disables conflation.
+
+        *keepPosition* - If True (default), the new request takes the place of the replaced one in the queue, so the
+        topic keeps its position in the draining order. If False, the new request is moved to the tail of the queue.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_offline_publish_conflation(topicFilters, keepPosition)
+
+    def configureDrainingFrequency(self, frequencyInHz, burst=1, followAcks=False):
         """
         **Description**
 
         Used to configure the draining speed to clear up the queued requests when the connection is back.
-        Should be called before connect.
+        Draining is paced by a token bucket: up to *burst* requests go out back to back, after which requests
+        go out at *frequencyInHz*. Should be called before connect.
 
         **Syntax**
 
@@ -311,6 +373,8 @@ class AWSIoTMQTTClient:
 
           # Configure the draining speed to be 2 requests/second
           myAWSIoTMQTTClient.configureDrainingFrequency(2)
+          # Drain at 50 requests/second in bursts of up to 20, without exceeding the in-flight window
+          myAWSIoTMQTTClient.configureDrainingFrequency(50, 20, True)
 
         .. note::
 
@@ -321,12 +385,252 @@ class AWSIoTMQTTClient:
 
         *frequencyInHz* - The draining speed to clear the queued requests, in requests/second.
 
+        *burst* - Maximum number of requests sent back to back when tokens have built up. Defaults to 1.
+
+        *followAcks* - If True, a queued request is only sent while the in-flight window has room, so that
+        draining follows the PUBACKs instead of piling up messages in flight. Defaults to False.
+
         **Returns**
 
         None
 
         """
         self._mqtt_core.configure_draining_interval_sec(1/float(frequencyInHz))
+        self._mqtt_core.configure_draining_burst(burst, followAcks)
+
+    def configureMaxTopicsPerSubscribe(self, maxTopicsPerSubscribe):
+        """
+        **Description**
+
+        Used to configure how many topic filters are packed into a single SUBSCRIBE packet when the client
+        resubscribes after a reconnect. Defaults to 8, the AWS IoT limit. Should be called before connect.
+
+        **Syntax**
+
+        .. code:: python
+
+          # Resubscribe one topic per SUBSCRIBE packet
+          myAWSIoTMQTTClient.configureMaxTopicsPerSubscribe(1)
+
+        **Parameters**
+
+        *maxTopicsPerSubscribe* - Maximum number of topic filters per resubscribe SUBSCRIBE packet.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_max_topics_per_subscribe(maxTopicsPerSubscribe)
+
+    def getResubscribeStats(self):
+        """
+        **Description**
+
+        Used to get the outcome of the latest resubscribe after a reconnect. Topics rejected by the broker in
+        their SUBACK, or that could not be sent, are listed as failed. When the broker reports in CONNACK that a
+        persistent session (:code:`cleanSession=False`) is still present, only the topics that were never
+        acknowledged in that session are resubscribed, if any.
+
+        **Syntax**
+
+        .. code:: python
+
+          stats = myAWSIoTMQTTClient.getResubscribeStats()
+          for topic in stats["failed_topics"]:
+              myAWSIoTMQTTClient.subscribeAsync(topic, 1, messageCallback=customCallback)
+
+        **Parameters**
+
+        None
+
+        **Returns**
+
+        A dict with :code:`path` (:code:`"full"` for a new session, :code:`"delta"` or :code:`"skipped"` when the
+        session was present), :code:`path_counts` (number of times each path was taken),
+        :code:`topics` and :code:`packets` (topics resubscribed and SUBSCRIBE packets sent),
+        :code:`pending_packets` (packets still waiting for a SUBACK), :code:`failed_topics` and :code:`duration_sec`
+        (time from the first SUBSCRIBE to the last SUBACK, None until all SUBACKs are in).
+
+        """
+        return self._mqtt_core.get_resubscribe_stats()
+
+    def configureDrainingLanePolicy(self, lanePolicy, liveWeight=1):
+        """
+        **Description**
+
+        Used to configure how publish requests made while the client is resubscribing or draining the offline
+        requests queue after a reconnect (live requests) share the connection with the queued ones (backlog).
+        Subscribe and unsubscribe requests always stay in order behind the backlog. Should be called before connect.
+
+        Ordering per topic:
+
+        - :code:`AWSIoTPyMQTT.LANE_BACKLOG_FIRST` (default): live publishes are queued behind the backlog. All
+          requests go out in the order they were made.
+        - :code:`AWSIoTPyMQTT.LANE_LIVE_FIRST`: live publishes go out right away, unpaced. A live message may overtake
+          backlog messages on the same topic. The backlog and live messages are each in order.
+        - :code:`AWSIoTPyMQTT.LANE_WEIGHTED`: live publishes are queued in their own lane, and the draining sends
+          *liveWeight* live requests for each backlog request, both paced by the draining frequency. A live message
+          may overtake backlog messages on the same topic. Each lane is in order.
+
+        **Syntax**
+
+        .. code:: python
+
+          import AWSIoTPythonSDK.MQTTLib as AWSIoTPyMQTT
+
+          # Send alarms ahead of stale queued telemetry
+          myAWSIoTMQTTClient.configureDrainingLanePolicy(AWSIoTPyMQTT.LANE_LIVE_FIRST)
+          # Send 3 live publishes for every queued one while draining
+          myAWSIoTMQTTClient.configureDrainingLanePolicy(AWSIoTPyMQTT.LANE_WEIGHTED, 3)
+
+        **Parameters**
+
+        *lanePolicy* - Could be :code:`AWSIoTPyMQTT.LANE_BACKLOG_FIRST`, :code:`AWSIoTPyMQTT.LANE_LIVE_FIRST` or
+        :code:`AWSIoTPyMQTT.LANE_WEIGHTED`.
+
+        *liveWeight* - Number of live requests sent per backlog request with :code:`AWSIoTPyMQTT.LANE_WEIGHTED`.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_lane_policy(lanePolicy, liveWeight)
+
+    def getDrainingStats(self):
+        """
+        **Description**
+
+        Used to get the progress of draining the offline requests queue.
+
+        **Syntax**
+
+        .. code:: python
+
+          stats = myAWSIoTMQTTClient.getDrainingStats()
+          print("%d requests left, done in %s sec" % (stats["remaining"], stats["eta_sec"]))
+
+        **Parameters**
+
+        None
+
+        **Returns**
+
+        A dict with :code:`draining` (whether draining is in progress), :code:`remaining` (queued requests),
+        :code:`drained` (requests sent in the current or last draining), :code:`rate_per_sec` (measured draining
+        rate while draining, the configured one otherwise) and :code:`eta_sec` (estimated time to drain the
+        remaining requests).
+
+        """
+        return self._mqtt_core.get_draining_stats()
+
+    def getPublishExpiryStats(self):
+        """
+        **Description**
+
+        Used to get the number of expiring publish requests that have been dropped before being sent, see the
+        :code:`ttlSec` and :code:`deadline` parameters of :code:`publish` and :code:`publishAsync`.
+
+        **Syntax**
+
+        .. code:: python
+
+          stats = myAWSIoTMQTTClient.getPublishExpiryStats()
+          print("%d messages expired, %d bytes" % (stats["expired_messages"], stats["expired_bytes"]))
+
+        **Parameters**
+
+        None
+
+        **Returns**
+
+        A dict with :code:`expired_messages` and :code:`expired_bytes` (total payload size of the expired messages).
+
+        """
+        return self._mqtt_core.get_expiry_stats()
+
+    def configurePipelinedConnect(self, enabled):
+        """
+        **Description**
+
+        Used to configure whether publish, subscribe and unsubscribe requests made between :code:`connectAsync` and
+        the CONNACK are written on the socket right behind CONNECT, instead of being queued until the connection is
+        stable. This saves the round trips of waiting for CONNACK, e.g. for devices that wake up, publish a reading and
+        go back to sleep. Requests are only pipelined while the offline requests queue is empty, so that they do not
+        overtake queued ones. If the connection is refused or lost before CONNACK, pipelined QoS0 publishes are queued
+        again, QoS1 publishes are kept for retransmission and pipelined subscriptions are resubscribed on the next
+        accepted connection. Disabled by default. Should be called before connect.
+
+        **Syntax**
+
+        .. code:: python
+
+          myAWSIoTMQTTClient.configurePipelinedConnect(True)
+          myAWSIoTMQTTClient.connectAsync()
+          myAWSIoTMQTTClient.publishAsync("myTopic/reading", reading, 1, ackCallback=myPubackCallback)
+
+        **Parameters**
+
+        *enabled* - True to send requests right behind CONNECT, False to queue them until the connection is stable.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_pipelined_connect(enabled)
+
+    def configureMessageStore(self, storeDirectory=None, syncPolicy=SYNC_BATCHED, syncBatchSize=100,
+                              syncIntervalSec=1.0, segmentSizeBytes=1024 * 1024):
+        """
+        **Description**
+
+        Used to configure a message store that keeps outbound publish requests until they are done with. Offline
+        queued publish requests are kept until they are sent, and QoS1 publish requests until they are acknowledged.
+        With a store directory, the messages are kept in memory-mapped, checksummed segment files under it, so that
+        they survive a process restart: publish requests left in the store are queued up again by this call and sent,
+        in their original order, once connected. Drained segment files are deleted and sparsely used ones compacted.
+        Should be called before connect.
+
+        **Syntax**
+
+        .. code:: python
+
+          import AWSIoTPythonSDK.MQTTLib as AWSIoTPyMQTT
+
+          # Persist outbound messages under /var/lib/myDevice/outbox, syncing to disk every 100 writes or 1 second
+          myAWSIoTMQTTClient.configureMessageStore("/var/lib/myDevice/outbox")
+          # Persist outbound messages and sync to disk on every write
+          myAWSIoTMQTTClient.configureMessageStore("/var/lib/myDevice/outbox", AWSIoTPyMQTT.SYNC_ALWAYS)
+
+        **Parameters**
+
+        *storeDirectory* - Directory for the store files, created if missing. If set to None, messages are kept in
+        memory only.
+
+        *syncPolicy* - When to flush writes to disk. Could be :code:`AWSIoTPyMQTT.SYNC_NONE` to leave it to the OS,
+        :code:`AWSIoTPyMQTT.SYNC_ALWAYS` to flush on every write or :code:`AWSIoTPyMQTT.SYNC_BATCHED` to flush every
+        *syncBatchSize* writes or *syncIntervalSec* seconds, whichever comes first. The store is also flushed on
+        disconnect.
+
+        *syncBatchSize* - Number of writes per flush with :code:`AWSIoTPyMQTT.SYNC_BATCHED`.
+
+        *syncIntervalSec* - Maximum time in seconds that a write stays unflushed with
+        :code:`AWSIoTPyMQTT.SYNC_BATCHED`, also when no further write follows it.
+
+        *segmentSizeBytes* - Size of each store segment file in bytes.
+
+        **Returns**
+
+        None
+
+        """
+        if storeDirectory is None:
+            messageStore = InMemoryMessageStore()
+        else:
+            messageStore = MappedFileMessageStore(storeDirectory, segmentSizeBytes, syncPolicy, syncBatchSize, syncIntervalSec)
+        self._mqtt_core.configure_message_store(messageStore)
 
     def configureConnectDisconnectTimeout(self, timeoutSecond):
         """
@@ -404,6 +708,261 @@ class AWSIoTMQTTClient:
         """
         self._mqtt_core.configure_username_password(username, password)
 
+    def configureMaxInflightMessages(self, maxInflightMessages):
+        """
+        **Description**
+
+        Used to configure the maximum number of QoS 1 publishes that can be waiting for a PUBACK at once. Further
+        publishes are held back by the client until a PUBACK frees up the window. Default is 20. Not used while the
+        adaptive in-flight window is enabled. Should be called before connect.
+
+        **Syntax**
+
+        .. code:: python
+
+          # Allow up to 50 QoS 1 publishes in flight
+          myAWSIoTMQTTClient.configureMaxInflightMessages(50)
+
+        **Parameters**
+
+        *maxInflightMessages* - Maximum number of in-flight QoS 1 publishes. 0 means no limit.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_max_inflight_messages(maxInflightMessages)
+
+    def configureAdaptiveInflightWindow(self, enabled, minInflightMessages=1, maxInflightMessages=100):
+        """
+        **Description**
+
+        Used to enable or disable the adaptive in-flight window. While enabled, the maximum number of QoS 1 publishes in
+        flight grows while the PUBACK round trip time stays stable, and is halved on retry timeouts and connection drops.
+        This fills high latency links without overrunning the broker's throttling on fast ones. Disabled by default.
+        Should be called before connect.
+
+        **Syntax**
+
+        .. code:: python
+
+          # Let the in-flight window adapt between 1 and 200 publishes
+          myAWSIoTMQTTClient.configureAdaptiveInflightWindow(True, 1, 200)
+
+        **Parameters**
+
+        *enabled* - True to enable the adaptive in-flight window, False to use the fixed maximum again.
+
+        *minInflightMessages* - Lower bound of the window.
+
+        *maxInflightMessages* - Upper bound of the window.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_adaptive_inflight(enabled, minInflightMessages, maxInflightMessages)
+
+    def getInflightWindowStats(self):
+        """
+        **Description**
+
+        Used to read the current in-flight window and round trip time estimates.
+
+        **Syntax**
+
+        .. code:: python
+
+          stats = myAWSIoTMQTTClient.getInflightWindowStats()
+
+        **Parameters**
+
+        None
+
+        **Returns**
+
+        Dict with the current window size (:code:`window`), the number of publishes in flight (:code:`inflight`) and,
+        while the adaptive window is enabled, the smoothed and minimum PUBACK round trip times in seconds
+        (:code:`smoothed_rtt_sec`, :code:`min_rtt_sec`), None until measured.
+
+        """
+        return self._mqtt_core.get_inflight_window_stats()
+
+    def configureRetransmissionTimeout(self, initialTimeoutSecond, minTimeoutSecond, maxTimeoutSecond):
+        """
+        **Description**
+
+        Used to configure when unacknowledged QoS 1 publishes are retransmitted. The timeout is derived from the
+        measured PUBACK round trip time and its variance, as TCP does, bounded to *minTimeoutSecond* and
+        *maxTimeoutSecond*. The initial timeout is used until the round trip time has been measured on a connection.
+        Each retransmission of a message doubles its timeout, up to *maxTimeoutSecond*. Default is 20 seconds initially,
+        bounded to 1 to 120 seconds. Should be called before connect.
+
+        **Syntax**
+
+        .. code:: python
+
+          # Start from 5 seconds and keep the timeout between 0.5 and 60 seconds
+          myAWSIoTMQTTClient.configureRetransmissionTimeout(5, 0.5, 60)
+
+        **Parameters**
+
+        *initialTimeoutSecond* - Timeout in seconds used before the round trip time has been measured.
+
+        *minTimeoutSecond* - Lower bound in seconds of the timeout, measured or initial.
+
+        *maxTimeoutSecond* - Upper bound in seconds of the measured timeout and of the per message backoff.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_retransmission_timeout(initialTimeoutSecond, minTimeoutSecond, maxTimeoutSecond)
+
+    def getRetransmissionStats(self):
+        """
+        **Description**
+
+        Used to read the number of retransmissions and the current retransmission timeout estimate.
+
+        **Syntax**
+
+        .. code:: python
+
+          stats = myAWSIoTMQTTClient.getRetransmissionStats()
+
+        **Parameters**
+
+        None
+
+        **Returns**
+
+        Dict with the number of retransmissions so far (:code:`retransmissions`), the current timeout in seconds
+        (:code:`retry_timeout_sec`) and the smoothed round trip time and its variance in seconds
+        (:code:`smoothed_rtt_sec`, :code:`rtt_variance_sec`), None until measured.
+
+        """
+        return self._mqtt_core.get_retransmission_stats()
+
+    def configureZeroCopyPayload(self, enabled):
+        """
+        **Description**
+
+        Used to configure whether received message payloads are delivered as a read-only :code:`memoryview` over the
+        received packet instead of a :code:`bytes` copy. This saves copying large payloads before the message callback
+        runs. Use :code:`message.payload.tobytes()` where a bytes object is needed. Disabled by default. Should not be
+        enabled on a connection shared with a shadow client, which expects bytes payloads. Should be called before connect.
+
+        **Syntax**
+
+        .. code:: python
+
+          # Deliver message payloads as memoryview objects
+          myAWSIoTMQTTClient.configureZeroCopyPayload(True)
+
+        **Parameters**
+
+        *enabled* - True to deliver payloads as memoryview objects, False to deliver bytes.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_zero_copy_payload(enabled)
+
+    def configureMessageCallbackExecutor(self, workerCount, queueSize=-1, dropBehavior=DROP_NEWEST, keyFunction=None):
+        """
+        **Description**
+
+        Used to run message callbacks on a pool of worker threads instead of the single event consuming thread, so that
+        a slow callback on one topic does not hold up messages on other topics, or connack/disconnect/ack callbacks.
+        Messages are partitioned by topic, or by the value of :code:`keyFunction(message)` if provided. Messages with
+        the same key are always handled by the same worker, in arrival order. Messages with different keys may run in
+        parallel, so callbacks must be thread-safe. Both the subscription callbacks and the general onMessage callback
+        run on the workers. Other callbacks stay on the event consuming thread. The workers stop, after finishing the
+        messages already queued, when the client disconnects, and start again on the next connect. Disabled by default.
+
+        **Syntax**
+
+        .. code:: python
+
+          # Run message callbacks on 4 workers, each holding at most 100 pending messages, dropping the newest
+          myAWSIoTMQTTClient.configureMessageCallbackExecutor(4, 100, AWSIoTPyMQTT.DROP_NEWEST)
+          # Partition by the first topic level, keeping per-device ordering
+          myAWSIoTMQTTClient.configureMessageCallbackExecutor(4, keyFunction=lambda message: message.topic.split("/")[0])
+          # Go back to running message callbacks on the event consuming thread
+          myAWSIoTMQTTClient.configureMessageCallbackExecutor(0)
+
+        **Parameters**
+
+        *workerCount* - Number of worker threads. 0 disables the executor.
+
+        *queueSize* - Maximum number of pending messages per worker. -1 means an unbounded queue.
+
+        *dropBehavior* - The type of drop behavior when a worker queue is full. Could be :code:`AWSIoTPyMQTT.DROP_OLDEST`
+        or :code:`AWSIoTPyMQTT.DROP_NEWEST`.
+
+        *keyFunction* - Function taking the message and returning a hashable partitioning key. Defaults to the topic.
+
+        **Returns**
+
+        None
+
+        """
+        self._mqtt_core.configure_message_callback_executor(workerCount, queueSize, dropBehavior, keyFunction)
+
+    def getInlineDispatchStats(self):
+        """
+        **Description**
+
+        Used to get statistics on message callbacks of subscriptions made with :code:`inlineBudgetSec`: how many ran
+        inline on the network thread, how many took longer than their budget and the longest run time.
+
+        **Syntax**
+
+        .. code:: python
+
+          stats = myAWSIoTMQTTClient.getInlineDispatchStats()
+
+        **Parameters**
+
+        None
+
+        **Returns**
+
+        A dict with :code:`inline_callbacks`, :code:`budget_overruns` and :code:`max_elapsed_sec`.
+
+        """
+        return self._mqtt_core.get_inline_dispatch_stats()
+
+    def getMessageCallbackExecutorStats(self):
+        """
+        **Description**
+
+        Used to get the pending message count of each message callback worker and the number of messages dropped
+        because a worker queue was full. Returns None if the executor is disabled.
+
+        **Syntax**
+
+        .. code:: python
+
+          stats = myAWSIoTMQTTClient.getMessageCallbackExecutorStats()
+
+        **Parameters**
+
+        None
+
+        **Returns**
+
+        A dict with :code:`queue_sizes` and :code:`dropped_messages`, or None.
+
+        """
+        return self._mqtt_core.get_message_callback_executor_stats()
+
     def enableMetricsCollection(self):
         """
         **Description**
@@ -565,11 +1124,14 @@ class AWSIoTMQTTClient:
         """
         return self._mqtt_core.disconnect_async(ackCallback)
 
-    def publish(self, topic, payload, QoS):
+    def publish(self, topic, payload, QoS, priority=PRIORITY_NORMAL, ttlSec=None, deadline=None, expiryCallback=None):
         """
         **Description**
 
-        Publish a new message to the desired topic with QoS.
+        Publish a new message to the desired topic with QoS. Outgoing packets are written in priority order:
+        acknowledgements, pings and other control packets first, then high, normal and low priority publishes. A
+        higher priority packet goes ahead of queued lower priority ones at the next packet boundary, while messages
+        of the same priority keep their publish order.
 
         **Syntax**
 
@@ -579,6 +1141,10 @@ class AWSIoTMQTTClient:
           myAWSIoTMQTTClient.publish("myTopic", "myPayload", 0)
           # Publish a QoS1 message "myPayloadWithQos1" to topic "myTopic/sub"
           myAWSIoTMQTTClient.publish("myTopic/sub", "myPayloadWithQos1", 1)
+          # Publish a QoS1 alarm ahead of queued bulk data
+          myAWSIoTMQTTClient.publish("myTopic/alarm", "myAlarm", 1, priority=AWSIoTPyMQTT.PRIORITY_HIGH)
+          # Publish a QoS1 reading that is not worth sending after one minute
+          myAWSIoTMQTTClient.publish("myTopic/telemetry", "myReading", 1, ttlSec=60, expiryCallback=myExpiryCallback)
 
         **Parameters**
 
@@ -588,14 +1154,31 @@ class AWSIoTMQTTClient:
 
         *QoS* - Quality of Service. Could be 0 or 1.
 
+        *priority* - Write priority of the message. Could be :code:`AWSIoTPyMQTT.PRIORITY_HIGH`,
+        :code:`AWSIoTPyMQTT.PRIORITY_NORMAL` or :code:`AWSIoTPyMQTT.PRIORITY_LOW`. Default is
+        :code:`AWSIoTPyMQTT.PRIORITY_NORMAL`.
+
+        *ttlSec* - Time to live of the message in seconds. A message that is still waiting to be sent when it runs
+        out, in the offline requests queue or, for QoS1, waiting for a connection or for room in the in-flight window,
+        is dropped instead of being sent. So is a QoS1 message due to be retransmitted. Default is None, no expiry.
+
+        *deadline* - Absolute expiry time of the message, as a :code:`time.time()` timestamp. Works like *ttlSec*,
+        the earlier one applies if both are given. Default is None, no expiry.
+
+        *expiryCallback* - Callback to be invoked when the message expires. Should be in form
+        :code:`customCallback(topic, payload)`. Expiring messages are dropped as they come up to be sent, not when
+        they expire, so the callback can be late.
+
         **Returns**
 
-        True if the publish request has been sent to paho. False if the request did not reach paho.
+        True if the publish request has been sent to paho. False if the request did not reach paho, or if a QoS1
+        message expired before its PUBACK arrived and was dropped.
 
         """
-        return self._mqtt_core.publish(topic, payload, QoS, False)  # Disable retain for publish by now
+        return self._mqtt_core.publish(topic, payload, QoS, False, priority, ttlSec, deadline, expiryCallback)  # Disable retain for publish by now
 
-    def publishAsync(self, topic, payload, QoS, ackCallback=None):
+    def publishAsync(self, topic, payload, QoS, ackCallback=None, priority=PRIORITY_NORMAL, ttlSec=None, deadline=None,
+                     expiryCallback=None):
         """
         **Description**
 
@@ -622,14 +1205,31 @@ class AWSIoTMQTTClient:
         *ackCallback* - Callback to be invoked when the client receives a PUBACK. Should be in form
         :code:`customCallback(mid)`, where :code:`mid` is the packet id for the disconnect request.
 
+        *priority* - Write priority of the message. Could be :code:`AWSIoTPyMQTT.PRIORITY_HIGH`,
+        :code:`AWSIoTPyMQTT.PRIORITY_NORMAL` or :code:`AWSIoTPyMQTT.PRIORITY_LOW`. Default is
+        :code:`AWSIoTPyMQTT.PRIORITY_NORMAL`. See :code:`publish`.
+
+        *ttlSec* - Time to live of the message in seconds. A message that is still waiting to be sent when it runs
+        out, in the offline requests queue or, for QoS1, waiting for a connection or for room in the in-flight window,
+        is dropped instead of being sent. So is a QoS1 message due to be retransmitted. Default is None, no expiry.
+
+        *deadline* - Absolute expiry time of the message, as a :code:`time.time()` timestamp. Works like *ttlSec*,
+        the earlier one applies if both are given. Default is None, no expiry.
+
+        *expiryCallback* - Callback to be invoked when the message expires. Should be in form
+        :code:`customCallback(topic, payload)`. Expiring messages are dropped as they come up to be sent, not when
+        they expire, so the callback can be late.
+
         **Returns**
 
-        Publish request packet id, for tracking purpose in the corresponding callback.
+        Publish request packet id, for tracking purpose in the corresponding callback. An expired message gets no
+        PUBACK callback.
 
         """
-        return self._mqtt_core.publish_async(topic, payload, QoS, False, ackCallback)
+        return self._mqtt_core.publish_async(topic, payload, QoS, False, ackCallback, priority, ttlSec, deadline,
+                                             expiryCallback)
 
-    def subscribe(self, topic, QoS, callback):
+    def subscribe(self, topic, QoS, callback, inlineBudgetSec=None):
         """
         **Description**
 
@@ -643,6 +1243,8 @@ class AWSIoTMQTTClient:
           myAWSIoTMQTTClient.subscribe("myTopic", 0, customCallback)
           # Subscribe to "myTopic/#" with QoS1 and register a callback
           myAWSIoTMQTTClient.subscribe("myTopic/#", 1, customCallback)
+          # Subscribe to "myTopic/control" with QoS0 and run the callback inline, with a 1 ms budget
+          myAWSIoTMQTTClient.subscribe("myTopic/control", 0, customCallback, inlineBudgetSec=0.001)
 
         **Parameters**
 
@@ -656,14 +1258,21 @@ class AWSIoTMQTTClient:
         here just to be aligned with the underneath Paho callback function signature. These fields are pending to be
         deprecated and should not be depended on.
 
+        *inlineBudgetSec* - If set, the message callback runs inline on the network thread as soon as the message is
+        decoded, instead of being queued to the event consuming thread. This avoids the thread handoff for
+        latency-critical topics, but blocks all network I/O while it runs, so it must be short and must not call back
+        into the client synchronously. A warning is logged and the overrun is counted in
+        :code:`getInlineDispatchStats` when the callback takes longer than this many seconds. Defaults to None, which
+        queues the callback as usual.
+
         **Returns**
 
         True if the subscribe attempt succeeded. False if failed.
 
         """
-        return self._mqtt_core.subscribe(topic, QoS, callback)
+        return self._mqtt_core.subscribe(topic, QoS, callback, inlineBudgetSec)
 
-    def subscribeAsync(self, topic, QoS, ackCallback=None, messageCallback=None):
+    def subscribeAsync(self, topic, QoS, ackCallback=None, messageCallback=None, inlineBudgetSec=None):
         """
         **Description**
 
@@ -694,12 +1303,19 @@ class AWSIoTMQTTClient:
         here just to be aligned with the underneath Paho callback function signature. These fields are pending to be
         deprecated and should not be depended on.
 
+        *inlineBudgetSec* - If set, *messageCallback* runs inline on the network thread as soon as the message is
+        decoded, instead of being queued to the event consuming thread. This avoids the thread handoff for
+        latency-critical topics, but blocks all network I/O while it runs, so it must be short and must not call back
+        into the client synchronously. A warning is logged and the overrun is counted in
+        :code:`getInlineDispatchStats` when the callback takes longer than this many seconds. Defaults to None, which
+        queues the callback as usual.
+
         **Returns**
 
         Subscribe request packet id, for tracking purpose in the corresponding callback.
 
         """
-        return self._mqtt_core.subscribe_async(topic, QoS, ackCallback, messageCallback)
+        return self._mqtt_core.subscribe_async(topic, QoS, ackCallback, messageCallback, inlineBudgetSec)
 
     def unsubscribe(self, topic):
         """
@@ -27,6 +27,7 @@ import time
 import threading
 import logging
 import os
+import heapq
 from datetime import datetime
 import hashlib
 import hmac
@@ -47,12 +48,90 @@ except ImportError:
     from ConfigParser import NoOptionError
     from ConfigParser import NoSectionError
 
+# Monotonic clock for timers, not affected by system time changes
+monotonicTime = getattr(time, "monotonic", time.time)
+
+
+# This class implements a timer scheduler that is driven by the paho network
+# loop. Timers are kept in a heap ordered by their deadline on the monotonic
+# clock. The network loop waits no longer than getNextTimeoutSecond and then
+# calls runDue to invoke the timer callbacks that are due, on its own thread.
+# Cancelled timers are dropped lazily when they reach the top of the heap, and
+# the heap is rebuilt once they make up most of it.
+
+
+class TimerSchedulerCore:
+    # Logger
+    _logger = logging.getLogger(__name__)
+    # Minimum number of cancelled timers before the heap is rebuilt
+    _MIN_CANCELLED_TO_COMPACT = 64
+
+    def __init__(self):
+        # Heap of [deadline, sequence number, callback, args] entries
+        self._timerHeap = []
+        self._sequenceNumber = 0
+        self._cancelledCount = 0
+        self._lock = threading.Lock()
+
+    # Invoke callback(*args) once delaySecond has passed
+    # Return a timer handle that can be passed to cancel
+    def schedule(self, delaySecond, callback, *args):
+        with self._lock:
+            timer = [monotonicTime() + delaySecond, self._sequenceNumber, callback, args]
+            self._sequenceNumber += 1
+            heapq.heappush(self._timerHeap, timer)
+        return timer
+
+    # Cancel a timer that has not fired yet
+    # Cancelling None or a timer that has already fired does nothing
+    def cancel(self, timer):
+        if timer is None:
+            return
+        with self._lock:
+            if timer[2] is not None:
+                timer[2] = None
+                timer[3] = None
+                self._cancelledCount += 1
+                if self._cancelledCount > self._MIN_CANCELLED_TO_COMPACT and self._cancelledCount * 2 > len(self._timerHeap):
+                    self._timerHeap = [entry for entry in self._timerHeap if entry[2] is not None]
+                    heapq.heapify(self._timerHeap)
+                    self._cancelledCount = 0
+
+    # Return the time in seconds until the next timer is due, 0 if one is already due
+    # Return None if there is no timer
+    def getNextTimeoutSecond(self):
+        with self._lock:
+            self._dropCancelledTimersLocked()
+            if not self._timerHeap:
+                return None
+            return max(0.0, self._timerHeap[0][0] - monotonicTime())
+
+    # Invoke the callbacks of all timers that are due, in deadline order
+    def runDue(self):
+        now = monotonicTime()
+        while True:
+            with self._lock:
+                self._dropCancelledTimersLocked()
+                if not self._timerHeap or self._timerHeap[0][0] > now:
+                    return
+                timer = heapq.heappop(self._timerHeap)
+                callback = timer[2]
+                args = timer[3]
+                timer[2] = None  # Fired, later cancel calls have nothing to do
+                timer[3] = None
+            callback(*args)
+
+    def _dropCancelledTimersLocked(self):
+        while self._timerHeap and self._timerHeap[0][2] is None:
+            heapq.heappop(self._timerHeap)
+            self._cancelledCount -= 1
+
 
 class ProgressiveBackOffCore:
     # Logger
     _logger = logging.getLogger(__name__)
 
-    def __init__(self, srcBaseReconnectTimeSecond=1, srcMaximumReconnectTimeSecond=32, srcMinimumConnectTimeSecond=20):
+    def __init__(self, srcBaseReconnectTimeSecond=1, srcMaximumReconnectTimeSecond=32, srcMinimumConnectTimeSecond=20, srcTimerScheduler=None):
         # The base reconnection time in seconds, default 1
         self._baseReconnectTimeSecond = srcBaseReconnectTimeSecond
         # The maximum reconnection time in seconds, default 32
@@ -64,6 +143,8 @@ class ProgressiveBackOffCore:
         self._currentBackoffTimeSecond = 1
         # Handler for timer
         self._resetBackoffTimer = None
+        # Scheduler that runs the stable connection timer, a threading.Timer is used without it
+        self._timerScheduler = srcTimerScheduler
 
     # For custom progressiveBackoff timing configuration
     def configTime(self, srcBaseReconnectTimeSecond, srcMaximumReconnectTimeSecond, srcMinimumConnectTimeSecond):
@@ -79,16 +160,18 @@ class ProgressiveBackOffCore:
         self._currentBackoffTimeSecond = 1
 
     # Block the reconnect logic for _currentBackoffTimeSecond
+    # This should get called only when a disconnect/reconnect happens
+    def backOff(self):
+        time.sleep(self.nextBackOffTimeSecond())
+
+    # Return _currentBackoffTimeSecond, the time to wait before this reconnect
     # Update the currentBackoffTimeSecond for the next reconnect
     # Cancel the in-waiting timer for resetting backOff time
     # This should get called only when a disconnect/reconnect happens
-    def backOff(self):
+    def nextBackOffTimeSecond(self):
         self._logger.debug("backOff: current backoff time is: " + str(self._currentBackoffTimeSecond) + " sec.")
-        if self._resetBackoffTimer is not None:
-            # Cancel the timer
-            self._resetBackoffTimer.cancel()
-        # Block the reconnect logic
-        time.sleep(self._currentBackoffTimeSecond)
+        self.stopStableConnectionTimer()
+        backOffTimeSecond = self._currentBackoffTimeSecond
         # Update the backoff time
         if self._currentBackoffTimeSecond == 0:
             # This is the first attempt to connect, set it to base
@@ -96,18 +179,28 @@ class ProgressiveBackOffCore:
         else:
             # r_cur = min(2^n*r_base, r_max)
             self._currentBackoffTimeSecond = min(self._maximumReconnectTimeSecond, self._currentBackoffTimeSecond * 2)
+        return backOffTimeSecond
 
     # Start the timer for resetting _currentBackoffTimeSecond
     # Will be cancelled upon calling backOff
     def startStableConnectionTimer(self):
-        self._resetBackoffTimer = threading.Timer(self._minimumConnectTimeSecond,
-                                                  self._connectionStableThenResetBackoffTime)
-        self._resetBackoffTimer.start()
+        self.stopStableConnectionTimer()
+        if self._timerScheduler is not None:
+            self._resetBackoffTimer = self._timerScheduler.schedule(self._minimumConnectTimeSecond,
+                                                                    self._connectionStableThenResetBackoffTime)
+        else:
+            self._resetBackoffTimer = threading.Timer(self._minimumConnectTimeSecond,
+                                                      self._connectionStableThenResetBackoffTime)
+            self._resetBackoffTimer.start()
 
     def stopStableConnectionTimer(self):
         if self._resetBackoffTimer is not None:
             # Cancel the timer
-            self._resetBackoffTimer.cancel()
+            if self._timerScheduler is not None:
+                self._timerScheduler.cancel(self._resetBackoffTimer)
+            else:
+                self._resetBackoffTimer.cancel()
+            self._resetBackoffTimer = None
 
     # Timer callback to reset _currentBackoffTimeSecond
     # If the connection is stable for longer than _minimumConnectTimeSecond,
@@ -118,6 +211,159 @@ class ProgressiveBackOffCore:
         self._currentBackoffTimeSecond = self._baseReconnectTimeSecond
 
 
+# This class implements an AIMD (additive increase, multiplicative decrease)
+# in-flight window for QoS>0 publishes, driven by the PUBACK round trip time.
+# The window grows by one message per window of acks while the smoothed RTT
+# stays close to the lowest RTT seen, holds while the RTT is inflating (the
+# broker or link is queueing) and is halved, at most once per RTT, on a
+# timeout, a retransmit or a connection drop.
+
+
+class AdaptiveInflightWindowCore:
+    # Logger
+    _logger = logging.getLogger(__name__)
+    # The window only grows while the smoothed RTT is within this factor of the minimum RTT
+    _RTT_STABLE_FACTOR = 1.5
+    # Window is multiplied by this factor on loss
+    _DECREASE_FACTOR = 0.5
+    # Smoothing gain of the RTT estimate
+    _RTT_GAIN = 0.125
+
+    def __init__(self, srcMinimumWindow=1, srcMaximumWindow=100, srcInitialWindow=None):
+        if srcMinimumWindow < 1 or srcMaximumWindow < srcMinimumWindow:
+            raise ValueError("Invalid in-flight window bounds.")
+        self._minimumWindow = srcMinimumWindow
+        self._maximumWindow = srcMaximumWindow
+        if srcInitialWindow is None:
+            srcInitialWindow = srcMinimumWindow
+        self._window = float(min(max(srcInitialWindow, srcMinimumWindow), srcMaximumWindow))
+        self._smoothedRttSecond = None
+        self._minimumRttSecond = None
+        self._lastDecreaseTime = None
+
+    # Record the RTT of a message that was acked on its first transmission
+    def onAck(self, rttSecond):
+        if rttSecond < 0:
+            return
+        if self._smoothedRttSecond is None:
+            self._smoothedRttSecond = rttSecond
+        else:
+            self._smoothedRttSecond += self._RTT_GAIN * (rttSecond - self._smoothedRttSecond)
+        if self._minimumRttSecond is None or rttSecond < self._minimumRttSecond:
+            self._minimumRttSecond = rttSecond
+        if self._smoothedRttSecond <= self._minimumRttSecond * self._RTT_STABLE_FACTOR:
+            self._window = min(self._window + 1.0 / self._window, float(self._maximumWindow))
+
+    # Record a timeout, retransmit or connection drop
+    def onLoss(self):
+        now = monotonicTime()
+        if self._lastDecreaseTime is not None and self._smoothedRttSecond is not None \
+                and now - self._lastDecreaseTime < self._smoothedRttSecond:
+            return  # Same loss event
+        self._lastDecreaseTime = now
+        self._window = max(self._window * self._DECREASE_FACTOR, float(self._minimumWindow))
+        self._logger.debug("In-flight window decreased to %d", int(self._window))
+
+    # Forget the RTT baseline, e.g. after reconnecting over a different path
+    def resetRtt(self):
+        self._smoothedRttSecond = None
+        self._minimumRttSecond = None
+        self._lastDecreaseTime = None
+
+    def getWindow(self):
+        return int(self._window)
+
+    def getSmoothedRttSecond(self):
+        return self._smoothedRttSecond
+
+    def getMinimumRttSecond(self):
+        return self._minimumRttSecond
+
+
+# This class implements the retransmission timeout (RTO) calculation of TCP
+# (RFC 6298) for MQTT acks. It keeps a smoothed RTT and RTT variance from
+# request/ack pairs and derives the timeout from them, bounded to a minimum and
+# a maximum. Until the first sample the initial timeout is used. Callers back
+# off exponentially per message by passing the number of times the message has
+# already been retransmitted.
+
+
+class RetransmissionTimeoutCore:
+    # Logger
+    _logger = logging.getLogger(__name__)
+    # Gains of the smoothed RTT and RTT variance estimates
+    _RTT_GAIN = 0.125
+    _RTT_VARIANCE_GAIN = 0.25
+    _RTT_VARIANCE_FACTOR = 4
+    # Clock granularity in seconds
+    _CLOCK_GRANULARITY_SECOND = 0.01
+    # Backoff stops doubling after this many retransmissions
+    _MAXIMUM_BACKOFF_EXPONENT = 16
+
+    def __init__(self, srcInitialTimeoutSecond=20, srcMinimumTimeoutSecond=1, srcMaximumTimeoutSecond=120):
+        self._initialTimeoutSecond = srcInitialTimeoutSecond
+        self._minimumTimeoutSecond = srcMinimumTimeoutSecond
+        self._maximumTimeoutSecond = srcMaximumTimeoutSecond
+        self.reset()
+
+    # Set the timeout used before the first RTT sample
+    def configInitialTimeout(self, srcInitialTimeoutSecond):
+        if srcInitialTimeoutSecond < 0:
+            raise ValueError("Negative time configuration detected.")
+        self._initialTimeoutSecond = srcInitialTimeoutSecond
+        if self._smoothedRttSecond is None:
+            self._timeoutSecond = self._getInitialTimeoutSecond()
+
+    # Set the bounds of the timeout computed from RTT samples
+    def configBounds(self, srcMinimumTimeoutSecond, srcMaximumTimeoutSecond):
+        if srcMinimumTimeoutSecond < 0 or srcMaximumTimeoutSecond < srcMinimumTimeoutSecond:
+            raise ValueError("Invalid retransmission timeout bounds.")
+        self._minimumTimeoutSecond = srcMinimumTimeoutSecond
+        self._maximumTimeoutSecond = srcMaximumTimeoutSecond
+        if self._smoothedRttSecond is not None:
+            self._updateTimeout()
+        else:
+            self._timeoutSecond = self._getInitialTimeoutSecond()
+
+    # Forget the estimates, e.g. for a new connection
+    def reset(self):
+        self._smoothedRttSecond = None
+        self._rttVarianceSecond = None
+        self._timeoutSecond = self._getInitialTimeoutSecond()
+
+    # Record the RTT of a request that was acked on its first transmission
+    def onRttSample(self, rttSecond):
+        if rttSecond < 0:
+            return
+        if self._smoothedRttSecond is None:
+            self._smoothedRttSecond = rttSecond
+            self._rttVarianceSecond = rttSecond / 2.0
+        else:
+            self._rttVarianceSecond += self._RTT_VARIANCE_GAIN * (abs(self._smoothedRttSecond - rttSecond) - self._rttVarianceSecond)
+            self._smoothedRttSecond += self._RTT_GAIN * (rttSecond - self._smoothedRttSecond)
+        self._updateTimeout()
+
+    # Return the timeout of a request that has been retransmitted retransmitCount times
+    def getTimeoutSecond(self, retransmitCount=0):
+        timeoutSecond = self._timeoutSecond * (2 ** min(retransmitCount, self._MAXIMUM_BACKOFF_EXPONENT))
+        return min(timeoutSecond, max(self._timeoutSecond, self._maximumTimeoutSecond))
+
+    def getSmoothedRttSecond(self):
+        return self._smoothedRttSecond
+
+    def getRttVarianceSecond(self):
+        return self._rttVarianceSecond
+
+    # The initial timeout is held to the same minimum as the measured one, so that a 0 second
+    # configuration cannot make a message retry in a busy loop
+    def _getInitialTimeoutSecond(self):
+        return max(self._initialTimeoutSecond, self._minimumTimeoutSecond, self._CLOCK_GRANULARITY_SECOND)
+
+    def _updateTimeout(self):
+        timeoutSecond = self._smoothedRttSecond + max(self._CLOCK_GRANULARITY_SECOND, self._RTT_VARIANCE_FACTOR * self._rttVarianceSecond)
+        self._timeoutSecond = min(max(timeoutSecond, self._minimumTimeoutSecond), self._maximumTimeoutSecond)
+
+
 class SigV4Core:
 
     _logger = logging.getLogger(__name__)
@@ -554,27 +800,18 @@ class SecuredWebSocketCore:
 
     # Override sslSocket read. Always read from the wss internal payload buffer, which
     # contains the masked MQTT packet. This read will decode ONE wss frame every time
-    # and load in the payload for MQTT _packet_read. At any time, MQTT _packet_read
-    # should be able to read a complete MQTT packet from the payload (buffered per wss
-    # frame payload). If the MQTT packet is break into separate wss frames, different
-    # chunks will be buffered in separate frames and MQTT _packet_read will not be able
-    # to collect a complete MQTT packet to operate on until the necessary payload is
-    # fully buffered.
-    # If the requested number of bytes are not available, SSL_ERROR_WANT_READ will be
-    # raised to trigger another call of _packet_read when the data is available again.
+    # and load in the payload for MQTT _packet_read. Like a plain socket recv, it returns
+    # up to numberOfBytes of whatever payload is buffered. MQTT _packet_read keeps
+    # partial MQTT packets in its own receive buffer, so an MQTT packet broken into
+    # separate wss frames is reassembled there as the frames come in.
+    # If no payload is available, SSL_ERROR_WANT_READ will be raised to trigger another
+    # call of _packet_read when the data is available again.
     def read(self, numberOfBytes):
-        # Check if we have enough data for paho
+        # Check if we have any data for paho
         # _payloadDataBuffer will not be empty ony when the payload of a new wss frame
         # has been unmasked.
-        if len(self._payloadDataBuffer) >= numberOfBytes:
-            ret = self._payloadDataBuffer[0:numberOfBytes]
-            self._payloadDataBuffer = self._payloadDataBuffer[numberOfBytes:]
-            # struct.unpack(fmt, string) # Py2.x
-            # struct.unpack(fmt, buffer) # Py3.x
-            # Here ret is always in bytes (buffer interface)
-            if sys.version_info[0] < 3:  # Py2.x
-                ret = str(ret)
-            return ret
+        if len(self._payloadDataBuffer) > 0:
+            return self._readFromPayloadBuffer(numberOfBytes)
         # Emmm, We don't. Try to buffer from the socket (It's a new wss frame).
         if not self._hasOpByte:  # Check if we need to buffer OpByte
             opByte = self._bufferedReader.read(1)
@@ -640,18 +877,21 @@ class SecuredWebSocketCore:
         if self._opCode == self._OP_PING:
             self._sendPONG()  # Nothing more to do here, if the transmission of the last wssMQTT packet is not finished, it will continue
         self._reset()
-        # Check again if we have enough data for paho
-        if len(self._payloadDataBuffer) >= numberOfBytes:
-            ret = self._payloadDataBuffer[0:numberOfBytes]
-            self._payloadDataBuffer = self._payloadDataBuffer[numberOfBytes:]
-            # struct.unpack(fmt, string) # Py2.x
-            # struct.unpack(fmt, buffer) # Py3.x
-            # Here ret is always in bytes (buffer interface)
-            if sys.version_info[0] < 3:  # Py2.x
-                ret = str(ret)
-            return ret
-        else:  # Fragmented MQTT packets in separate wss frames
-            raise socket.error(ssl.SSL_ERROR_WANT_READ, "Not a complete MQTT packet payload within this wss frame.")
+        # Check again if we have any data for paho
+        if len(self._payloadDataBuffer) > 0:
+            return self._readFromPayloadBuffer(numberOfBytes)
+        else:  # Control frame or empty frame, nothing for paho yet
+            raise socket.error(ssl.SSL_ERROR_WANT_READ, "No MQTT packet payload within this wss frame.")
+
+    def _readFromPayloadBuffer(self, numberOfBytes):
+        ret = self._payloadDataBuffer[0:numberOfBytes]
+        del self._payloadDataBuffer[0:numberOfBytes]
+        # struct.unpack(fmt, string) # Py2.x
+        # struct.unpack(fmt, buffer) # Py3.x
+        # Here ret is always in bytes (buffer interface)
+        if sys.version_info[0] < 3:  # Py2.x
+            ret = str(ret)
+        return ret
 
     def write(self, bytesToBeSent):
         # When there is a disconnection, select will report a TypeError which triggers the reconnect.
@@ -667,6 +907,13 @@ class SecuredWebSocketCore:
             self._sslSocket.close()
             self._sslSocket = None
 
+    def pending(self):
+        # Decoded payload plus decrypted bytes that select will not report
+        pendingLength = len(self._payloadDataBuffer)
+        if self._sslSocket is not None:
+            pendingLength += self._sslSocket.pending()
+        return pendingLength
+
     def getSSLSocket(self):
         if self._connectStatus != self._WebsocketDisconnected:
             return self._sslSocket
@@ -19,6 +19,8 @@ from threading import Lock
 from numbers import Number
 import AWSIoTPythonSDK.core.protocol.paho.client as mqtt
 from AWSIoTPythonSDK.core.protocol.paho.client import MQTT_ERR_SUCCESS
+from AWSIoTPythonSDK.core.protocol.paho.client import MQTT_ERR_NO_CONN
+from AWSIoTPythonSDK.core.protocol.paho.client import PRIORITY_NORMAL
 from AWSIoTPythonSDK.core.protocol.internal.events import FixedEventMids
 
 
@@ -58,6 +60,9 @@ class InternalAsyncMqttClient(object):
         self._use_wss = use_wss
         self._event_callback_map_lock = Lock()
         self._event_callback_map = dict()
+        self._message_store = None
+        self._stored_message_map = dict()  # mid of an unacked QoS>0 publish -> key in the message store
+        self._expiry_callback_map = dict()  # mid of an unacked, expiring QoS>0 publish -> expiry callback
 
     def _create_paho_client(self, client_id, clean_session, user_data, protocol, use_wss):
         self._logger.debug("Initializing MQTT layer...")
@@ -103,6 +108,28 @@ class InternalAsyncMqttClient(object):
     def configure_reconnect_back_off(self, base_reconnect_quiet_sec, max_reconnect_quiet_sec, stable_connection_sec):
         self._paho_client.setBackoffTiming(base_reconnect_quiet_sec, max_reconnect_quiet_sec, stable_connection_sec)
 
+    def configure_message_store(self, message_store):
+        self._message_store = message_store
+
+    def configure_zero_copy_payload(self, enabled):
+        self._paho_client.zero_copy_payload_set(enabled)
+
+    def configure_max_inflight_messages(self, max_inflight_messages):
+        self._paho_client.max_inflight_messages_set(max_inflight_messages)
+
+    def configure_adaptive_inflight(self, enabled, min_inflight_messages, max_inflight_messages):
+        self._paho_client.adaptive_inflight_set(enabled, min_inflight_messages, max_inflight_messages)
+
+    def get_inflight_window_stats(self):
+        return self._paho_client.inflight_window_stats()
+
+    def configure_retransmission_timeout(self, initial_timeout_sec, min_timeout_sec, max_timeout_sec):
+        self._paho_client.message_retry_set(initial_timeout_sec)
+        self._paho_client.message_retry_bounds_set(min_timeout_sec, max_timeout_sec)
+
+    def get_retransmission_stats(self):
+        return self._paho_client.retransmission_stats()
+
     def connect(self, keep_alive_sec, ack_callback=None):
         host = self._endpoint_provider.get_host()
         port = self._endpoint_provider.get_port()
@@ -167,13 +194,42 @@ class InternalAsyncMqttClient(object):
     def on_message(self, message):
         pass
 
-    def publish(self, topic, payload, qos, retain=False, ack_callback=None):
+    def publish(self, topic, payload, qos, retain=False, ack_callback=None, store_key=None, priority=PRIORITY_NORMAL,
+                expiry_time=None, expiry_callback=None):
+        # Persist outside of the lock, the network thread needs it for every ack
+        if self._message_store is not None and qos > 0 and store_key is None:
+            store_key = self._message_store.add(topic, payload, qos, retain)
         with self._event_callback_map_lock:
-            rc, mid = self._paho_client.publish(topic, payload, qos, retain)
+            rc, mid = self._paho_client.publish(topic, payload, qos, retain, priority, expiry_time)
             if MQTT_ERR_SUCCESS == rc and qos > 0 and ack_callback:
                 self._logger.debug("Filling in custom puback (QoS>0) event callback...")
                 self._event_callback_map[mid] = ack_callback
-            return rc, mid
+            if expiry_time is not None and qos > 0 and expiry_callback and rc in (MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN):
+                self._expiry_callback_map[mid] = expiry_callback
+            # Paho keeps QoS>0 messages, also when not connected, until they are acked
+            is_kept = qos > 0 and rc in (MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN)
+            if store_key is not None and is_kept:
+                self._stored_message_map[mid] = store_key
+        if store_key is not None and not is_kept:
+            self._message_store.remove(store_key)
+        return rc, mid
+
+    def release_stored_message(self, mid):
+        with self._event_callback_map_lock:
+            store_key = self._stored_message_map.pop(mid, None)
+            self._expiry_callback_map.pop(mid, None)
+        if store_key is not None:
+            self._message_store.remove(store_key)
+
+    def expire_message(self, mid):
+        # Paho dropped the message on expiry, no puback is coming for it
+        with self._event_callback_map_lock:
+            self._event_callback_map.pop(mid, None)
+            expiry_callback = self._expiry_callback_map.pop(mid, None)
+        self.release_stored_message(mid)
+        if expiry_callback:
+            self._logger.debug("Invoking expiry callback...")
+            expiry_callback()
 
     def subscribe(self, topic, qos, ack_callback=None):
         with self._event_callback_map_lock:
@@ -183,6 +239,15 @@ class InternalAsyncMqttClient(object):
                 self._event_callback_map[mid] = ack_callback
             return rc, mid
 
+    def subscribe_multiple(self, topic_qos_list, ack_callback=None):
+        # Subscribe to [(topic, qos), ...] in a single SUBSCRIBE packet
+        with self._event_callback_map_lock:
+            rc, mid = self._paho_client.subscribe(list(topic_qos_list))
+            if MQTT_ERR_SUCCESS == rc and ack_callback:
+                self._logger.debug("Filling in custom suback event callback...")
+                self._event_callback_map[mid] = ack_callback
+            return rc, mid
+
     def unsubscribe(self, topic, ack_callback=None):
         with self._event_callback_map_lock:
             rc, mid = self._paho_client.unsubscribe(topic)
@@ -191,11 +256,13 @@ class InternalAsyncMqttClient(object):
                 self._event_callback_map[mid] = ack_callback
             return rc, mid
 
-    def register_internal_event_callbacks(self, on_connect, on_disconnect, on_publish, on_subscribe, on_unsubscribe, on_message):
+    def register_internal_event_callbacks(self, on_connect, on_disconnect, on_publish, on_subscribe, on_unsubscribe, on_message,
+                                          on_publish_expire=None):
         self._logger.debug("Registering internal event callbacks to MQTT layer...")
         self._paho_client.on_connect = on_connect
         self._paho_client.on_disconnect = on_disconnect
         self._paho_client.on_publish = on_publish
+        self._paho_client.on_publish_expire = on_publish_expire
         self._paho_client.on_subscribe = on_subscribe
         self._paho_client.on_unsubscribe = on_unsubscribe
         self._paho_client.on_message = on_message
@@ -205,6 +272,7 @@ class InternalAsyncMqttClient(object):
         self._paho_client.on_connect = None
         self._paho_client.on_disconnect = None
         self._paho_client.on_publish = None
+        self._paho_client.on_publish_expire = None
         self._paho_client.on_subscribe = None
         self._paho_client.on_unsubscribe = None
         self._paho_client.on_message = None
@@ -16,4 +16,5 @@
 DEFAULT_CONNECT_DISCONNECT_TIMEOUT_SEC = 30
 DEFAULT_OPERATION_TIMEOUT_SEC = 5
 DEFAULT_DRAINING_INTERNAL_SEC = 0.5
+DEFAULT_MAX_TOPICS_PER_SUBSCRIBE = 8  # AWS IoT limit of topic filters in a single SUBSCRIBE
 METRICS_PREFIX = "?SDK=Python&Version="
\ No newline at end of file
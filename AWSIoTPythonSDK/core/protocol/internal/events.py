@@ -20,6 +20,7 @@ class EventTypes(object):
     SUBACK = 3
     UNSUBACK = 4
     MESSAGE = 5
+    PUBLISH_EXPIRE = 6
 
 
 class FixedEventMids(object):
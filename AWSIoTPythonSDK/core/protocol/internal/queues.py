@@ -14,6 +14,7 @@
 # */
 
 import logging
+from collections import deque
 from AWSIoTPythonSDK.core.util.enums import DropBehaviorTypes
 
 
@@ -23,35 +24,68 @@ class AppendResults(object):
     APPEND_SUCCESS = 0
 
 
-class OfflineRequestQueue(list):
+class _QueueSlot(object):
+    # A queue position. Its element is replaced in place on conflation, or set to None,
+    # leaving a skipped tombstone, when the replacement moves to the tail instead
+    __slots__ = ("data", "data_bytes", "key")
+
+    def __init__(self, data, data_bytes, key):
+        self.data = data
+        self.data_bytes = data_bytes
+        self.key = key
+
+
+class OfflineRequestQueue(object):
     _logger = logging.getLogger(__name__)
 
-    def __init__(self, max_size, drop_behavior=DropBehaviorTypes.DROP_NEWEST):
-        if not isinstance(max_size, int) or not isinstance(drop_behavior, int):
-            self._logger.error("init: MaximumSize/DropBehavior must be integer.")
-            raise TypeError("MaximumSize/DropBehavior must be integer.")
+    def __init__(self, max_size, drop_behavior=DropBehaviorTypes.DROP_NEWEST, max_bytes=-1, drop_callback=None):
+        if not isinstance(max_size, int) or not isinstance(drop_behavior, int) or not isinstance(max_bytes, int):
+            self._logger.error("init: MaximumSize/DropBehavior/MaximumBytes must be integer.")
+            raise TypeError("MaximumSize/DropBehavior/MaximumBytes must be integer.")
         if drop_behavior != DropBehaviorTypes.DROP_OLDEST and drop_behavior != DropBehaviorTypes.DROP_NEWEST:
             self._logger.error("init: Drop behavior not supported.")
             raise ValueError("Drop behavior not supported.")
 
-        list.__init__([])
+        # deque gives O(1) append, popleft and drop oldest, where list.pop(0) is O(n)
+        self._queue = deque()
+        self._size = 0  # Queued elements, not counting tombstones
+        self._tombstone_count = 0
         self._drop_behavior = drop_behavior
         # When self._maximumSize > 0, queue is limited
         # When self._maximumSize == 0, queue is disabled
         # When self._maximumSize < 0. queue is infinite
         self._max_size = max_size
+        # When self._max_bytes > 0, the total payload size of the queued requests is limited
+        # When self._max_bytes <= 0, it is not
+        self._max_bytes = max_bytes
+        self._total_bytes = 0
+        # Called with every element that is dropped instead of being queued
+        self._drop_callback = drop_callback
+        # With conflation, a new element replaces the queued one with the same, not None, key.
+        # The slot of the queued element is looked up by key
+        self._conflation_key_function = None
+        self._conflation_keeps_position = True
+        self._key_slot_map = dict()
+
+    def __len__(self):
+        return self._size
+
+    def get_total_bytes(self):
+        return self._total_bytes
 
     def _is_enabled(self):
         return self._max_size != 0
 
-    def _need_drop_messages(self):
+    def _need_drop_messages(self, extra_bytes):
         # Need to drop messages when:
         # 1. Queue is limited and full
-        # 2. Queue is disabled
-        is_queue_full = len(self) >= self._max_size
+        # 2. Queue is limited in bytes and there is no room for extra_bytes
+        # 3. Queue is disabled
+        is_queue_full = self._size >= self._max_size
         is_queue_limited = self._max_size > 0
+        is_queue_full_in_bytes = self._max_bytes > 0 and self._total_bytes + extra_bytes > self._max_bytes
         is_queue_disabled = not self._is_enabled()
-        return (is_queue_full and is_queue_limited) or is_queue_disabled
+        return (is_queue_full and is_queue_limited) or is_queue_full_in_bytes or is_queue_disabled
 
     def set_behavior_drop_newest(self):
         self._drop_behavior = DropBehaviorTypes.DROP_NEWEST
@@ -59,7 +93,18 @@ class OfflineRequestQueue(list):
     def set_behavior_drop_oldest(self):
         self._drop_behavior = DropBehaviorTypes.DROP_OLDEST
 
-    # Override
+    # key_function(element) returns the conflation key of an element, or None for an element that
+    # is never conflated. A replacement keeps the queue position of the replaced element when
+    # keeps_position is True, and is moved to the tail otherwise. None disables conflation
+    def set_conflation(self, key_function, keeps_position=True):
+        self._conflation_key_function = key_function
+        self._conflation_keeps_position = keeps_position
+        self._key_slot_map.clear()
+        for slot in self._queue:
+            slot.key = None
+            if key_function is not None and slot.data is not None:
+                self._index_slot(slot, key_function(slot.data))
+
     # Append to a queue with a limited size.
     # Return APPEND_SUCCESS if the append is successful
     # Return APPEND_FAILURE_QUEUE_FULL if the append failed because the queue is full
@@ -67,21 +112,102 @@ class OfflineRequestQueue(list):
     def append(self, data):
         ret = AppendResults.APPEND_SUCCESS
         if self._is_enabled():
-            if self._need_drop_messages():
-                # We should drop the newest
-                if DropBehaviorTypes.DROP_NEWEST == self._drop_behavior:
-                    self._logger.warn("append: Full queue. Drop the newest: " + str(data))
+            data_bytes = self._get_size_in_bytes(data)
+            key = self._get_conflation_key(data)
+            slot = self._key_slot_map.get(key) if key is not None else None
+            if slot is not None and self._can_replace(slot, data_bytes):
+                self._replace(slot, data, data_bytes)
+            elif self._need_drop_messages(data_bytes):
+                # We should drop the newest, also when it would not fit even into an empty queue
+                if DropBehaviorTypes.DROP_NEWEST == self._drop_behavior or 0 < self._max_bytes < data_bytes:
+                    self._logger.warn("append: Full queue. Drop the newest: %s", data)
+                    self._on_drop(data)
                     ret = AppendResults.APPEND_FAILURE_QUEUE_FULL
-                # We should drop the oldest
+                # We should drop the oldest, until there is room for the new one
                 else:
-                    current_oldest = super(OfflineRequestQueue, self).pop(0)
-                    self._logger.warn("append: Full queue. Drop the oldest: " + str(current_oldest))
-                    super(OfflineRequestQueue, self).append(data)
+                    while self._size and self._need_drop_messages(data_bytes):
+                        current_oldest = self.popleft()
+                        self._logger.warn("append: Full queue. Drop the oldest: %s", current_oldest)
+                        self._on_drop(current_oldest)
+                    self._push(data, data_bytes, key)
                     ret = AppendResults.APPEND_FAILURE_QUEUE_FULL
             else:
-                self._logger.debug("append: Add new element: " + str(data))
-                super(OfflineRequestQueue, self).append(data)
+                self._logger.debug("append: Add new element: %s", data)
+                self._push(data, data_bytes, key)
         else:
-            self._logger.debug("append: Queue is disabled. Drop the message: " + str(data))
+            self._logger.debug("append: Queue is disabled. Drop the message: %s", data)
+            self._on_drop(data)
             ret = AppendResults.APPEND_FAILURE_QUEUE_DISABLED
         return ret
+
+    # Remove and return the oldest element. Raise IndexError if the queue is empty
+    def popleft(self):
+        slot = self._queue.popleft()
+        while slot.data is None:
+            self._tombstone_count -= 1
+            slot = self._queue.popleft()
+        if slot.key is not None and self._key_slot_map.get(slot.key) is slot:
+            del self._key_slot_map[slot.key]
+        self._size -= 1
+        self._total_bytes -= slot.data_bytes
+        return slot.data
+
+    def clear(self):
+        self._queue.clear()
+        self._key_slot_map.clear()
+        self._size = 0
+        self._tombstone_count = 0
+        self._total_bytes = 0
+
+    def _on_drop(self, data):
+        if self._drop_callback:
+            self._drop_callback(data)
+
+    def _push(self, data, data_bytes, key=None):
+        slot = _QueueSlot(data, data_bytes, None)
+        self._queue.append(slot)
+        self._index_slot(slot, key)
+        self._size += 1
+        self._total_bytes += data_bytes
+
+    def _index_slot(self, slot, key):
+        if key is not None:
+            slot.key = key
+            self._key_slot_map[key] = slot
+
+    def _get_conflation_key(self, data):
+        if self._conflation_key_function is None:
+            return None
+        return self._conflation_key_function(data)
+
+    def _can_replace(self, slot, data_bytes):
+        # A replacement that would not fit into the byte limit is queued like any other element
+        return self._max_bytes <= 0 or self._total_bytes - slot.data_bytes + data_bytes <= self._max_bytes
+
+    def _replace(self, slot, data, data_bytes):
+        self._logger.debug("append: Replace the queued element with key %s: %s", slot.key, data)
+        replaced = slot.data
+        self._total_bytes += data_bytes - slot.data_bytes
+        if self._conflation_keeps_position:
+            slot.data = data
+            slot.data_bytes = data_bytes
+        else:
+            tail_slot = _QueueSlot(data, data_bytes, None)
+            self._queue.append(tail_slot)
+            self._index_slot(tail_slot, slot.key)
+            slot.data = None
+            slot.key = None
+            self._tombstone_count += 1
+            self._compact_tombstones()
+        self._on_drop(replaced)
+
+    def _compact_tombstones(self):
+        # Tombstones are skipped by popleft, and only cleaned up in bulk once they are the majority,
+        # so that it stays amortized O(1)
+        if self._tombstone_count > self._size:
+            self._queue = deque(slot for slot in self._queue if slot.data is not None)
+            self._tombstone_count = 0
+
+    def _get_size_in_bytes(self, data):
+        # Requests without a payload_size, like subscribe/unsubscribe, take no room in the byte limit
+        return getattr(data, "payload_size", 0)
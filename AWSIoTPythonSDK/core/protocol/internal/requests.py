@@ -25,3 +25,22 @@ class QueueableRequest(object):
     def __init__(self, type, data):
         self.type = type
         self.data = data  # Can be a tuple
+        self.store_key = None  # Key in the message store, if the request is persisted
+        # Publish requests still queued at expiry_time, on the monotonicTime clock, are dropped and
+        # reported to expiry_callback()
+        self.expiry_time = None
+        self.expiry_callback = None
+        # Payload size counted against the byte limit of the offline requests queue
+        self.payload_size = 0
+        if RequestTypes.PUBLISH == type:
+            self.payload_size = get_payload_size(data[1])
+
+
+def get_payload_size(payload):
+    if payload is None:
+        return 0
+    if isinstance(payload, (int, float)):
+        return len(str(payload))
+    if not isinstance(payload, (bytes, bytearray, memoryview)) and hasattr(payload, "encode"):
+        return len(payload.encode("utf-8"))  # Text payloads go on the wire utf-8 encoded
+    return len(payload)
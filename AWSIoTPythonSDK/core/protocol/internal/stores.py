@@ -0,0 +1,355 @@
+# /*
+# * Copyright 2010-2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# *
+# * Licensed under the Apache License, Version 2.0 (the "License").
+# * You may not use this file except in compliance with the License.
+# * A copy of the License is located at
+# *
+# *  http://aws.amazon.com/apache2.0
+# *
+# * or in the "license" file accompanying this file. This file is distributed
+# * on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# * express or implied. See the License for the specific language governing
+# * permissions and limitations under the License.
+# */
+
+import os
+import mmap
+import zlib
+import struct
+import logging
+from threading import Lock
+from threading import Timer
+from AWSIoTPythonSDK.core.protocol.connection.cores import monotonicTime
+from AWSIoTPythonSDK.core.util.enums import StoreSyncPolicies
+
+
+# Message stores keep outbound publish requests, (topic, payload, qos, retain), from the
+# moment they are accepted until they are done with: sent for QoS0, acked for QoS>0.
+# Every store implements:
+#   add(topic, payload, qos, retain) -> key, keys increase in the order of adding
+#   remove(key)
+#   load() -> [(key, (topic, payload, qos, retain))] of the stored messages, in key order
+#   sync()
+#   close()
+class InMemoryMessageStore(object):
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self._messages = dict()
+        self._next_key = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, topic, payload, qos, retain):
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._messages[key] = (topic, payload, qos, retain)
+            return key
+
+    def remove(self, key):
+        with self._lock:
+            self._messages.pop(key, None)
+
+    def load(self):
+        with self._lock:
+            return sorted(self._messages.items())
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Segment(object):
+
+    __slots__ = ("index", "path", "live_keys", "live_bytes", "used_bytes")
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.live_keys = dict()  # Key of a message added in this segment and not removed yet -> record size
+        self.live_bytes = 0
+        self.used_bytes = 0
+
+    def add_live_key(self, key, record_size):
+        self.live_keys[key] = record_size
+        self.live_bytes += record_size
+
+    def discard_live_key(self, key):
+        self.live_bytes -= self.live_keys.pop(key, 0)
+
+
+class MappedFileMessageStore(object):
+    # Append-only log of add/remove records, split into fixed size segment files under a
+    # directory. The segment being written is memory-mapped, so that appending a record is
+    # a memory copy and syncing it is an msync of the dirty pages. Older segments are read
+    # only. Segments are deleted oldest first once every message added in them is removed,
+    # and the oldest segment is compacted by copying its remaining messages forward when
+    # most of it is dead. Each record carries a CRC32, and reading a segment stops at the
+    # first torn or corrupted record.
+
+    _logger = logging.getLogger(__name__)
+
+    _RECORD_MARKER = 0xA5
+    _RECORD_ADD = 1
+    _RECORD_REMOVE = 2
+    # marker, type, crc32, key, body length
+    _RECORD_HEADER = struct.Struct("!BBIQI")
+    # qos, retain, topic length
+    _MESSAGE_HEADER = struct.Struct("!BBH")
+    _SEGMENT_SUFFIX = ".seg"
+
+    def __init__(self, directory, segment_size=1024 * 1024, sync_policy=StoreSyncPolicies.SYNC_BATCHED,
+                 sync_batch_size=100, sync_interval_sec=1.0):
+        if sync_policy not in (StoreSyncPolicies.SYNC_NONE, StoreSyncPolicies.SYNC_ALWAYS, StoreSyncPolicies.SYNC_BATCHED):
+            self._logger.error("init: Sync policy not supported.")
+            raise ValueError("Sync policy not supported.")
+        if segment_size <= self._RECORD_HEADER.size:
+            self._logger.error("init: Segment size is too small.")
+            raise ValueError("Segment size is too small.")
+        self._directory = directory
+        self._segment_size = segment_size
+        self._sync_policy = sync_policy
+        self._sync_batch_size = sync_batch_size
+        self._sync_interval_sec = sync_interval_sec
+        self._unsynced_writes = 0
+        self._last_sync_time = monotonicTime()
+        # With SYNC_BATCHED, syncs writes that are followed by no further write within the interval
+        self._sync_timer = None
+        self._lock = Lock()
+        self._segments = list()
+        self._key_segment_map = dict()  # Stored message key -> _Segment
+        self._messages = dict()  # Stored message key -> (topic, payload, qos, retain)
+        self._active_file = None
+        self._active_map = None
+        self._next_key = 0
+        # Set on roll-over, the oldest segment is compacted once the pending record is written
+        self._is_compaction_due = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._recover()
+        self._roll_over()
+        self._maybe_compact()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._messages)
+
+    def add(self, topic, payload, qos, retain):
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            message = (topic, payload, qos, retain)
+            self._append_add(key, message)
+            self._messages[key] = message
+            self._maybe_compact()
+            self._maybe_sync()
+            return key
+
+    def remove(self, key):
+        with self._lock:
+            if self._messages.pop(key, None) is None:
+                return
+            self._key_segment_map.pop(key).discard_live_key(key)
+            self._append_record(self._RECORD_REMOVE, key, b"")
+            self._delete_drained_segments()
+            self._maybe_compact()
+            self._maybe_sync()
+
+    def load(self):
+        with self._lock:
+            return sorted(self._messages.items())
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._cancel_sync_timer()
+            self._sync()
+            self._close_active_segment()
+
+    def _recover(self):
+        segment_names = sorted(name for name in os.listdir(self._directory) if name.endswith(self._SEGMENT_SUFFIX))
+        for name in segment_names:
+            segment = _Segment(int(name[:-len(self._SEGMENT_SUFFIX)]), os.path.join(self._directory, name))
+            self._segments.append(segment)
+            with open(segment.path, "rb") as segment_file:
+                self._read_segment(segment, segment_file.read())
+        self._delete_drained_segments()
+        self._logger.debug("Recovered %d stored messages from %d segments", len(self._messages), len(self._segments))
+
+    def _read_segment(self, segment, data):
+        position = 0
+        while position + self._RECORD_HEADER.size <= len(data):
+            marker, record_type, crc, key, length = self._RECORD_HEADER.unpack_from(data, position)
+            if marker != self._RECORD_MARKER:
+                break  # Preallocated space that has never been written
+            body_start = position + self._RECORD_HEADER.size
+            body = data[body_start:body_start + length]
+            if len(body) != length or crc != self._get_crc(record_type, key, body):
+                self._logger.warn("Stop reading segment %s at a torn or corrupted record", segment.path)
+                break
+            position = body_start + length
+            self._next_key = max(self._next_key, key + 1)
+            previous_segment = self._key_segment_map.pop(key, None)
+            if previous_segment is not None:  # Removed, or copied forward by a compaction that did not finish
+                previous_segment.discard_live_key(key)
+            if self._RECORD_ADD == record_type:
+                self._messages[key] = self._decode_message(body)
+                self._key_segment_map[key] = segment
+                segment.add_live_key(key, self._RECORD_HEADER.size + length)
+            elif self._RECORD_REMOVE == record_type:
+                self._messages.pop(key, None)
+        segment.used_bytes = position
+
+    def _get_crc(self, record_type, key, body):
+        return zlib.crc32(struct.pack("!BQ", record_type, key) + body) & 0xffffffff
+
+    def _encode_message(self, message):
+        topic, payload, qos, retain = message
+        if not isinstance(topic, bytes):
+            topic = topic.encode("utf-8")
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode("ascii")
+        elif not isinstance(payload, bytes):
+            payload = payload.encode("utf-8") if hasattr(payload, "encode") else bytes(payload)
+        return self._MESSAGE_HEADER.pack(qos, 1 if retain else 0, len(topic)) + topic + payload
+
+    def _decode_message(self, body):
+        qos, retain, topic_length = self._MESSAGE_HEADER.unpack_from(body, 0)
+        topic_start = self._MESSAGE_HEADER.size
+        topic = body[topic_start:topic_start + topic_length].decode("utf-8")
+        payload = bytearray(body[topic_start + topic_length:])  # Paho takes bytearray, not bytes, payloads
+        return topic, payload, qos, bool(retain)
+
+    def _append_add(self, key, message):
+        record_size = self._append_record(self._RECORD_ADD, key, self._encode_message(message))
+        segment = self._segments[-1]
+        self._key_segment_map[key] = segment
+        segment.add_live_key(key, record_size)
+
+    def _append_record(self, record_type, key, body):
+        record_size = self._RECORD_HEADER.size + len(body)
+        segment = self._segments[-1]
+        if segment.used_bytes + record_size > len(self._active_map):
+            self._roll_over(record_size)
+            segment = self._segments[-1]
+        header = self._RECORD_HEADER.pack(self._RECORD_MARKER, record_type, self._get_crc(record_type, key, body),
+                                          key, len(body))
+        position = segment.used_bytes
+        # Body first and header last, so that a crash in between leaves no valid marker behind
+        self._active_map[position + self._RECORD_HEADER.size:position + record_size] = body
+        self._active_map[position:position + self._RECORD_HEADER.size] = header
+        segment.used_bytes += record_size
+        self._unsynced_writes += 1
+        return record_size
+
+    def _roll_over(self, record_size=0):
+        # Seal the active segment, if any, and start writing into a new one
+        if self._active_map is not None:
+            self._sync()
+            self._close_active_segment()
+        index = self._segments[-1].index + 1 if self._segments else 0
+        segment = _Segment(index, os.path.join(self._directory, "%016d%s" % (index, self._SEGMENT_SUFFIX)))
+        size = max(self._segment_size, record_size)
+        self._active_file = open(segment.path, "w+b")
+        self._active_file.truncate(size)
+        self._active_file.flush()
+        os.fsync(self._active_file.fileno())
+        self._sync_directory()
+        self._active_map = mmap.mmap(self._active_file.fileno(), size)
+        self._segments.append(segment)
+        self._is_compaction_due = True
+        self._delete_drained_segments()
+
+    def _maybe_compact(self):
+        # Not done in _roll_over, so that the record that made it roll over is always written
+        # into the space it was sized for, ahead of the compacted ones
+        if self._is_compaction_due:
+            self._is_compaction_due = False
+            self._compact_oldest_segment()
+
+    def _compact_oldest_segment(self):
+        # Copy the remaining messages of a mostly dead oldest segment into the active one, so
+        # that a few long-lived messages do not pin whole segments on disk
+        if len(self._segments) < 3:
+            return
+        oldest_segment = self._segments[0]
+        if not oldest_segment.live_keys or oldest_segment.live_bytes * 2 > oldest_segment.used_bytes:
+            return
+        self._logger.debug("Compacting segment %s with %d live messages", oldest_segment.path,
+                           len(oldest_segment.live_keys))
+        for key in sorted(oldest_segment.live_keys):
+            self._append_add(key, self._messages[key])
+            oldest_segment.discard_live_key(key)
+        self._sync()
+        self._delete_drained_segments()
+
+    def _delete_drained_segments(self):
+        # Only delete from the oldest end: remove records of a segment may refer to messages
+        # added in older segments, and must outlive them
+        while len(self._segments) > 1 and not self._segments[0].live_keys:
+            segment = self._segments.pop(0)
+            try:
+                os.remove(segment.path)
+            except OSError as e:
+                self._logger.warn("Failed to delete drained segment %s: %s", segment.path, e)
+
+    def _maybe_sync(self):
+        if StoreSyncPolicies.SYNC_ALWAYS == self._sync_policy:
+            self._sync()
+        elif StoreSyncPolicies.SYNC_BATCHED == self._sync_policy:
+            if self._unsynced_writes >= self._sync_batch_size \
+                    or monotonicTime() - self._last_sync_time >= self._sync_interval_sec:
+                self._sync()
+            elif self._sync_timer is None:
+                self._sync_timer = Timer(self._sync_interval_sec, self._on_sync_timer)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+
+    def _on_sync_timer(self):
+        with self._lock:
+            self._sync_timer = None
+            if self._active_map is not None:
+                self._sync()
+
+    def _cancel_sync_timer(self):
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+
+    def _sync(self):
+        if self._active_map is not None and self._unsynced_writes:
+            self._active_map.flush()
+        self._unsynced_writes = 0
+        self._last_sync_time = monotonicTime()
+
+    def _close_active_segment(self):
+        if self._active_map is not None:
+            self._active_map.close()
+            self._active_file.close()
+            self._active_map = None
+            self._active_file = None
+
+    def _sync_directory(self):
+        # Persist segment creation, where the platform supports syncing a directory
+        try:
+            directory_fd = os.open(self._directory, os.O_RDONLY)
+        except (OSError, AttributeError):
+            return
+        try:
+            os.fsync(directory_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(directory_fd)
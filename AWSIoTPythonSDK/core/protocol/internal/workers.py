@@ -13,29 +13,43 @@
 # * permissions and limitations under the License.
 # */
 
-import time
 import logging
+from collections import deque
 from threading import Thread
 from threading import Event
+from threading import Lock
+from threading import Condition
 from AWSIoTPythonSDK.core.protocol.internal.events import EventTypes
 from AWSIoTPythonSDK.core.protocol.internal.events import FixedEventMids
 from AWSIoTPythonSDK.core.protocol.internal.clients import ClientStatus
 from AWSIoTPythonSDK.core.protocol.internal.queues import OfflineRequestQueue
 from AWSIoTPythonSDK.core.protocol.internal.requests import RequestTypes
 from AWSIoTPythonSDK.core.protocol.paho.client import topic_matches_sub
+from AWSIoTPythonSDK.core.protocol.paho.client import TopicFilterIndex
 from AWSIoTPythonSDK.core.protocol.internal.defaults import DEFAULT_DRAINING_INTERNAL_SEC
+from AWSIoTPythonSDK.core.protocol.internal.defaults import DEFAULT_MAX_TOPICS_PER_SUBSCRIBE
+from AWSIoTPythonSDK.core.protocol.paho.client import MQTT_ERR_SUCCESS
+from AWSIoTPythonSDK.core.protocol.paho.client import CONNACK_ACCEPTED
+from AWSIoTPythonSDK.core.protocol.connection.cores import monotonicTime
+from AWSIoTPythonSDK.core.util.enums import DropBehaviorTypes
+from AWSIoTPythonSDK.core.util.enums import LanePolicyTypes
 
 
 class EventProducer(object):
 
     _logger = logging.getLogger(__name__)
 
-    def __init__(self, cv, event_queue):
+    def __init__(self, cv, event_queue, subscription_manager=None):
         self._cv = cv
         self._event_queue = event_queue
+        # Inline subscription callbacks run right here, on the network thread
+        self._subscription_manager = subscription_manager
+        self._inline_stats_lock = Lock()
+        self._reset_inline_stats()
 
     def on_connect(self, client, user_data, flags, rc):
-        self._add_to_queue(FixedEventMids.CONNACK_MID, EventTypes.CONNACK, rc)
+        session_present = bool(flags.get("session present"))
+        self._add_to_queue(FixedEventMids.CONNACK_MID, EventTypes.CONNACK, (rc, session_present))
         self._logger.debug("Produced [connack] event")
 
     def on_disconnect(self, client, user_data, rc):
@@ -46,6 +60,10 @@ class EventProducer(object):
         self._add_to_queue(mid, EventTypes.PUBACK, None)
         self._logger.debug("Produced [puback] event")
 
+    def on_publish_expire(self, client, user_data, mid):
+        self._add_to_queue(mid, EventTypes.PUBLISH_EXPIRE, None)
+        self._logger.debug("Produced [publish expire] event")
+
     def on_subscribe(self, client, user_data, mid, granted_qos):
         self._add_to_queue(mid, EventTypes.SUBACK, granted_qos)
         self._logger.debug("Produced [suback] event")
@@ -55,18 +73,55 @@ class EventProducer(object):
         self._logger.debug("Produced [unsuback] event")
 
     def on_message(self, client, user_data, message):
+        if self._subscription_manager is not None:
+            self._dispatch_inline(message)
         self._add_to_queue(FixedEventMids.MESSAGE_MID, EventTypes.MESSAGE, message)
         self._logger.debug("Produced [message] event")
 
+    def get_inline_stats(self):
+        with self._inline_stats_lock:
+            return {
+                "inline_callbacks": self._inline_callbacks,
+                "budget_overruns": self._inline_overruns,
+                "max_elapsed_sec": self._inline_max_elapsed_sec
+            }
+
+    def reset_inline_stats(self):
+        with self._inline_stats_lock:
+            self._reset_inline_stats()
+
+    def _reset_inline_stats(self):
+        self._inline_callbacks = 0
+        self._inline_overruns = 0
+        self._inline_max_elapsed_sec = 0.0
+
+    def _dispatch_inline(self, message):
+        for topic, (qos, message_callback), budget_sec in self._subscription_manager.match_inline_records(message.topic):
+            start_time = monotonicTime()
+            try:
+                message_callback(None, None, message)  # message_callback(client, userdata, message)
+            except Exception:
+                # Never let a user callback take down the network thread
+                self._logger.exception("Inline message callback for %s raised an exception", topic)
+            elapsed_sec = monotonicTime() - start_time
+            with self._inline_stats_lock:
+                self._inline_callbacks += 1
+                if elapsed_sec > self._inline_max_elapsed_sec:
+                    self._inline_max_elapsed_sec = elapsed_sec
+                if elapsed_sec > budget_sec:
+                    self._inline_overruns += 1
+            if elapsed_sec > budget_sec:
+                self._logger.warn("Inline message callback for %s took %f sec, over its budget of %f sec",
+                                  topic, elapsed_sec, budget_sec)
+
     def _add_to_queue(self, mid, event_type, data):
         with self._cv:
-            self._event_queue.put((mid, event_type, data))
+            self._event_queue.append((mid, event_type, data, monotonicTime()))
             self._cv.notify()
 
 
 class EventConsumer(object):
 
-    MAX_DISPATCH_INTERNAL_SEC = 0.01
     _logger = logging.getLogger(__name__)
 
     def __init__(self, cv, event_queue, internal_async_client,
@@ -79,13 +134,20 @@ class EventConsumer(object):
         self._client_status = client_status
         self._is_running = False
         self._draining_interval_sec = DEFAULT_DRAINING_INTERNAL_SEC
+        self._draining_scheduler = DrainingScheduler(1 / DEFAULT_DRAINING_INTERNAL_SEC)
+        self._max_topics_per_subscribe = DEFAULT_MAX_TOPICS_PER_SUBSCRIBE
+        self._resubscribe_lock = Lock()
+        self._resubscribe_path = None
+        self._resubscribe_path_counts = {"full": 0, "delta": 0, "skipped": 0}
+        self._reset_resubscribe_stats(0)
         self._dispatch_methods = {
             EventTypes.CONNACK : self._dispatch_connack,
             EventTypes.DISCONNECT : self._dispatch_disconnect,
             EventTypes.PUBACK : self._dispatch_puback,
             EventTypes.SUBACK : self._dispatch_suback,
             EventTypes.UNSUBACK : self._dispatch_unsuback,
-            EventTypes.MESSAGE : self._dispatch_message
+            EventTypes.MESSAGE : self._dispatch_message,
+            EventTypes.PUBLISH_EXPIRE : self._dispatch_publish_expire
         }
         self._offline_request_handlers = {
             RequestTypes.PUBLISH : self._handle_offline_publish,
@@ -93,12 +155,54 @@ class EventConsumer(object):
             RequestTypes.UNSUBSCRIBE : self._handle_offline_unsubscribe
         }
         self._stopper = Event()
+        self._message_callback_executor = None
+        # Bumped on every start, so that a consumer thread left over from a previous
+        # connection exits instead of dispatching alongside the new one
+        self._generation = 0
+        self._stats_lock = Lock()
+        self._reset_stats()
 
     def update_offline_requests_manager(self, offline_requests_manager):
         self._offline_requests_manager = offline_requests_manager
 
+    def update_message_callback_executor(self, message_callback_executor):
+        self._message_callback_executor = message_callback_executor
+
     def update_draining_interval_sec(self, draining_interval_sec):
         self._draining_interval_sec = draining_interval_sec
+        self._draining_scheduler.update_rate(1 / float(draining_interval_sec))
+
+    def update_draining_burst(self, burst, follow_acks):
+        self._draining_scheduler.update_burst(burst, follow_acks)
+
+    def update_max_topics_per_subscribe(self, max_topics_per_subscribe):
+        self._max_topics_per_subscribe = max_topics_per_subscribe
+
+    def get_resubscribe_stats(self):
+        # Outcome of the latest resubscribe: the path taken on connack, topics and SUBSCRIBE packets
+        # sent, packets still waiting for a SUBACK, topics the broker or the client failed, and the
+        # time from the first SUBSCRIBE to the last SUBACK. Also the number of times each path was taken
+        with self._resubscribe_lock:
+            return {
+                "path": self._resubscribe_path,
+                "path_counts": dict(self._resubscribe_path_counts),
+                "topics": self._resubscribe_topic_count,
+                "packets": self._resubscribe_packet_count,
+                "pending_packets": len(self._resubscribe_pending_map),
+                "failed_topics": list(self._resubscribe_failed_topics),
+                "duration_sec": self._resubscribe_duration_sec
+            }
+
+    def _reset_resubscribe_stats(self, topic_count):
+        self._resubscribe_topic_count = topic_count
+        self._resubscribe_packet_count = 0
+        self._resubscribe_pending_map = dict()  # mid -> [topic, ...] of the SUBSCRIBE packet
+        self._resubscribe_failed_topics = list()
+        self._resubscribe_start_time = monotonicTime()
+        self._resubscribe_duration_sec = None
+
+    def get_draining_stats(self):
+        return self._draining_scheduler.get_stats(self._offline_requests_manager.get_size())
 
     def get_draining_interval_sec(self):
         return self._draining_interval_sec
@@ -106,10 +210,41 @@ class EventConsumer(object):
     def is_running(self):
         return self._is_running
 
+    def get_stats(self):
+        # Wakeups of the consuming thread, dispatched events and batches, and the
+        # enqueue to dispatch latency of events, since the last reset
+        with self._stats_lock:
+            stats = dict(self._stats)
+        if stats["dispatched_events"]:
+            stats["average_latency_sec"] = stats["total_latency_sec"] / stats["dispatched_events"]
+        else:
+            stats["average_latency_sec"] = None
+        del stats["total_latency_sec"]
+        return stats
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+            "wakeups": 0,
+            "batches": 0,
+            "dispatched_events": 0,
+            "max_batch_size": 0,
+            "total_latency_sec": 0.0,
+            "max_latency_sec": 0.0
+        }
+
     def start(self):
         self._stopper.clear()
-        self._is_running = True
-        dispatch_events = Thread(target=self._dispatch)
+        with self._cv:
+            self._generation += 1
+            self._is_running = True
+            generation = self._generation
+        if self._message_callback_executor is not None:
+            self._message_callback_executor.start()
+        dispatch_events = Thread(target=self._dispatch, args=(generation,))
         dispatch_events.daemon = True
         dispatch_events.start()
         self._logger.debug("Event consuming thread started")
@@ -118,12 +253,15 @@ class EventConsumer(object):
         if self._is_running:
             self._is_running = False
             self._clean_up()
+            if self._message_callback_executor is not None:
+                self._message_callback_executor.stop()
         self._logger.debug("Event consuming thread stopped")
 
     def _clean_up(self):
         self._logger.debug("Cleaning up before stopping event consuming")
-        with self._event_queue.mutex:
-            self._event_queue.queue.clear()
+        with self._cv:
+            self._event_queue.clear()
+            self._cv.notify_all()  # Wake up the consuming thread so that it exits
             self._logger.debug("Event queue cleared")
         self._internal_async_client.stop_background_network_io()
         self._logger.debug("Network thread stopped")
@@ -137,21 +275,60 @@ class EventConsumer(object):
     def is_fully_stopped(self):
         return self._stopper.is_set()
 
-    def _dispatch(self):
-        while self._is_running:
+    def _is_current(self, generation):
+        return self._is_running and generation == self._generation
+
+    def _dispatch(self, generation):
+        while True:
+            # Block until events arrive, then take all of them in one batch
+            # and dispatch them without holding the lock
             with self._cv:
-                if self._event_queue.empty():
-                    self._cv.wait(self.MAX_DISPATCH_INTERNAL_SEC)
-                else:
-                    while not self._event_queue.empty():
-                        self._dispatch_one()
-        self._stopper.set()
+                while self._is_current(generation) and not self._event_queue:
+                    self._cv.wait()
+                    with self._stats_lock:
+                        self._stats["wakeups"] += 1
+                if not self._is_current(generation):
+                    break
+                events = list(self._event_queue)
+                self._event_queue.clear()
+            self._record_batch(len(events))
+            for event in events:
+                if not self._is_current(generation):
+                    break  # Stopped by a disconnect event in this batch
+                self._record_latency(event)
+                self._dispatch_one(event)
+        if generation == self._generation:
+            self._stopper.set()
         self._logger.debug("Exiting dispatching loop...")
 
-    def _dispatch_one(self):
-        mid, event_type, data = self._event_queue.get()
+    def _record_batch(self, batch_size):
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], batch_size)
+
+    def _record_latency(self, event):
+        latency_sec = monotonicTime() - event[3]
+        with self._stats_lock:
+            self._stats["dispatched_events"] += 1
+            self._stats["total_latency_sec"] += latency_sec
+            if latency_sec > self._stats["max_latency_sec"]:
+                self._stats["max_latency_sec"] = latency_sec
+
+    def _dispatch_one(self, event):
+        mid, event_type, data, enqueue_time = event
         if mid:
+            message_callback_executor = self._message_callback_executor
+            if EventTypes.MESSAGE == event_type and message_callback_executor is not None:
+                # Message callbacks run on the executor, so that they never hold up
+                # connack/disconnect/ack events
+                message_callback_executor.submit(data, self._create_message_callbacks_task(data))
+                return
             self._dispatch_methods[event_type](mid, data)
+            if EventTypes.PUBLISH_EXPIRE == event_type:
+                return  # Its expiry callback has been invoked in dispatching, there is no ack callback to invoke
+            if EventTypes.CONNACK == event_type:
+                rc, session_present = data
+                data = rc  # Connack callbacks only get the rc
             self._internal_async_client.invoke_event_callback(mid, data=data)
             # We need to make sure disconnect event gets dispatched and then we stop the consumer
             if self._need_to_stop_dispatching(mid):
@@ -162,9 +339,21 @@ class EventConsumer(object):
         return (ClientStatus.USER_DISCONNECT == status or ClientStatus.CONNECT == status) \
                and mid == FixedEventMids.DISCONNECT_MID
 
-    def _dispatch_connack(self, mid, rc):
+    def _dispatch_connack(self, mid, data):
+        rc, session_present = data
         status = self._client_status.get_status()
-        self._logger.debug("Dispatching [connack] event")
+        self._logger.debug("Dispatching [connack] event, session present: %s", session_present)
+        requeued_count = self._offline_requests_manager.close_pipeline(CONNACK_ACCEPTED == rc)
+        if CONNACK_ACCEPTED != rc and requeued_count is not None:
+            # Requests sent ahead of CONNACK are queued again, or resubscribed, on the next accepted one
+            self._logger.warn("Connection refused: %d. Queued %d pipelined requests again", rc, requeued_count)
+            self._subscription_manager.clear_pipelined()
+            self._client_status.set_status(ClientStatus.ABNORMAL_DISCONNECT)
+            return
+        if not session_present:
+            # Subscriptions did not survive on the broker, all of them need resubscribing
+            self._subscription_manager.clear_confirmations()
+        self._record_resubscribe_path(session_present)
         if self._need_recover():
             if ClientStatus.STABLE != status:  # To avoid multiple connack dispatching
                 self._logger.debug("Has recovery job")
@@ -175,7 +364,25 @@ class EventConsumer(object):
             self._client_status.set_status(ClientStatus.STABLE)
 
     def _need_recover(self):
-        return self._subscription_manager.list_records() or self._offline_requests_manager.has_more()
+        return self._subscription_manager.list_unconfirmed_records() or self._offline_requests_manager.has_more()
+
+    def _record_resubscribe_path(self, session_present):
+        # Full: new session, resubscribe all. Delta: session present, resubscribe only the topics
+        # never acked in it. Skipped: session present with every topic acked in it
+        record_count = len(self._subscription_manager.list_records())
+        if not record_count:
+            return
+        unconfirmed_count = len(self._subscription_manager.list_unconfirmed_records())
+        if not session_present:
+            path = "full"
+        elif unconfirmed_count:
+            path = "delta"
+        else:
+            path = "skipped"
+        self._logger.debug("Resubscribe path: %s, %d of %d topics", path, unconfirmed_count, record_count)
+        with self._resubscribe_lock:
+            self._resubscribe_path = path
+            self._resubscribe_path_counts[path] += 1
 
     def _clean_up_debt(self):
         self._handle_resubscribe()
@@ -183,28 +390,64 @@ class EventConsumer(object):
         self._client_status.set_status(ClientStatus.STABLE)
 
     def _handle_resubscribe(self):
-        subscriptions = self._subscription_manager.list_records()
+        subscriptions = self._subscription_manager.list_unconfirmed_records()
         if subscriptions and not self._has_user_disconnect_request():
             self._logger.debug("Start resubscribing")
             self._client_status.set_status(ClientStatus.RESUBSCRIBE)
-            for topic, (qos, message_callback) in subscriptions:
+            with self._resubscribe_lock:
+                self._reset_resubscribe_stats(len(subscriptions))
+            # Pack the topics into as few SUBSCRIBE packets as the broker allows. SUBACKs are
+            # tracked asynchronously, so that user traffic is not held up waiting for them
+            batch_size = self._max_topics_per_subscribe
+            for index in range(0, len(subscriptions), batch_size):
                 if self._has_user_disconnect_request():
                     self._logger.debug("User disconnect detected")
                     break
-                self._internal_async_client.subscribe(topic, qos)
+                topic_qos_list = [(topic, qos) for topic, (qos, message_callback) in subscriptions[index:index + batch_size]]
+                with self._resubscribe_lock:
+                    rc, mid = self._internal_async_client.subscribe_multiple(topic_qos_list, self._on_resubscribe_suback)
+                    self._resubscribe_packet_count += 1
+                    if MQTT_ERR_SUCCESS == rc:
+                        self._resubscribe_pending_map[mid] = [topic for topic, qos in topic_qos_list]
+                    else:
+                        self._logger.error("Resubscribe error: %d, topics: %s", rc, topic_qos_list)
+                        self._resubscribe_failed_topics.extend(topic for topic, qos in topic_qos_list)
+
+    def _on_resubscribe_suback(self, mid, data):
+        with self._resubscribe_lock:
+            topics = self._resubscribe_pending_map.pop(mid, None)
+            if topics is None:  # SUBACK of an earlier resubscribe
+                return
+            for topic, granted_qos in zip(topics, data):
+                if granted_qos == 0x80:
+                    self._logger.error("Resubscribe to %s rejected by the broker", topic)
+                    self._resubscribe_failed_topics.append(topic)
+                else:
+                    self._subscription_manager.confirm_record(topic)
+            if not self._resubscribe_pending_map:
+                self._resubscribe_duration_sec = monotonicTime() - self._resubscribe_start_time
+                self._logger.debug("Resubscribed %d topics in %d packets in %f sec", self._resubscribe_topic_count,
+                                   self._resubscribe_packet_count, self._resubscribe_duration_sec)
 
     def _handle_draining(self):
         if self._offline_requests_manager.has_more() and not self._has_user_disconnect_request():
             self._logger.debug("Start draining")
             self._client_status.set_status(ClientStatus.DRAINING)
+            self._draining_scheduler.start()
             while self._offline_requests_manager.has_more():
-                if self._has_user_disconnect_request():
+                # Wait for a token, and for room in the in-flight window if following acks
+                if not self._draining_scheduler.acquire(self._has_user_disconnect_request, self._has_inflight_room):
                     self._logger.debug("User disconnect detected")
                     break
                 offline_request = self._offline_requests_manager.get_next()
                 if offline_request:
                     self._offline_request_handlers[offline_request.type](offline_request)
-                    time.sleep(self._draining_interval_sec)
+                    self._draining_scheduler.record_drained()
+            self._draining_scheduler.stop()
+
+    def _has_inflight_room(self):
+        inflight_window_stats = self._internal_async_client.get_inflight_window_stats()
+        return inflight_window_stats["window"] == 0 or inflight_window_stats["inflight"] < inflight_window_stats["window"]
 
     def _has_user_disconnect_request(self):
         return ClientStatus.USER_DISCONNECT == self._client_status.get_status()
@@ -216,11 +459,22 @@ class EventConsumer(object):
             pass
         else:
             self._client_status.set_status(ClientStatus.ABNORMAL_DISCONNECT)
+        # Lost before CONNACK: requests sent ahead of it are queued again, or resubscribed
+        self._offline_requests_manager.close_pipeline(False)
+        self._subscription_manager.clear_pipelined()
+        self._draining_scheduler.notify()
 
     # For puback, suback and unsuback, ack callback invocation is handled in dispatch_one
     # Do nothing in the event dispatching itself
     def _dispatch_puback(self, mid, rc):
         self._logger.debug("Dispatching [puback] event")
+        self._internal_async_client.release_stored_message(mid)
+        self._draining_scheduler.notify()  # Room in the in-flight window for the next drained request
+
+    def _dispatch_publish_expire(self, mid, data):
+        self._logger.debug("Dispatching [publish expire] event")
+        self._internal_async_client.expire_message(mid)
+        self._draining_scheduler.notify()  # Room in the in-flight window for the next drained request
 
     def _dispatch_suback(self, mid, rc):
         self._logger.debug("Dispatching [suback] event")
@@ -230,21 +484,31 @@ class EventConsumer(object):
 
     def _dispatch_message(self, mid, message):
         self._logger.debug("Dispatching [message] event")
-        subscriptions = self._subscription_manager.list_records()
-        if subscriptions:
-            for topic, (qos, message_callback) in subscriptions:
-                if topic_matches_sub(topic, message.topic) and message_callback:
-                    message_callback(None, None, message)  # message_callback(client, userdata, message)
+        for topic, (qos, message_callback) in self._subscription_manager.match_records(message.topic):
+            if message_callback:
+                message_callback(None, None, message)  # message_callback(client, userdata, message)
+
+    def _create_message_callbacks_task(self, message):
+        # Subscription callbacks are matched now, in the order of the message events
+        message_callbacks = [message_callback for topic, (qos, message_callback)
+                             in self._subscription_manager.match_records(message.topic) if message_callback]
+
+        def message_callbacks_task():
+            for message_callback in message_callbacks:
+                message_callback(None, None, message)  # message_callback(client, userdata, message)
+            self._internal_async_client.invoke_event_callback(FixedEventMids.MESSAGE_MID, data=message)
+        return message_callbacks_task
 
     def _handle_offline_publish(self, request):
-        topic, payload, qos, retain = request.data
-        self._internal_async_client.publish(topic, payload, qos, retain)
+        topic, payload, qos, retain, priority = request.data
+        self._internal_async_client.publish(topic, payload, qos, retain, store_key=request.store_key, priority=priority,
+                                            expiry_time=request.expiry_time, expiry_callback=request.expiry_callback)
         self._logger.debug("Processed offline publish request")
 
     def _handle_offline_subscribe(self, request):
-        topic, qos, message_callback = request.data
-        self._subscription_manager.add_record(topic, qos, message_callback)
-        self._internal_async_client.subscribe(topic, qos)
+        topic, qos, message_callback, inline_budget_sec = request.data
+        self._subscription_manager.add_record(topic, qos, message_callback, inline_budget_sec)
+        self._internal_async_client.subscribe(topic, qos, self._subscription_manager.create_confirming_ack_callback(topic))
         self._logger.debug("Processed offline subscribe request")
 
     def _handle_offline_unsubscribe(self, request):
@@ -260,37 +524,403 @@ class SubscriptionManager(object):
 
     def __init__(self):
         self._subscription_map = dict()
-
-    def add_record(self, topic, qos, message_callback):
+        # Topic filters indexed by topic level, matches come back in subscription order
+        self._topic_filter_index = TopicFilterIndex()
+        # Topic filters whose callbacks run inline on the network thread -> time budget in seconds
+        self._inline_budget_map = dict()
+        # Topic filters acked by the broker in the current session, no need to resubscribe them
+        # while the session is present
+        self._confirmed_topics = set()
+        # Topic filters subscribed right behind CONNECT, not to be resubscribed on its CONNACK
+        self._pipelined_topics = set()
+        self._lock = Lock()
+
+    def add_record(self, topic, qos, message_callback, inline_budget_sec=None):
         self._logger.debug("Adding a new subscription record: %s qos: %d", topic, qos)
-        self._subscription_map[topic] = qos, message_callback  # message_callback could be None
+        with self._lock:
+            self._topic_filter_index.add(topic)  # No-op if already subscribed
+            self._subscription_map[topic] = qos, message_callback  # message_callback could be None
+            self._confirmed_topics.discard(topic)  # Until the SUBACK of this subscribe
+            if inline_budget_sec is not None and message_callback:
+                self._inline_budget_map[topic] = inline_budget_sec
+            else:
+                self._inline_budget_map.pop(topic, None)
 
     def remove_record(self, topic):
         self._logger.debug("Removing subscription record: %s", topic)
-        if self._subscription_map.get(topic):  # Ignore topics that are never subscribed to
-            del self._subscription_map[topic]
-        else:
-            self._logger.warn("Removing attempt for non-exist subscription record: %s", topic)
+        with self._lock:
+            if self._subscription_map.get(topic):  # Ignore topics that are never subscribed to
+                del self._subscription_map[topic]
+                self._topic_filter_index.remove(topic)
+                self._inline_budget_map.pop(topic, None)
+                self._confirmed_topics.discard(topic)
+                self._pipelined_topics.discard(topic)
+                return
+        self._logger.warn("Removing attempt for non-exist subscription record: %s", topic)
 
     def list_records(self):
-        return list(self._subscription_map.items())
+        with self._lock:
+            return list(self._subscription_map.items())
+
+    def list_unconfirmed_records(self):
+        with self._lock:
+            return [record for record in self._subscription_map.items()
+                    if record[0] not in self._confirmed_topics and record[0] not in self._pipelined_topics]
+
+    def confirm_record(self, topic):
+        with self._lock:
+            self._pipelined_topics.discard(topic)
+            if topic in self._subscription_map:
+                self._confirmed_topics.add(topic)
+
+    def mark_pipelined(self, topic):
+        with self._lock:
+            self._pipelined_topics.add(topic)
+
+    def clear_pipelined(self):
+        with self._lock:
+            self._pipelined_topics.clear()
+
+    def clear_confirmations(self):
+        with self._lock:
+            self._confirmed_topics.clear()
+
+    def create_confirming_ack_callback(self, topic, ack_callback=None):
+        # Wrap a suback callback to confirm the topic, unless the broker rejected it
+        def confirming_ack_callback(mid, data=None):
+            if data and data[0] != 0x80:
+                self.confirm_record(topic)
+            if ack_callback:
+                ack_callback(mid=mid, data=data)
+        return confirming_ack_callback
+
+    def match_records(self, topic):
+        # Return the (topic filter, (qos, message_callback)) records matching the topic
+        # in subscription order, in O(topic depth) rather than O(subscriptions)
+        # Inline records are left out, they are dispatched by match_inline_records
+        with self._lock:
+            matched_topics = self._topic_filter_index.match(topic)
+            return [(matched_topic, self._subscription_map[matched_topic]) for matched_topic in matched_topics
+                    if matched_topic not in self._inline_budget_map]
+
+    def match_inline_records(self, topic):
+        # Return the (topic filter, (qos, message_callback), budget sec) inline records matching the topic
+        with self._lock:
+            if not self._inline_budget_map:
+                return []
+            matched_topics = self._topic_filter_index.match(topic)
+            return [(matched_topic, self._subscription_map[matched_topic], self._inline_budget_map[matched_topic])
+                    for matched_topic in matched_topics if matched_topic in self._inline_budget_map]
+
+
+class DrainingScheduler(object):
+
+    _logger = logging.getLogger(__name__)
+
+    # Upper bound on a wait for an ack, in case the window frees up without one, e.g. on a dropped message
+    _MAX_ACK_WAIT_SEC = 1.0
+
+    def __init__(self, rate_per_sec, burst=1, follow_acks=False):
+        # Token bucket: up to burst requests back to back, refilled at rate_per_sec
+        self._cv = Condition()
+        self._rate_per_sec = rate_per_sec
+        self._burst = burst
+        self._follow_acks = follow_acks
+        self._tokens = float(burst)
+        self._last_refill_time = monotonicTime()
+        self._is_draining = False
+        self._start_time = None
+        self._drained_count = 0
+
+    def update_rate(self, rate_per_sec):
+        with self._cv:
+            self._rate_per_sec = rate_per_sec
+            self._cv.notify_all()
+
+    def update_burst(self, burst, follow_acks):
+        with self._cv:
+            self._burst = burst
+            self._follow_acks = follow_acks
+            self._tokens = min(self._tokens, float(burst))
+            self._cv.notify_all()
+
+    def start(self):
+        with self._cv:
+            self._tokens = float(self._burst)
+            self._last_refill_time = monotonicTime()
+            self._is_draining = True
+            self._start_time = self._last_refill_time
+            self._drained_count = 0
+
+    def stop(self):
+        with self._cv:
+            self._is_draining = False
+
+    def notify(self):
+        with self._cv:
+            self._cv.notify_all()
+
+    def acquire(self, should_stop, has_inflight_room):
+        # Block until the next request may go out. Return False if should_stop() turned True
+        with self._cv:
+            while True:
+                if should_stop():
+                    return False
+                self._refill()
+                has_token = self._tokens >= 1
+                if has_token and (not self._follow_acks or has_inflight_room()):
+                    self._tokens -= 1
+                    return True
+                if has_token:
+                    self._cv.wait(self._MAX_ACK_WAIT_SEC)
+                else:
+                    self._cv.wait((1 - self._tokens) / self._rate_per_sec)
+
+    def record_drained(self):
+        with self._cv:
+            self._drained_count += 1
+
+    def get_stats(self, remaining):
+        with self._cv:
+            rate_per_sec = self._rate_per_sec
+            if self._is_draining and self._drained_count:
+                elapsed_sec = monotonicTime() - self._start_time
+                if elapsed_sec > 0:
+                    rate_per_sec = self._drained_count / elapsed_sec
+            return {
+                "draining": self._is_draining,
+                "remaining": remaining,
+                "drained": self._drained_count,
+                "rate_per_sec": rate_per_sec,
+                "eta_sec": remaining / rate_per_sec if rate_per_sec > 0 else None
+            }
+
+    def _refill(self):
+        now = monotonicTime()
+        self._tokens = min(float(self._burst), self._tokens + (now - self._last_refill_time) * self._rate_per_sec)
+        self._last_refill_time = now
+
+
+class MessageCallbackExecutor(object):
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, worker_count, max_queue_size, drop_behavior=DropBehaviorTypes.DROP_NEWEST, key_function=None):
+        # Messages are partitioned by key_function(message), the topic by default. Each key
+        # always goes to the same worker, so messages with the same key are processed in
+        # order while different keys are processed in parallel.
+        if not isinstance(worker_count, int) or not isinstance(max_queue_size, int) or not isinstance(drop_behavior, int):
+            self._logger.error("init: WorkerCount/MaximumQueueSize/DropBehavior must be integer.")
+            raise TypeError("WorkerCount/MaximumQueueSize/DropBehavior must be integer.")
+        if worker_count < 1 or max_queue_size == 0:
+            self._logger.error("init: Worker count and maximum queue size must be positive.")
+            raise ValueError("Worker count and maximum queue size must be positive.")
+        if drop_behavior != DropBehaviorTypes.DROP_OLDEST and drop_behavior != DropBehaviorTypes.DROP_NEWEST:
+            self._logger.error("init: Drop behavior not supported.")
+            raise ValueError("Drop behavior not supported.")
+        self._max_queue_size = max_queue_size  # Per worker, infinite when negative
+        self._drop_behavior = drop_behavior
+        self._key_function = key_function if key_function else self._get_topic
+        self._worker_count = worker_count
+        self._queues = list()
+        self._cvs = list()
+        self._dropped_counts = [0] * worker_count  # Per worker, each guarded by the worker's condition
+        self._is_running = False
+        self._generation = 0
+        self.start()
+
+    def _get_topic(self, message):
+        return message.topic
+
+    def submit(self, message, task):
+        # Queue task() on the worker of the message's key
+        # Return False if the task, or an older one, was dropped because the queue is full
+        index = hash(self._key_function(message)) % len(self._queues)
+        queue = self._queues[index]
+        with self._cvs[index]:
+            if 0 < self._max_queue_size <= len(queue):
+                self._dropped_counts[index] += 1
+                if DropBehaviorTypes.DROP_NEWEST == self._drop_behavior:
+                    self._logger.warn("submit: Full queue. Drop the newest message on topic: %s", message.topic)
+                    return False
+                self._logger.warn("submit: Full queue. Drop the oldest message")
+                queue.popleft()
+                queue.append(task)
+                return False
+            queue.append(task)
+            self._cvs[index].notify()
+        return True
+
+    def start(self):
+        # Each start gets its own queues, so that workers left over from a previous start
+        # drain only what was queued before the stop
+        if self._is_running:
+            return
+        self._queues = [deque() for i in range(self._worker_count)]
+        self._cvs = [Condition() for i in range(self._worker_count)]
+        self._generation += 1
+        self._is_running = True
+        for index in range(self._worker_count):
+            worker = Thread(target=self._work, args=(self._queues[index], self._cvs[index], self._generation))
+            worker.daemon = True
+            worker.start()
+        self._logger.debug("Message callback executor started with %d workers", self._worker_count)
+
+    def stop(self):
+        # Workers exit once their queued tasks are done
+        if not self._is_running:
+            return
+        self._is_running = False
+        for cv in self._cvs:
+            with cv:
+                cv.notify()
+        self._logger.debug("Message callback executor stopped")
+
+    def get_stats(self):
+        return {
+            "queue_sizes": [len(queue) for queue in self._queues],
+            "dropped_messages": sum(self._dropped_counts)
+        }
+
+    def _work(self, queue, cv, generation):
+        while True:
+            with cv:
+                while self._is_running and generation == self._generation and not queue:
+                    cv.wait()
+                if not queue:
+                    break
+                task = queue.popleft()
+            try:
+                task()
+            except Exception:
+                self._logger.exception("Message callback raised an exception")
 
 
 class OfflineRequestsManager(object):
 
     _logger = logging.getLogger(__name__)
 
-    def __init__(self, max_size, drop_behavior):
-        self._queue = OfflineRequestQueue(max_size, drop_behavior)
+    def __init__(self, max_size, drop_behavior, max_bytes=-1, message_store=None):
+        self._queue = OfflineRequestQueue(max_size, drop_behavior, max_bytes, self._on_drop)
+        # Publishes made while draining, with the weighted lane policy. They interleave with the
+        # backlog, live_weight of them per backlog request
+        self._live_queue = OfflineRequestQueue(max_size, drop_behavior, max_bytes, self._on_drop)
+        self._lane_policy = LanePolicyTypes.BACKLOG_FIRST
+        self._live_weight = 1
+        self._live_credit = 1
+        # Queued publish requests are persisted here until they are sent
+        self._message_store = message_store
+        # While pipelining, requests are sent right behind CONNECT instead of being queued. QoS0
+        # publishes sent that way are kept until CONNACK, to be queued again if it is refused
+        self._pipeline_lock = Lock()
+        self._is_pipelining = False
+        self._pipelined_requests = list()
+
+    def update_message_store(self, message_store):
+        self._message_store = message_store
+
+    def update_conflation(self, topic_filters, keeps_position=True):
+        # A publish on a topic matching one of topic_filters replaces the queued publish on the same
+        # topic, if any. Exact topics are looked up in a set, only wildcard filters are matched one by one
+        exact_topics = set()
+        wildcard_filters = list()
+        for topic_filter in topic_filters:
+            if "+" in topic_filter or "#" in topic_filter:
+                wildcard_filters.append(topic_filter)
+            else:
+                exact_topics.add(topic_filter)
+        key_function = None
+        if exact_topics or wildcard_filters:
+            def key_function(request):
+                if RequestTypes.PUBLISH != request.type:
+                    return None
+                topic = request.data[0]
+                if topic in exact_topics or any(topic_matches_sub(topic_filter, topic) for topic_filter in wildcard_filters):
+                    return topic
+                return None
+        self._queue.set_conflation(key_function, keeps_position)
+        self._live_queue.set_conflation(key_function, keeps_position)
+
+    def update_lane_policy(self, lane_policy, live_weight):
+        self._lane_policy = lane_policy
+        self._live_weight = live_weight
+        self._live_credit = live_weight
 
     def has_more(self):
-        return len(self._queue) > 0
-
-    def add_one(self, request):
+        return len(self._queue) > 0 or len(self._live_queue) > 0
+
+    def add_one(self, request, is_live=False):
+        # is_live: a publish made while resubscribing or draining
+        if self._message_store is not None and RequestTypes.PUBLISH == request.type and request.store_key is None:
+            topic, payload, qos, retain = request.data[:4]  # Stored messages are replayed at normal priority
+            request.store_key = self._message_store.add(topic, payload, qos, retain)
+        if is_live and LanePolicyTypes.WEIGHTED == self._lane_policy:
+            return self._live_queue.append(request)
         return self._queue.append(request)
 
-    def get_next(self):
-        if self.has_more():
-            return self._queue.pop(0)
-        else:
+    def _on_drop(self, request):
+        if self._message_store is not None and request.store_key is not None:
+            self._message_store.remove(request.store_key)
+
+    def _on_expire(self, request):
+        self._logger.debug("Dropped expired offline publish request")
+        self._on_drop(request)
+        if request.expiry_callback:
+            request.expiry_callback()
+
+    def get_size(self):
+        return len(self._queue) + len(self._live_queue)
+
+    def pop_stored_requests(self):
+        # Empty the queues and return the requests persisted in the message store, in queue order
+        stored_requests = list()
+        for queue in (self._queue, self._live_queue):
+            while queue:
+                request = queue.popleft()
+                if request.store_key is not None:
+                    stored_requests.append(request)
+        return stored_requests
+
+    def open_pipeline(self):
+        with self._pipeline_lock:
+            self._is_pipelining = True
+
+    def is_pipelining(self):
+        # Queued requests go first, so that pipelined ones do not overtake them
+        return self._is_pipelining and not self.has_more()
+
+    def add_pipelined(self, request):
+        with self._pipeline_lock:
+            self._pipelined_requests.append(request)
+
+    def close_pipeline(self, is_accepted):
+        # Return the number of pipelined requests queued again, None if the pipeline was not open
+        with self._pipeline_lock:
+            was_pipelining = self._is_pipelining
+            self._is_pipelining = False
+            pipelined_requests = self._pipelined_requests
+            self._pipelined_requests = list()
+        if not was_pipelining:
             return None
+        if is_accepted:
+            return 0
+        for request in pipelined_requests:
+            self.add_one(request)
+        return len(pipelined_requests)
+
+    def get_next(self):
+        # Expired requests are dropped here, as they come up, rather than by scanning the queues
+        request = self._get_next()
+        while request is not None and request.expiry_time is not None and monotonicTime() >= request.expiry_time:
+            self._on_expire(request)
+            request = self._get_next()
+        return request
+
+    def _get_next(self):
+        if self._live_queue and (not self._queue or self._live_credit > 0):
+            self._live_credit -= 1
+            return self._live_queue.popleft()
+        if self._queue:
+            self._live_credit = self._live_weight
+            return self._queue.popleft()
+        return None
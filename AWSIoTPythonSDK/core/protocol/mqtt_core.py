@@ -21,13 +21,16 @@ from AWSIoTPythonSDK.core.protocol.internal.workers import EventProducer
 from AWSIoTPythonSDK.core.protocol.internal.workers import EventConsumer
 from AWSIoTPythonSDK.core.protocol.internal.workers import SubscriptionManager
 from AWSIoTPythonSDK.core.protocol.internal.workers import OfflineRequestsManager
+from AWSIoTPythonSDK.core.protocol.internal.workers import MessageCallbackExecutor
 from AWSIoTPythonSDK.core.protocol.internal.requests import RequestTypes
 from AWSIoTPythonSDK.core.protocol.internal.requests import QueueableRequest
+from AWSIoTPythonSDK.core.protocol.internal.requests import get_payload_size
 from AWSIoTPythonSDK.core.protocol.internal.defaults import DEFAULT_CONNECT_DISCONNECT_TIMEOUT_SEC
 from AWSIoTPythonSDK.core.protocol.internal.defaults import DEFAULT_OPERATION_TIMEOUT_SEC
 from AWSIoTPythonSDK.core.protocol.internal.defaults import METRICS_PREFIX
 from AWSIoTPythonSDK.core.protocol.internal.events import FixedEventMids
 from AWSIoTPythonSDK.core.protocol.paho.client import MQTT_ERR_SUCCESS
+from AWSIoTPythonSDK.core.protocol.connection.cores import monotonicTime
 from AWSIoTPythonSDK.exception.AWSIoTExceptions import connectError
 from AWSIoTPythonSDK.exception.AWSIoTExceptions import connectTimeoutException
 from AWSIoTPythonSDK.exception.AWSIoTExceptions import disconnectError
@@ -46,15 +49,17 @@ from AWSIoTPythonSDK.exception.AWSIoTExceptions import unsubscribeError
 from AWSIoTPythonSDK.exception.AWSIoTExceptions import unsubscribeTimeoutException
 from AWSIoTPythonSDK.core.protocol.internal.queues import AppendResults
 from AWSIoTPythonSDK.core.util.enums import DropBehaviorTypes
+from AWSIoTPythonSDK.core.util.enums import LanePolicyTypes
 from AWSIoTPythonSDK.core.protocol.paho.client import MQTTv31
+from AWSIoTPythonSDK.core.protocol.paho.client import PRIORITY_HIGH
+from AWSIoTPythonSDK.core.protocol.paho.client import PRIORITY_NORMAL
+from AWSIoTPythonSDK.core.protocol.paho.client import PRIORITY_LOW
 from threading import Condition
 from threading import Event
+from threading import Lock
+from collections import deque
 import logging
-import sys
-if sys.version_info[0] < 3:
-    from Queue import Queue
-else:
-    from queue import Queue
+import time
 
 
 class MqttCore(object):
@@ -65,12 +70,12 @@ class MqttCore(object):
         self._username = ""
         self._password = None
         self._enable_metrics_collection = True
-        self._event_queue = Queue()
+        self._event_queue = deque()
         self._event_cv = Condition()
-        self._event_producer = EventProducer(self._event_cv, self._event_queue)
+        self._subscription_manager = SubscriptionManager()
+        self._event_producer = EventProducer(self._event_cv, self._event_queue, self._subscription_manager)
         self._client_status = ClientStatusContainer()
         self._internal_async_client = InternalAsyncMqttClient(client_id, clean_session, protocol, use_wss)
-        self._subscription_manager = SubscriptionManager()
         self._offline_requests_manager = OfflineRequestsManager(-1, DropBehaviorTypes.DROP_NEWEST)  # Infinite queue
         self._event_consumer = EventConsumer(self._event_cv,
                                              self._event_queue,
@@ -80,6 +85,15 @@ class MqttCore(object):
                                              self._client_status)
         self._connect_disconnect_timeout_sec = DEFAULT_CONNECT_DISCONNECT_TIMEOUT_SEC
         self._operation_timeout_sec = DEFAULT_OPERATION_TIMEOUT_SEC
+        self._message_callback_executor = None
+        self._message_store = None
+        self._pipelined_connect = False
+        self._lane_policy = LanePolicyTypes.BACKLOG_FIRST
+        self._live_weight = 1
+        self._conflation_topic_filters = list()
+        self._conflation_keeps_position = True
+        self._expiry_stats_lock = Lock()
+        self._expiry_stats = {"expired_messages": 0, "expired_bytes": 0}
         self._init_offline_request_exceptions()
         self._init_workers()
         self._logger.info("MqttCore initialized")
@@ -105,7 +119,8 @@ class MqttCore(object):
                                                                       self._event_producer.on_publish,
                                                                       self._event_producer.on_subscribe,
                                                                       self._event_producer.on_unsubscribe,
-                                                                      self._event_producer.on_message)
+                                                                      self._event_producer.on_message,
+                                                                      self._event_producer.on_publish_expire)
 
     def _start_workers(self):
         self._event_consumer.start()
@@ -149,6 +164,60 @@ class MqttCore(object):
         self._logger.info("Stable connection time: %f sec" % stable_connection_sec)
         self._internal_async_client.configure_reconnect_back_off(base_reconnect_quiet_sec, max_reconnect_quiet_sec, stable_connection_sec)
 
+    def configure_lane_policy(self, lane_policy, live_weight=1):
+        if lane_policy not in (LanePolicyTypes.BACKLOG_FIRST, LanePolicyTypes.LIVE_FIRST, LanePolicyTypes.WEIGHTED):
+            self._logger.error("Lane policy not supported: %s", lane_policy)
+            raise ValueError("Lane policy not supported.")
+        self._logger.info("Configuring lane policy: %d, live weight: %d", lane_policy, live_weight)
+        self._lane_policy = lane_policy
+        self._live_weight = live_weight
+        self._offline_requests_manager.update_lane_policy(lane_policy, live_weight)
+
+    def configure_pipelined_connect(self, enabled):
+        self._logger.info("Configuring pipelined connect: %s", enabled)
+        self._pipelined_connect = enabled
+
+    def configure_message_store(self, message_store):
+        # Publish requests still in the store, from before a restart, are queued up again to be sent
+        # in their original order once connected
+        self._logger.info("Configuring message store: %s", type(message_store).__name__)
+        self._message_store = message_store
+        self._internal_async_client.configure_message_store(message_store)
+        self._offline_requests_manager.update_message_store(message_store)
+        stored_messages = message_store.load()
+        for store_key, data in stored_messages:
+            offline_request = QueueableRequest(RequestTypes.PUBLISH, data + (PRIORITY_NORMAL,))
+            offline_request.store_key = store_key
+            self._offline_requests_manager.add_one(offline_request)
+        self._logger.info("Queued %d stored publish requests", len(stored_messages))
+
+    def configure_zero_copy_payload(self, enabled):
+        self._logger.info("Configuring zero-copy message payloads: %s", enabled)
+        self._internal_async_client.configure_zero_copy_payload(enabled)
+
+    def configure_max_inflight_messages(self, max_inflight_messages):
+        self._logger.info("Configuring max in-flight messages: %d", max_inflight_messages)
+        self._internal_async_client.configure_max_inflight_messages(max_inflight_messages)
+
+    def configure_adaptive_inflight(self, enabled, min_inflight_messages=1, max_inflight_messages=100):
+        self._logger.info("Configuring adaptive in-flight window: %s, %d to %d messages",
+                          enabled, min_inflight_messages, max_inflight_messages)
+        self._internal_async_client.configure_adaptive_inflight(enabled, min_inflight_messages, max_inflight_messages)
+
+    def get_event_dispatch_stats(self):
+        return self._event_consumer.get_stats()
+
+    def get_inflight_window_stats(self):
+        return self._internal_async_client.get_inflight_window_stats()
+
+    def configure_retransmission_timeout(self, initial_timeout_sec, min_timeout_sec, max_timeout_sec):
+        self._logger.info("Configuring retransmission timeout: initial %f sec, bounds %f to %f sec",
+                          initial_timeout_sec, min_timeout_sec, max_timeout_sec)
+        self._internal_async_client.configure_retransmission_timeout(initial_timeout_sec, min_timeout_sec, max_timeout_sec)
+
+    def get_retransmission_stats(self):
+        return self._internal_async_client.get_retransmission_stats()
+
     def configure_last_will(self, topic, payload, qos, retain=False):
         self._logger.info("Configuring last will...")
         self._internal_async_client.configure_last_will(topic, payload, qos, retain)
@@ -168,15 +237,71 @@ class MqttCore(object):
     def disable_metrics_collection(self):
         self._enable_metrics_collection = False
 
-    def configure_offline_requests_queue(self, max_size, drop_behavior):
-        self._logger.info("Configuring offline requests queueing: max queue size: %d", max_size)
-        self._offline_requests_manager = OfflineRequestsManager(max_size, drop_behavior)
+    def configure_offline_requests_queue(self, max_size, drop_behavior, max_bytes=-1):
+        self._logger.info("Configuring offline requests queueing: max queue size: %d, max queue bytes: %d",
+                          max_size, max_bytes)
+        # Persisted requests, like the ones queued up again from the message store, move to the new queue.
+        # Those that do not fit are dropped, and removed from the store
+        stored_requests = self._offline_requests_manager.pop_stored_requests()
+        self._offline_requests_manager = OfflineRequestsManager(max_size, drop_behavior, max_bytes, self._message_store)
+        self._offline_requests_manager.update_lane_policy(self._lane_policy, self._live_weight)
+        self._offline_requests_manager.update_conflation(self._conflation_topic_filters, self._conflation_keeps_position)
+        for stored_request in stored_requests:
+            self._offline_requests_manager.add_one(stored_request)
+        if stored_requests:
+            self._logger.info("Moved %d stored publish requests to the new offline requests queue", len(stored_requests))
         self._event_consumer.update_offline_requests_manager(self._offline_requests_manager)
 
+    def configure_offline_publish_conflation(self, topic_filters, keeps_position=True):
+        self._logger.info("Configuring offline publish conflation: topic filters: %s, keeping position: %s",
+                          topic_filters, keeps_position)
+        self._conflation_topic_filters = list(topic_filters)
+        self._conflation_keeps_position = keeps_position
+        self._offline_requests_manager.update_conflation(self._conflation_topic_filters, keeps_position)
+
+    def configure_message_callback_executor(self, worker_count, max_queue_size=-1,
+                                            drop_behavior=DropBehaviorTypes.DROP_NEWEST, key_function=None):
+        if self._message_callback_executor is not None:
+            self._message_callback_executor.stop()
+            self._message_callback_executor = None
+        if worker_count > 0:
+            self._logger.info("Configuring message callback executor: %d workers, max queue size: %d",
+                              worker_count, max_queue_size)
+            self._message_callback_executor = MessageCallbackExecutor(worker_count, max_queue_size, drop_behavior, key_function)
+        else:
+            self._logger.info("Configuring message callbacks to run on the event consuming thread")
+        self._event_consumer.update_message_callback_executor(self._message_callback_executor)
+
+    def get_inline_dispatch_stats(self):
+        return self._event_producer.get_inline_stats()
+
+    def get_message_callback_executor_stats(self):
+        if self._message_callback_executor is None:
+            return None
+        return self._message_callback_executor.get_stats()
+
     def configure_draining_interval_sec(self, draining_interval_sec):
         self._logger.info("Configuring offline requests queue draining interval: %f sec", draining_interval_sec)
         self._event_consumer.update_draining_interval_sec(draining_interval_sec)
 
+    def configure_draining_burst(self, burst, follow_acks=False):
+        self._logger.info("Configuring offline requests queue draining burst: %d, following acks: %s", burst, follow_acks)
+        self._event_consumer.update_draining_burst(burst, follow_acks)
+
+    def configure_max_topics_per_subscribe(self, max_topics_per_subscribe):
+        self._logger.info("Configuring max topics per resubscribe packet: %d", max_topics_per_subscribe)
+        self._event_consumer.update_max_topics_per_subscribe(max_topics_per_subscribe)
+
+    def get_resubscribe_stats(self):
+        return self._event_consumer.get_resubscribe_stats()
+
+    def get_draining_stats(self):
+        return self._event_consumer.get_draining_stats()
+
+    def get_expiry_stats(self):
+        with self._expiry_stats_lock:
+            return dict(self._expiry_stats)
+
     def connect(self, keep_alive_sec):
         self._logger.info("Performing sync connect...")
         event = Event()
@@ -193,12 +318,34 @@ class MqttCore(object):
         self._load_callbacks()
         self._load_username_password()
         self._client_status.set_status(ClientStatus.CONNECT)
+        self._offline_requests_manager.close_pipeline(False)
+        self._subscription_manager.clear_pipelined()
         rc = self._internal_async_client.connect(keep_alive_sec, ack_callback)
         if MQTT_ERR_SUCCESS != rc:
             self._logger.error("Connect error: %d", rc)
             raise connectError(rc)
+        if self._pipelined_connect:
+            # CONNECT is on its way, requests can follow right behind it
+            self._offline_requests_manager.open_pipeline()
         return FixedEventMids.CONNACK_MID
 
+    def _can_send_now(self, is_publish=False):
+        status = self._client_status.get_status()
+        return ClientStatus.STABLE == status or \
+            self._is_sending_behind_connect(status) or \
+            (is_publish and LanePolicyTypes.LIVE_FIRST == self._lane_policy and self._is_recovering())
+
+    def _is_recovering(self):
+        # Connected, resubscribing or draining the offline requests queue
+        status = self._client_status.get_status()
+        return ClientStatus.RESUBSCRIBE == status or ClientStatus.DRAINING == status
+
+    def _is_sending_behind_connect(self, status=None):
+        # CONNECT is sent and not yet acked, and requests are pipelined right behind it
+        if status is None:
+            status = self._client_status.get_status()
+        return ClientStatus.CONNECT == status and self._offline_requests_manager.is_pipelining()
+
     def _load_callbacks(self):
         self._logger.debug("Passing in general notification callbacks to internal client...")
         self._internal_async_client.on_online = self.on_online
@@ -231,50 +378,110 @@ class MqttCore(object):
         if MQTT_ERR_SUCCESS != rc:
             self._logger.error("Disconnect error: %d", rc)
             raise disconnectError(rc)
+        if self._message_store is not None:
+            self._message_store.sync()
         return FixedEventMids.DISCONNECT_MID
 
-    def publish(self, topic, payload, qos, retain=False):
+    def publish(self, topic, payload, qos, retain=False, priority=PRIORITY_NORMAL, ttl_sec=None, deadline=None,
+                expiry_callback=None):
         self._logger.info("Performing sync publish...")
+        self._check_publish_priority(priority)
+        expiry_time = self._get_expiry_time(ttl_sec, deadline)
         ret = False
-        if ClientStatus.STABLE != self._client_status.get_status():
-            self._handle_offline_request(RequestTypes.PUBLISH, (topic, payload, qos, retain))
+        if not self._can_send_now(is_publish=True):
+            self._handle_offline_request(RequestTypes.PUBLISH, (topic, payload, qos, retain, priority), expiry_time,
+                                         self._create_expiry_callback(topic, payload, expiry_time, expiry_callback))
         else:
             if qos > 0:
                 event = Event()
-                rc, mid = self._publish_async(topic, payload, qos, retain, self._create_blocking_ack_callback(event))
+                expired_event = Event()
+                # An expired publish is never acked, stop waiting on expiry as well
+                blocking_expiry_callback = None
+                if expiry_time is not None:
+                    blocking_expiry_callback = self._create_blocking_expiry_callback(
+                        self._create_expiry_callback(topic, payload, expiry_time, expiry_callback), event, expired_event)
+                rc, mid = self._publish_async(topic, payload, qos, retain, self._create_blocking_ack_callback(event),
+                                              priority, expiry_time, blocking_expiry_callback)
                 if not event.wait(self._operation_timeout_sec):
                     self._internal_async_client.remove_event_callback(mid)
                     self._logger.error("Publish timed out")
                     raise publishTimeoutException()
+                if expired_event.is_set():
+                    self._logger.warn("Publish expired before being acked")
+                    return False
             else:
-                self._publish_async(topic, payload, qos, retain)
+                self._publish_async(topic, payload, qos, retain, priority=priority, expiry_time=expiry_time,
+                                    expiry_callback=self._create_expiry_callback(topic, payload, expiry_time, expiry_callback))
             ret = True
         return ret
 
-    def publish_async(self, topic, payload, qos, retain=False, ack_callback=None):
+    def publish_async(self, topic, payload, qos, retain=False, ack_callback=None, priority=PRIORITY_NORMAL, ttl_sec=None,
+                      deadline=None, expiry_callback=None):
         self._logger.info("Performing async publish...")
-        if ClientStatus.STABLE != self._client_status.get_status():
-            self._handle_offline_request(RequestTypes.PUBLISH, (topic, payload, qos, retain))
+        self._check_publish_priority(priority)
+        expiry_time = self._get_expiry_time(ttl_sec, deadline)
+        expiry_callback = self._create_expiry_callback(topic, payload, expiry_time, expiry_callback)
+        if not self._can_send_now(is_publish=True):
+            self._handle_offline_request(RequestTypes.PUBLISH, (topic, payload, qos, retain, priority), expiry_time,
+                                         expiry_callback)
             return FixedEventMids.QUEUED_MID
         else:
-            rc, mid = self._publish_async(topic, payload, qos, retain, ack_callback)
+            rc, mid = self._publish_async(topic, payload, qos, retain, ack_callback, priority, expiry_time, expiry_callback)
             return mid
 
-    def _publish_async(self, topic, payload, qos, retain=False, ack_callback=None):
-        rc, mid = self._internal_async_client.publish(topic, payload, qos, retain, ack_callback)
+    def _get_expiry_time(self, ttl_sec, deadline):
+        # Both a time to live and a wall clock deadline become an expiry time on the monotonic clock,
+        # the earlier one if both are given
+        expiry_times = list()
+        now = monotonicTime()
+        if ttl_sec is not None:
+            expiry_times.append(now + ttl_sec)
+        if deadline is not None:
+            expiry_times.append(now + deadline - time.time())
+        return min(expiry_times) if expiry_times else None
+
+    def _create_expiry_callback(self, topic, payload, expiry_time, expiry_callback):
+        if expiry_time is None:
+            return None
+        payload_size = get_payload_size(payload)
+        def on_expire():
+            self._logger.info("Publish request on topic %s expired before being sent", topic)
+            with self._expiry_stats_lock:
+                self._expiry_stats["expired_messages"] += 1
+                self._expiry_stats["expired_bytes"] += payload_size
+            if expiry_callback:
+                expiry_callback(topic, payload)
+        return on_expire
+
+    def _check_publish_priority(self, priority):
+        if priority not in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+            self._logger.error("Publish priority not supported: %s", priority)
+            raise ValueError("Publish priority not supported.")
+
+    def _publish_async(self, topic, payload, qos, retain=False, ack_callback=None, priority=PRIORITY_NORMAL,
+                       expiry_time=None, expiry_callback=None):
+        rc, mid = self._internal_async_client.publish(topic, payload, qos, retain, ack_callback, priority=priority,
+                                                      expiry_time=expiry_time, expiry_callback=expiry_callback)
         if MQTT_ERR_SUCCESS != rc:
             self._logger.error("Publish error: %d", rc)
             raise publishError(rc)
+        if qos == 0 and self._is_sending_behind_connect():
+            # Kept until CONNACK, in case the connection is refused
+            pipelined_request = QueueableRequest(RequestTypes.PUBLISH, (topic, payload, qos, retain, priority))
+            pipelined_request.expiry_time = expiry_time
+            pipelined_request.expiry_callback = expiry_callback
+            self._offline_requests_manager.add_pipelined(pipelined_request)
         return rc, mid
 
-    def subscribe(self, topic, qos, message_callback=None):
+    def subscribe(self, topic, qos, message_callback=None, inline_budget_sec=None):
         self._logger.info("Performing sync subscribe...")
         ret = False
-        if ClientStatus.STABLE != self._client_status.get_status():
-            self._handle_offline_request(RequestTypes.SUBSCRIBE, (topic, qos, message_callback))
+        if not self._can_send_now():
+            self._handle_offline_request(RequestTypes.SUBSCRIBE, (topic, qos, message_callback, inline_budget_sec))
         else:
             event = Event()
-            rc, mid = self._subscribe_async(topic, qos, self._create_blocking_ack_callback(event), message_callback)
+            rc, mid = self._subscribe_async(topic, qos, self._create_blocking_ack_callback(event),
+                                            message_callback, inline_budget_sec)
             if not event.wait(self._operation_timeout_sec):
                 self._internal_async_client.remove_event_callback(mid)
                 self._logger.error("Subscribe timed out")
@@ -282,17 +489,20 @@ class MqttCore(object):
             ret = True
         return ret
 
-    def subscribe_async(self, topic, qos, ack_callback=None, message_callback=None):
+    def subscribe_async(self, topic, qos, ack_callback=None, message_callback=None, inline_budget_sec=None):
         self._logger.info("Performing async subscribe...")
-        if ClientStatus.STABLE != self._client_status.get_status():
-            self._handle_offline_request(RequestTypes.SUBSCRIBE, (topic, qos, message_callback))
+        if not self._can_send_now():
+            self._handle_offline_request(RequestTypes.SUBSCRIBE, (topic, qos, message_callback, inline_budget_sec))
             return FixedEventMids.QUEUED_MID
         else:
-            rc, mid = self._subscribe_async(topic, qos, ack_callback, message_callback)
+            rc, mid = self._subscribe_async(topic, qos, ack_callback, message_callback, inline_budget_sec)
             return mid
 
-    def _subscribe_async(self, topic, qos, ack_callback=None, message_callback=None):
-        self._subscription_manager.add_record(topic, qos, message_callback)
+    def _subscribe_async(self, topic, qos, ack_callback=None, message_callback=None, inline_budget_sec=None):
+        self._subscription_manager.add_record(topic, qos, message_callback, inline_budget_sec)
+        if self._is_sending_behind_connect():
+            self._subscription_manager.mark_pipelined(topic)
+        ack_callback = self._subscription_manager.create_confirming_ack_callback(topic, ack_callback)
         rc, mid = self._internal_async_client.subscribe(topic, qos, ack_callback)
         if MQTT_ERR_SUCCESS != rc:
             self._logger.error("Subscribe error: %d", rc)
@@ -302,7 +512,7 @@ class MqttCore(object):
     def unsubscribe(self, topic):
         self._logger.info("Performing sync unsubscribe...")
         ret = False
-        if ClientStatus.STABLE != self._client_status.get_status():
+        if not self._can_send_now():
             self._handle_offline_request(RequestTypes.UNSUBSCRIBE, topic)
         else:
             event = Event()
@@ -316,7 +526,7 @@ class MqttCore(object):
 
     def unsubscribe_async(self, topic, ack_callback=None):
         self._logger.info("Performing async unsubscribe...")
-        if ClientStatus.STABLE != self._client_status.get_status():
+        if not self._can_send_now():
             self._handle_offline_request(RequestTypes.UNSUBSCRIBE, topic)
             return FixedEventMids.QUEUED_MID
         else:
@@ -336,10 +546,20 @@ class MqttCore(object):
             event.set()
         return ack_callback
 
-    def _handle_offline_request(self, type, data):
+    def _create_blocking_expiry_callback(self, expiry_callback, event, expired_event):
+        def blocking_expiry_callback():
+            expiry_callback()
+            expired_event.set()
+            event.set()
+        return blocking_expiry_callback
+
+    def _handle_offline_request(self, type, data, expiry_time=None, expiry_callback=None):
         self._logger.info("Offline request detected!")
         offline_request = QueueableRequest(type, data)
-        append_result = self._offline_requests_manager.add_one(offline_request)
+        offline_request.expiry_time = expiry_time
+        offline_request.expiry_callback = expiry_callback
+        is_live = RequestTypes.PUBLISH == type and self._is_recovering()
+        append_result = self._offline_requests_manager.add_one(offline_request, is_live)
         if AppendResults.APPEND_FAILURE_QUEUE_DISABLED == append_result:
             self._logger.error("Offline request queue has been disabled")
             raise self._offline_request_queue_disabled_exceptions[type]
@@ -17,6 +17,7 @@ This is an MQTT v3.1 client module. MQTT is a lightweight pub/sub messaging
 protocol that is easy to implement and suitable for low powered devices.
 """
 import errno
+import os
 import platform
 import random
 import select
@@ -34,6 +35,14 @@ import struct
 import sys
 import threading
 import time
+from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
+try:
+    import selectors
+    HAVE_SELECTORS = True
+except ImportError:
+    HAVE_SELECTORS = False
 HAVE_DNS = True
 try:
     import dns.resolver
@@ -45,7 +54,14 @@ if platform.system() == 'Windows':
 else:
     EAGAIN = errno.EAGAIN
 
+# Scatter/gather send of plain socket writes, not available on Windows or Python 2
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
 from AWSIoTPythonSDK.core.protocol.connection.cores import ProgressiveBackOffCore
+from AWSIoTPythonSDK.core.protocol.connection.cores import AdaptiveInflightWindowCore
+from AWSIoTPythonSDK.core.protocol.connection.cores import RetransmissionTimeoutCore
+from AWSIoTPythonSDK.core.protocol.connection.cores import TimerSchedulerCore
+from AWSIoTPythonSDK.core.protocol.connection.cores import monotonicTime as time_func
 from AWSIoTPythonSDK.core.protocol.connection.cores import SecuredWebSocketCore
 
 VERSION_MAJOR=1
@@ -136,11 +152,63 @@ MQTT_ERR_ERRNO = 14
 MSG_QUEUEING_DROP_OLDEST = 0
 MSG_QUEUEING_DROP_NEWEST = 1
 
+# Maximum number of bytes pulled from the socket per read
+READ_BUFFER_SIZE = 65536
+# Default maximum number of queued packet bytes gathered into one write
+WRITE_BATCH_SIZE = 65536
+# sendmsg() rejects more buffers than the platform IOV_MAX with EMSGSIZE
+try:
+    WRITE_BATCH_PACKETS = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    WRITE_BATCH_PACKETS = 1024
+if WRITE_BATCH_PACKETS <= 0:
+    WRITE_BATCH_PACKETS = 1024
+# Outgoing packet priorities, highest first. Queued packets are written in
+# priority order at packet boundaries, so that acknowledgements and other
+# control packets do not wait behind queued PUBLISH data.
+PRIORITY_CONTROL = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+# Maximum number of topics whose encoded PUBLISH topic field is cached
+PUBLISH_TOPIC_CACHE_SIZE = 256
+# Maximum number of received topics whose matching topic specific callbacks are cached
+MESSAGE_FILTER_CACHE_SIZE = 4096
+
+_struct_uint16 = struct.Struct("!H")
+# Single byte remaining lengths, 0 to 127
+_remaining_length_table = [struct.pack("!B", length) for length in range(128)]
+
+# Selector events
+if HAVE_SELECTORS:
+    EVENT_READ = selectors.EVENT_READ
+    EVENT_WRITE = selectors.EVENT_WRITE
+else:
+    EVENT_READ = (1 << 0)
+    EVENT_WRITE = (1 << 1)
+
 if sys.version_info[0] < 3:
     sockpair_data = "0"
 else:
     sockpair_data = b"0"
 
+def _encode_remaining_length(remaining_length):
+    """Return the MQTT variable length encoding of remaining_length."""
+    if remaining_length < 128:
+        return _remaining_length_table[remaining_length]
+    encoded = bytearray()
+    while True:
+        byte = remaining_length % 128
+        remaining_length = remaining_length // 128
+        # If there are more digits to encode, set the top bit of this digit
+        if remaining_length > 0:
+            byte = byte | 0x80
+        encoded.append(byte)
+        if remaining_length == 0:
+            # FIXME - this doesn't deal with incorrectly large payloads
+            return bytes(encoded)
+
+
 def error_string(mqtt_errno):
     """Return the error string associated with an mqtt error number."""
     if mqtt_errno == MQTT_ERR_SUCCESS:
@@ -260,6 +328,169 @@ def topic_matches_sub(sub, topic):
     return result
 
 
+class _TopicTrieNode(object):
+    __slots__ = ("children", "sub")
+
+    def __init__(self):
+        self.children = {}  # topic level, '+' or '#' -> _TopicTrieNode
+        self.sub = None  # Subscription that ends at this node
+
+
+class TopicFilterIndex(object):
+    """Set of subscriptions that returns those matching a topic in
+    O(topic depth) rather than O(subscriptions), in the order they were added.
+
+    Subscriptions without wildcards are matched with a dict lookup, those
+    whose wildcards take up whole levels with a trie of topic levels, and any
+    other with topic_matches_sub(). Not thread safe."""
+
+    def __init__(self):
+        self._sequences = {}  # Subscription -> order it was added in
+        self._next_sequence = 0
+        self._exact_subs = set()
+        self._wildcard_root = _TopicTrieNode()
+        self._irregular_subs = set()
+
+    def __contains__(self, sub):
+        return sub in self._sequences
+
+    def __len__(self):
+        return len(self._sequences)
+
+    def add(self, sub):
+        if sub in self._sequences:
+            return
+        self._sequences[sub] = self._next_sequence
+        self._next_sequence += 1
+        if '+' not in sub and '#' not in sub:
+            self._exact_subs.add(sub)
+            return
+        levels = sub.split('/')
+        if not self._is_regular(levels):
+            self._irregular_subs.add(sub)
+            return
+        node = self._wildcard_root
+        for level in levels:
+            child = node.children.get(level)
+            if child is None:
+                child = _TopicTrieNode()
+                node.children[level] = child
+            node = child
+        node.sub = sub
+
+    def remove(self, sub):
+        if self._sequences.pop(sub, None) is None:
+            return
+        if sub in self._exact_subs:
+            self._exact_subs.discard(sub)
+            return
+        if sub in self._irregular_subs:
+            self._irregular_subs.discard(sub)
+            return
+        path = [self._wildcard_root]
+        levels = sub.split('/')
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].sub = None
+        # Prune the nodes that no longer lead to a subscription
+        for depth in range(len(levels), 0, -1):
+            node = path[depth]
+            if node.sub is not None or node.children:
+                break
+            del path[depth-1].children[levels[depth-1]]
+
+    def match(self, topic):
+        """Return the subscriptions matching topic, in the order they were
+        added."""
+        matched = []
+        if topic in self._exact_subs:
+            matched.append(topic)
+        if self._wildcard_root.children:
+            self._match_wildcards(self._wildcard_root, topic.split('/'), 0, matched)
+        for sub in self._irregular_subs:
+            if topic_matches_sub(sub, topic):
+                matched.append(sub)
+        if len(matched) > 1:
+            matched.sort(key=self._sequences.get)
+        return matched
+
+    def _is_regular(self, levels):
+        # '+' and '#' must take up a whole level, and '#' must be the last one
+        for i, level in enumerate(levels):
+            if level == '#':
+                if i != len(levels)-1:
+                    return False
+            elif level != '+' and ('+' in level or '#' in level):
+                return False
+        return True
+
+    def _match_wildcards(self, node, levels, index, matched):
+        if index == len(levels):
+            if node.sub is not None:
+                matched.append(node.sub)
+            multi_level_node = node.children.get('#')  # foo/# also matches foo
+            if multi_level_node is not None and multi_level_node.sub is not None:
+                matched.append(multi_level_node.sub)
+            return
+        level = levels[index]
+        # Wildcards at the first level do not match topics starting with $
+        if index > 0 or not level.startswith('$'):
+            multi_level_node = node.children.get('#')
+            if multi_level_node is not None and multi_level_node.sub is not None:
+                matched.append(multi_level_node.sub)
+            single_level_node = node.children.get('+')
+            if single_level_node is not None:
+                self._match_wildcards(single_level_node, levels, index+1, matched)
+        child = node.children.get(level)
+        if child is not None:
+            self._match_wildcards(child, levels, index+1, matched)
+
+
+_SelectorKey = namedtuple("_SelectorKey", ["fileobj", "events", "data"])
+
+
+class _SelectSelectorCompat(object):
+    """select() based stand-in for selectors.DefaultSelector where the
+    selectors module is not available (Python 2). Only the calls used by the
+    network loop are provided."""
+
+    def __init__(self):
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        if fileobj is None:
+            raise ValueError("Invalid file object: None")
+        if fileobj in self._keys:
+            raise KeyError("%r is already registered" % (fileobj,))
+        key = _SelectorKey(fileobj, events, data)
+        self._keys[fileobj] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self._keys.pop(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        key = _SelectorKey(self._keys[fileobj].fileobj, events, data)
+        self._keys[fileobj] = key
+        return key
+
+    def select(self, timeout=None):
+        rlist = [key.fileobj for key in self._keys.values() if key.events & EVENT_READ]
+        wlist = [key.fileobj for key in self._keys.values() if key.events & EVENT_WRITE]
+        if timeout is not None and timeout < 0:
+            timeout = 0
+        readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        ready = {}
+        for fileobj in readable:
+            ready[fileobj] = EVENT_READ
+        for fileobj in writable:
+            ready[fileobj] = ready.get(fileobj, 0) | EVENT_WRITE
+        return [(self._keys[fileobj], events) for fileobj, events in ready.items()]
+
+    def close(self):
+        self._keys.clear()
+
+
 def _socketpair_compat():
     """TCP/IP socketpair including Windows support"""
     listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_IP)
@@ -281,7 +512,7 @@ def _socketpair_compat():
     return (sock1, sock2)
 
 
-class MQTTMessage:
+class MQTTMessage(object):
     """ This is a class that describes an incoming message. It is passed to the
     on_message callback as the message parameter.
 
@@ -292,7 +523,15 @@ class MQTTMessage:
     qos : Integer. The message Quality of Service 0, 1 or 2.
     retain : Boolean. If true, the message is a retained message and not fresh.
     mid : Integer. The message id.
+    priority : Integer. Write priority of an outgoing message, PRIORITY_HIGH,
+    PRIORITY_NORMAL or PRIORITY_LOW.
+    expiry_time : Float or None. Time, on the time_func() clock, after which an
+    outgoing message is dropped instead of being sent or resent.
     """
+    # No per-instance __dict__, many messages may be held while in flight
+    __slots__ = ("timestamp", "state", "dup", "mid", "topic", "payload", "qos", "retain", "priority",
+                 "expiry_time", "_retry_timer", "_retry_count")
+
     def __init__(self):
         self.timestamp = 0
         self.state = mqtt_ms_invalid
@@ -302,6 +541,83 @@ class MQTTMessage:
         self.payload = None
         self.qos = 0
         self.retain = False
+        self.priority = PRIORITY_NORMAL
+        self.expiry_time = None
+        self._retry_timer = None
+        self._retry_count = 0
+
+
+class _OutPacket(object):
+    """Outgoing packet waiting in the write queue."""
+    __slots__ = ("command", "mid", "qos", "priority", "pos", "to_process", "packet")
+
+    def __init__(self, command, mid, qos, packet, priority):
+        self.command = command
+        self.mid = mid
+        self.qos = qos
+        self.priority = priority
+        self.pos = 0
+        self.to_process = len(packet)
+        self.packet = packet
+
+
+class _OutPacketQueue(object):
+    """Write queue with one FIFO lane per packet priority."""
+    __slots__ = ("_lanes", "_length")
+
+    def __init__(self):
+        self._lanes = tuple(deque() for i in range(PRIORITY_LOW + 1))
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    __nonzero__ = __bool__
+
+    def append(self, packet):
+        self._lanes[packet.priority].append(packet)
+        self._length = self._length + 1
+
+    def appendleft(self, packet):
+        self._lanes[packet.priority].appendleft(packet)
+        self._length = self._length + 1
+
+    def peek(self):
+        """Return the first packet of the highest priority non-empty lane."""
+        for lane in self._lanes:
+            if lane:
+                return lane[0]
+        return None
+
+    def popleft(self):
+        for lane in self._lanes:
+            if lane:
+                self._length = self._length - 1
+                return lane.popleft()
+        raise IndexError('pop from an empty queue')
+
+    def has_priority_above(self, priority):
+        """Return True if a packet of a higher priority than the given one is queued."""
+        for lane in self._lanes[:priority]:
+            if lane:
+                return True
+        return False
+
+
+class _InPacket(object):
+    """Parse state of the incoming packet being handled, reused for every packet."""
+    __slots__ = ("command", "remaining_length", "packet")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.command = 0
+        self.remaining_length = 0
+        self.packet = b""
 
 
 class Client(object):
@@ -435,9 +751,24 @@ class Client(object):
         self._userdata = userdata
         self._sock = None
         self._sockpairR, self._sockpairW = _socketpair_compat()
+        # Registrations persist across loop iterations. The broker socket is
+        # registered on first use and unregistered when it is closed, and write
+        # interest is only changed when the outgoing queue empties or fills.
+        if HAVE_SELECTORS:
+            self._selector = selectors.DefaultSelector()
+        else:
+            self._selector = _SelectSelectorCompat()
+        self._selector.register(self._sockpairR, EVENT_READ)
+        self._selector_sock = None
+        self._selector_events = 0
+        # Coalesce wakeups of the network loop, guarded by _out_packet_mutex
+        self._loop_waiting = False
+        self._wakeup_pending = False
         self._keepalive = 60
         self._message_retry = 20
-        self._last_retry_check = 0
+        # Retry timeouts follow the ack RTT, starting from _message_retry
+        self._retransmission_timeout = RetransmissionTimeoutCore(self._message_retry)
+        self._retransmit_count = 0
         self._clean_session = clean_session
         if client_id == "" or client_id is None:
             self._client_id = "paho/" + "".join(random.choice("0123456789ADCDEF") for x in range(23-5))
@@ -446,26 +777,33 @@ class Client(object):
 
         self._username = ""
         self._password = ""
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
-        self._out_packet = []
-        self._current_out_packet = None
-        self._last_msg_in = time.time()
-        self._last_msg_out = time.time()
+        self._in_packet = _InPacket()
+        self._in_buffer = bytearray()
+        self._out_packet = _OutPacketQueue()
+        self._current_out_batch = []
+        self._max_write_batch_size = WRITE_BATCH_SIZE
+        self._publish_topic_cache = {}
+        self._zero_copy_payload = False
+        self._last_msg_in = time_func()
+        self._last_msg_out = time_func()
         self._ping_t = 0
         self._last_mid = 0
         self._state = mqtt_cs_new
         self._max_inflight_messages = 20
-        self._out_messages = []
-        self._in_messages = []
+        self._fixed_inflight_messages = 20
+        self._inflight_window = None
+        # Set on a connection loss, where _out_message_mutex may already be
+        # held, and applied to the window with the mutex held later
+        self._inflight_window_loss_pending = False
+        # Messages are keyed by mid, in the order they were published/received.
+        # Outgoing messages waiting for room in the inflight window are also
+        # kept, in order, in _out_message_queue.
+        self._out_messages = OrderedDict()
+        self._out_message_queue = deque()
+        self._in_messages = OrderedDict()
         self._inflight_messages = 0
+        # Outgoing messages dropped on expiry, waiting for on_publish_expire
+        self._expired_messages = []
         self._will = False
         self._will_topic = ""
         self._will_payload = None
@@ -474,8 +812,15 @@ class Client(object):
         self.on_disconnect = None
         self.on_connect = None
         self.on_publish = None
+        self.on_publish_expire = None
         self.on_message = None
         self.on_message_filtered = []
+        # Index of the on_message_filtered subscriptions, and their callbacks
+        self._message_filters = TopicFilterIndex()
+        self._message_filter_callbacks = {}
+        # LRU of received topic -> matching topic specific callbacks, cleared
+        # whenever they change
+        self._message_filter_cache = OrderedDict()
         self.on_subscribe = None
         self.on_unsubscribe = None
         self.on_log = None
@@ -487,7 +832,7 @@ class Client(object):
         self._callback_mutex = threading.Lock()
         self._state_mutex = threading.Lock()
         self._out_packet_mutex = threading.Lock()
-        self._current_out_packet_mutex = threading.Lock()
+        self._current_out_batch_mutex = threading.Lock()
         self._msgtime_mutex = threading.Lock()
         self._out_message_mutex = threading.Lock()
         self._in_message_mutex = threading.Lock()
@@ -502,7 +847,12 @@ class Client(object):
         self._tls_version = tls_version
         self._tls_insecure = False
         self._useSecuredWebsocket = useSecuredWebsocket  # Do we enable secured websocket
-        self._backoffCore = ProgressiveBackOffCore()  # Init the backoffCore using default configuration
+        # Owns keepalive, message retry, back off and stable connection deadlines.
+        # Timers run on the network loop thread.
+        self._scheduler = TimerSchedulerCore()
+        self._keepalive_timer = None
+        self._backoff_pending = False
+        self._backoffCore = ProgressiveBackOffCore(srcTimerScheduler=self._scheduler)  # Init the backoffCore using default configuration
         self._AWSAccessKeyIDCustomConfig = ""
         self._AWSSecretAccessKeyCustomConfig = ""
         self._AWSSessionTokenCustomConfig = ""
@@ -533,13 +883,8 @@ class Client(object):
         self._AWSSessionTokenCustomConfig = srcAWSSessionToken
 
     def reinitialise(self, client_id="", clean_session=True, userdata=None):
-        if self._ssl:
-            self._ssl.close()
-            self._ssl = None
-            self._sock = None
-        elif self._sock:
-            self._sock.close()
-            self._sock = None
+        self._sock_close()
+        self._selector.close()
         if self._sockpairR:
             self._sockpairR.close()
             self._sockpairR = None
@@ -731,44 +1076,38 @@ class Client(object):
         if self._port <= 0:
             raise ValueError('Invalid port number.')
 
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+        self._in_packet.reset()
+        self._in_buffer = bytearray()
 
         self._out_packet_mutex.acquire()
-        self._out_packet = []
+        self._out_packet = _OutPacketQueue()
         self._out_packet_mutex.release()
 
-        self._current_out_packet_mutex.acquire()
-        self._current_out_packet = None
-        self._current_out_packet_mutex.release()
+        self._current_out_batch_mutex.acquire()
+        self._current_out_batch = []
+        self._current_out_batch_mutex.release()
 
         self._msgtime_mutex.acquire()
-        self._last_msg_in = time.time()
-        self._last_msg_out = time.time()
+        self._last_msg_in = time_func()
+        self._last_msg_out = time_func()
         self._msgtime_mutex.release()
 
         self._ping_t = 0
         self._state_mutex.acquire()
         self._state = mqtt_cs_new
         self._state_mutex.release()
-        if self._ssl:
-            self._ssl.close()
-            self._ssl = None
-            self._sock = None
-        elif self._sock:
-            self._sock.close()
-            self._sock = None
+        self._sock_close()
 
         # Put messages in progress in a valid state.
         self._messages_reconnect_reset()
 
+        # The new connection may take a different path to the broker
+        self._out_message_mutex.acquire()
+        self._retransmission_timeout.reset()
+        if self._inflight_window is not None:
+            self._inflight_window.resetRtt()
+        self._out_message_mutex.release()
+
         try:
             if (sys.version_info[0] == 2 and sys.version_info[1] < 7) or (sys.version_info[0] == 3 and sys.version_info[1] < 2):
                 sock = socket.create_connection((self._host, self._port))
@@ -811,6 +1150,11 @@ class Client(object):
         else:
             pass  # For MQTT over WebSocket
 
+        self._scheduler.cancel(self._keepalive_timer)
+        self._keepalive_timer = None
+        if self._keepalive > 0:
+            self._keepalive_timer = self._scheduler.schedule(self._keepalive, self._check_keepalive)
+
         return self._send_connect(self._keepalive, self._clean_session)
 
     def loop(self, timeout=1.0, max_packets=1):
@@ -826,67 +1170,83 @@ class Client(object):
         messages with QoS>0.
 
         timeout: The time in seconds to wait for incoming/outgoing network
-          traffic before timing out and returning.
+          traffic before timing out and returning. The wait is cut short when
+          a timer (keepalive, message retry, ...) falls due. None waits until
+          there is network traffic or a timer falls due.
         max_packets: Not currently used.
 
         Returns MQTT_ERR_SUCCESS on success.
         Returns >0 on error.
 
         A ValueError will be raised if timeout < 0"""
-        if timeout < 0.0:
+        if timeout is not None and timeout < 0.0:
             raise ValueError('Invalid timeout.')
 
-        self._current_out_packet_mutex.acquire()
-        self._out_packet_mutex.acquire()
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
-
-        if self._current_out_packet:
-            wlist = [self.socket()]
-        else:
-            wlist = []
-        self._out_packet_mutex.release()
-        self._current_out_packet_mutex.release()
+        next_timeout = self._scheduler.getNextTimeoutSecond()
+        if next_timeout is not None and (timeout is None or next_timeout < timeout):
+            timeout = next_timeout
 
-        # sockpairR is used to break out of select() before the timeout, on a
-        # call to publish() etc.
-        rlist = [self.socket(), self._sockpairR]
+        sock = self.socket()
+        self._out_packet_mutex.acquire()
         try:
-            socklist = select.select(rlist, wlist, [], timeout)
-        except TypeError as e:
+            if self.want_write():
+                self._selector_set(sock, EVENT_READ | EVENT_WRITE)
+            else:
+                self._selector_set(sock, EVENT_READ)
+        except (TypeError, ValueError, KeyError, EnvironmentError):
             # Socket isn't correct type, in likelihood connection is lost
+            self._out_packet_mutex.release()
             return MQTT_ERR_CONN_LOST
-        except ValueError:
-            # Can occur if we just reconnected but rlist/wlist contain a -1 for
-            # some reason.
-            return MQTT_ERR_CONN_LOST
+        # Anything queued from now on wakes us up through sockpairR
+        self._loop_waiting = True
+        self._out_packet_mutex.release()
+
+        rc = MQTT_ERR_SUCCESS
+        try:
+            events = self._selector.select(timeout)
+        except (TypeError, ValueError):
+            # Can occur if the socket was closed under us
+            rc = MQTT_ERR_CONN_LOST
         except:
-            return MQTT_ERR_UNKNOWN
+            rc = MQTT_ERR_UNKNOWN
+
+        self._out_packet_mutex.acquire()
+        self._loop_waiting = False
+        self._out_packet_mutex.release()
+        if rc != MQTT_ERR_SUCCESS:
+            return rc
 
-        if self.socket() in socklist[0]:
+        readable = False
+        writable = False
+        for key, mask in events:
+            if key.fileobj is self._sockpairR:
+                # Clear sockpairR, then stimulate output write even though we
+                # didn't ask for it, because at that point the publish or other
+                # command wasn't present.
+                self._out_packet_mutex.acquire()
+                self._wakeup_pending = False
+                self._out_packet_mutex.release()
+                self._wakeup_clear()
+                writable = True
+            elif key.fileobj is sock:
+                if mask & EVENT_READ:
+                    readable = True
+                if mask & EVENT_WRITE:
+                    writable = True
+
+        if readable:
             rc = self.loop_read(max_packets)
             if rc or (self._ssl is None and self._sock is None):
                 return rc
 
-        if self._sockpairR in socklist[0]:
-            # Stimulate output write even though we didn't ask for it, because
-            # at that point the publish or other command wasn't present.
-            socklist[1].insert(0, self.socket())
-            # Clear sockpairR - only ever a single byte written.
-            try:
-                self._sockpairR.recv(1)
-            except socket.error as err:
-                if err.errno != EAGAIN:
-                    raise
-
-        if self.socket() in socklist[1]:
+        if writable and self.want_write():
             rc = self.loop_write(max_packets)
             if rc or (self._ssl is None and self._sock is None):
                 return rc
 
         return self.loop_misc()
 
-    def publish(self, topic, payload=None, qos=0, retain=False):
+    def publish(self, topic, payload=None, qos=0, retain=False, priority=PRIORITY_NORMAL, expiry_time=None):
         """Publish a message on a topic.
 
         This causes a message to be sent to the broker and subsequently from
@@ -901,6 +1261,13 @@ class Client(object):
         qos: The quality of service level to use.
         retain: If set to true, the message will be set as the "last known
         good"/retained message for the topic.
+        priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW. Queued
+        packets are written highest priority first, after any queued control
+        packets. Messages of the same priority are written in publish order.
+        expiry_time: Time, on the time_func() clock, after which a QoS>0 message
+        that is still waiting to be sent, for a connection or for room in the
+        inflight window, or waiting to be resent, is dropped instead. Dropped
+        messages are reported to on_publish_expire(). None for no expiry.
 
         Returns a tuple (result, mid), where result is MQTT_ERR_SUCCESS to
         indicate success or MQTT_ERR_NO_CONN if the client is not currently
@@ -909,12 +1276,15 @@ class Client(object):
         mid argument in the on_publish() callback if it is defined.
 
         A ValueError will be raised if topic is None, has zero length or is
-        invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
-        the length of the payload is greater than 268435455 bytes."""
+        invalid (contains a wildcard), if qos is not one of 0, 1 or 2, if
+        priority is not a publish priority, or if the length of the payload is
+        greater than 268435455 bytes."""
         if topic is None or len(topic) == 0:
             raise ValueError('Invalid topic.')
         if qos<0 or qos>2:
             raise ValueError('Invalid QoS level.')
+        if priority not in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+            raise ValueError('Invalid publish priority.')
         if isinstance(payload, str) or isinstance(payload, bytearray):
             local_payload = payload
         elif sys.version_info[0] < 3 and isinstance(payload, unicode):
@@ -935,11 +1305,11 @@ class Client(object):
         local_mid = self._mid_generate()
 
         if qos == 0:
-            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False)
+            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False, priority)
             return (rc, local_mid)
         else:
             message = MQTTMessage()
-            message.timestamp = time.time()
+            message.timestamp = time_func()
 
             message.mid = local_mid
             message.topic = topic
@@ -951,28 +1321,33 @@ class Client(object):
             message.qos = qos
             message.retain = retain
             message.dup = False
+            message.priority = priority
+            message.expiry_time = expiry_time
 
-            self._out_message_mutex.acquire()                
-            self._out_messages.append(message)
+            self._out_message_mutex.acquire()
+            self._out_messages[message.mid] = message
             if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                 self._inflight_messages = self._inflight_messages+1
                 if qos == 1:
                     message.state = mqtt_ms_wait_for_puback
                 elif qos == 2:
                     message.state = mqtt_ms_wait_for_pubrec
+                self._message_retry_arm(message, self._out_messages, self._out_message_mutex)
                 self._out_message_mutex.release()
                     
-                rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup)
+                rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup, message.priority)
 
                 # remove from inflight messages so it will be send after a connection is made
                 if rc is MQTT_ERR_NO_CONN:
                     with self._out_message_mutex:
                         self._inflight_messages -= 1
                         message.state = mqtt_ms_publish
+                        self._message_retry_cancel(message)
                         
                 return (rc, local_mid)
             else:
-                message.state = mqtt_ms_queued;
+                message.state = mqtt_ms_queued
+                self._out_message_queue.append(message)
                 self._out_message_mutex.release()
                 return (MQTT_ERR_SUCCESS, local_mid)
 
@@ -997,6 +1372,7 @@ class Client(object):
         self._backoffCore.stopStableConnectionTimer()
 
         if self._sock is None and self._ssl is None:
+            self._wakeup()  # Cut short a reconnect back off wait
             return MQTT_ERR_NO_CONN
 
         return self._send_disconnect()
@@ -1127,13 +1503,18 @@ class Client(object):
         if max_packets < 1:
             max_packets = 1
 
-        for i in range(0, max_packets):
+        packets = 0
+        while True:
             rc = self._packet_read()
             if rc > 0:
                 return self._loop_rc_handle(rc)
             elif rc == MQTT_ERR_AGAIN:
                 return MQTT_ERR_SUCCESS
-        return MQTT_ERR_SUCCESS
+            packets = packets + 1
+            # Data already decrypted by SSL is not reported by select(), so
+            # it is read now rather than waiting for the next timer
+            if packets >= max_packets and not self._ssl_pending():
+                return MQTT_ERR_SUCCESS
 
     def loop_write(self, max_packets=1):
         """Process read network events. Use in place of calling loop() if you
@@ -1165,7 +1546,7 @@ class Client(object):
         """Call to determine if there is network data waiting to be written.
         Useful if you are calling select() yourself rather than using loop().
         """
-        if self._current_out_packet or len(self._out_packet) > 0:
+        if self._current_out_batch or len(self._out_packet) > 0:
             return True
         else:
             return False
@@ -1178,51 +1559,110 @@ class Client(object):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        now = time.time()
-        self._check_keepalive()
-        if self._last_retry_check+1 < now:
-            # Only check once a second at most
-            self._message_retry_check()
-            self._last_retry_check = now
-
-        if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
-            # client->ping_t != 0 means we are waiting for a pingresp.
-            # This hasn't happened in the keepalive time so we should disconnect.
-            if self._ssl:
-                self._ssl.close()
-                self._ssl = None
-            elif self._sock:
-                self._sock.close()
-                self._sock = None
+        # Keepalive, message retry and stable connection timers
+        self._scheduler.runDue()
 
-            self._callback_mutex.acquire()
-            if self._state == mqtt_cs_disconnecting:
-                rc = MQTT_ERR_SUCCESS
-            else:
-                rc = 1
-            if self.on_disconnect:
-                self._in_callback = True
-                self.on_disconnect(self, self._userdata, rc)
-                self._in_callback = False
-            self._callback_mutex.release()
+        if self._sock is None and self._ssl is None:
+            # A keepalive timer has closed the connection
             return MQTT_ERR_CONN_LOST
 
         return MQTT_ERR_SUCCESS
 
     def max_inflight_messages_set(self, inflight):
         """Set the maximum number of messages with QoS>0 that can be part way
-        through their network flow at once. Defaults to 20."""
+        through their network flow at once. Defaults to 20. Not used while the
+        adaptive in-flight window is enabled."""
         if inflight < 0:
             raise ValueError('Invalid inflight.')
-        self._max_inflight_messages = inflight
+        self._out_message_mutex.acquire()
+        self._fixed_inflight_messages = inflight
+        if self._inflight_window is None:
+            self._max_inflight_messages = inflight
+        self._out_message_mutex.release()
+
+    def adaptive_inflight_set(self, enabled, min_inflight=1, max_inflight=100):
+        """Enable or disable the adaptive in-flight window for messages with
+        QoS>0. While enabled, the number of messages that can be part way
+        through their network flow at once starts from the fixed limit (clamped
+        to min_inflight..max_inflight). It grows by one per window of acks
+        while the PUBACK/PUBREC round trip time stays close to the lowest seen,
+        and is halved on retry timeouts and connection drops.
+        Disabling it restores the limit set with max_inflight_messages_set()."""
+        if enabled and (min_inflight < 1 or max_inflight < min_inflight):
+            raise ValueError('Invalid inflight.')
+        self._out_message_mutex.acquire()
+        if enabled:
+            self._inflight_window = AdaptiveInflightWindowCore(min_inflight, max_inflight, self._fixed_inflight_messages or max_inflight)
+            self._max_inflight_messages = self._inflight_window.getWindow()
+        else:
+            self._inflight_window = None
+            self._max_inflight_messages = self._fixed_inflight_messages
+        self._out_message_mutex.release()
+
+    def inflight_window_stats(self):
+        """Return a dict with the current in-flight window ('window'), the
+        number of messages in flight ('inflight') and, while the adaptive
+        window is enabled, the smoothed and minimum round trip times in seconds
+        ('smoothed_rtt_sec', 'min_rtt_sec'; None until the first sample)."""
+        self._out_message_mutex.acquire()
+        stats = {
+            "window": self._max_inflight_messages,
+            "inflight": self._inflight_messages,
+            "smoothed_rtt_sec": None,
+            "min_rtt_sec": None}
+        if self._inflight_window is not None:
+            stats["smoothed_rtt_sec"] = self._inflight_window.getSmoothedRttSecond()
+            stats["min_rtt_sec"] = self._inflight_window.getMinimumRttSecond()
+        self._out_message_mutex.release()
+        return stats
+
+    def write_batch_size_set(self, batch_size):
+        """Set the maximum number of bytes of queued packets that are gathered
+        into a single socket write. A packet larger than this is still written
+        on its own. 65536 bytes by default."""
+        if batch_size < 1:
+            raise ValueError('Invalid batch size.')
+        self._max_write_batch_size = batch_size
+
+    def zero_copy_payload_set(self, enabled):
+        """Deliver the payload of received messages as a read-only memoryview
+        over the received packet instead of a bytes copy. Call
+        message.payload.tobytes() where bytes are needed, and copy the payload
+        to keep it beyond the callback cheaply. Disabled by default."""
+        self._zero_copy_payload = bool(enabled)
 
     def message_retry_set(self, retry):
-        """Set the timeout in seconds before a message with QoS>0 is retried.
+        """Set the timeout in seconds before a message with QoS>0 is retried,
+        until the round trip time of acks on the connection has been measured.
+        Then the timeout is derived from the smoothed RTT and RTT variance, as
+        TCP does. Each retry of a message doubles its timeout. The timeout is
+        never below the minimum set by message_retry_bounds_set().
         20 seconds by default."""
         if retry < 0:
             raise ValueError('Invalid retry.')
 
         self._message_retry = retry
+        self._retransmission_timeout.configInitialTimeout(retry)
+
+    def message_retry_bounds_set(self, min_retry, max_retry):
+        """Set the bounds in seconds of the retry timeout derived from the
+        round trip time, and the cap of the per message backoff.
+        1 and 120 seconds by default."""
+        if min_retry < 0 or max_retry < min_retry:
+            raise ValueError('Invalid retry.')
+
+        self._retransmission_timeout.configBounds(min_retry, max_retry)
+
+    def retransmission_stats(self):
+        """Return a dict with the number of retries of messages with QoS>0 sent
+        so far ('retransmissions'), the current retry timeout in seconds
+        ('retry_timeout_sec') and the smoothed RTT and RTT variance in seconds
+        ('smoothed_rtt_sec', 'rtt_variance_sec'; None until measured)."""
+        return {
+            "retransmissions": self._retransmit_count,
+            "retry_timeout_sec": self._retransmission_timeout.getTimeoutSecond(),
+            "smoothed_rtt_sec": self._retransmission_timeout.getSmoothedRttSecond(),
+            "rtt_variance_sec": self._retransmission_timeout.getRttVarianceSecond()}
 
     def user_data_set(self, userdata):
         """Set the user data variable passed to callbacks. May be any data type."""
@@ -1313,8 +1753,7 @@ class Client(object):
                     if not retry_first_connection:
                         raise
                     self._easy_log(MQTT_LOG_DEBUG, "Connection failed, retrying")
-                    self._backoffCore.backOff()
-                    # time.sleep(1)
+                    self._backoff_wait()
             else:
                 break
 
@@ -1325,10 +1764,10 @@ class Client(object):
                 # We don't need to worry about locking here, because we've
                 # either called loop_forever() when in single threaded mode, or
                 # in multi threaded mode when loop_stop() has been called and
-                # so no other threads can access _current_out_packet,
+                # so no other threads can access _current_out_batch,
                 # _out_packet or _messages.
                 if (self._thread_terminate is True
-                        and self._current_out_packet is None
+                        and not self._current_out_batch
                         and len(self._out_packet) == 0
                         and len(self._out_messages) == 0):
 
@@ -1341,8 +1780,7 @@ class Client(object):
                 self._state_mutex.release()
             else:
                 self._state_mutex.release()
-                self._backoffCore.backOff()
-                # time.sleep(1)
+                self._backoff_wait()
 
                 self._state_mutex.acquire()
                 if self._state == mqtt_cs_disconnecting or run is False or self._thread_terminate is True:
@@ -1381,6 +1819,7 @@ class Client(object):
             return MQTT_ERR_INVAL
 
         self._thread_terminate = True
+        self._wakeup()
         self._thread.join()
         self._thread = None
 
@@ -1402,10 +1841,12 @@ class Client(object):
         for i in range(0, len(self.on_message_filtered)):
             if self.on_message_filtered[i][0] == sub:
                 self.on_message_filtered[i] = (sub, callback)
+                self._message_filters_update()
                 self._callback_mutex.release()
                 return
 
         self.on_message_filtered.append((sub, callback))
+        self._message_filters_update()
         self._callback_mutex.release()
 
     def message_callback_remove(self, sub):
@@ -1418,6 +1859,7 @@ class Client(object):
         for i in range(0, len(self.on_message_filtered)):
             if self.on_message_filtered[i][0] == sub:
                 self.on_message_filtered.pop(i)
+                self._message_filters_update()
                 self._callback_mutex.release()
                 return
         self._callback_mutex.release()
@@ -1428,17 +1870,15 @@ class Client(object):
 
     def _loop_rc_handle(self, rc):
         if rc:
-            if self._ssl:
-                self._ssl.close()
-                self._ssl = None
-            elif self._sock:
-                self._sock.close()
-                self._sock = None
+            self._sock_close()
 
             self._state_mutex.acquire()
             if self._state == mqtt_cs_disconnecting:
                 rc = MQTT_ERR_SUCCESS
             self._state_mutex.release()
+            if rc:
+                # Dropped by the broker, possibly for being throttled
+                self._inflight_window_loss_pending = True
             self._callback_mutex.acquire()
             if self.on_disconnect:
                 self._in_callback = True
@@ -1449,125 +1889,102 @@ class Client(object):
         return rc
 
     def _packet_read(self):
-        # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
-            try:
-                if self._ssl:
-                    command = self._ssl.read(1)
-                else:
-                    command = self._sock.recv(1)
-            except socket.error as err:
-                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                    return MQTT_ERR_AGAIN
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
+        # This gets called if select() indicates that there is network data
+        # available - ie. at least one byte. Rather than reading the command,
+        # remaining length and payload of a single packet with separate reads,
+        # pull as much as is available (up to READ_BUFFER_SIZE) into the
+        # receive buffer in one call and then frame and handle every complete
+        # packet in it. A trailing partial packet is kept in the buffer and
+        # completed by the next read.
+        try:
+            if self._ssl:
+                data = self._ssl.read(READ_BUFFER_SIZE)
             else:
-                if len(command) == 0:
-                    return 1
-                command = struct.unpack("!B", command)
-                self._in_packet['command'] = command[0]
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
-            # Algorithm for decoding taken from pseudo code at
+                data = self._sock.recv(READ_BUFFER_SIZE)
+        except socket.error as err:
+            if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
+                return MQTT_ERR_AGAIN
+            if err.errno == EAGAIN:
+                return MQTT_ERR_AGAIN
+            print(err)
+            return 1
+        if len(data) == 0:
+            return 1
+        self._in_buffer.extend(data)
+        return self._packet_read_buffered()
+
+    def _packet_read_buffered(self):
+        # Frame and handle all complete packets in the receive buffer.
+        buf = self._in_buffer
+        buf_len = len(buf)
+        pos = 0
+        rc = MQTT_ERR_SUCCESS
+        while buf_len - pos >= 2:
+            # Decode the remaining length. Algorithm for decoding taken from pseudo code at
             # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
-            while True:
-                try:
-                    if self._ssl:
-                        byte = self._ssl.read(1)
-                    else:
-                        byte = self._sock.recv(1)
-                except socket.error as err:
-                    if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                        return MQTT_ERR_AGAIN
-                    if err.errno == EAGAIN:
-                        return MQTT_ERR_AGAIN
-                    print(err)
-                    return 1
-                else:
-                    byte = struct.unpack("!B", byte)
-                    byte = byte[0]
-                    self._in_packet['remaining_count'].append(byte)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                     # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] = self._in_packet['remaining_length'] + (byte & 127)*self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
-
+            remaining_length = 0
+            remaining_mult = 1
+            header_end = pos + 1
+            complete = False
+            while header_end < buf_len:
+                byte = buf[header_end]
+                header_end += 1
+                remaining_length += (byte & 127) * remaining_mult
+                remaining_mult *= 128
                 if (byte & 128) == 0:
+                    complete = True
                     break
+                # Max 4 bytes length for remaining length as defined by protocol.
+                # Anything more likely means a broken/malicious client.
+                if header_end - pos > 4:
+                    return MQTT_ERR_PROTOCOL
+            if not complete or header_end + remaining_length > buf_len:
+                break  # Partial packet, wait for more data
+
+            packet_end = header_end + remaining_length
+            self._in_packet.command = buf[pos]
+            self._in_packet.remaining_length = remaining_length
+            self._in_packet.packet = memoryview(buf)[header_end:packet_end].tobytes()
+            pos = packet_end
+
+            rc = self._packet_handle()
+
+            self._msgtime_mutex.acquire()
+            self._last_msg_in = time_func()
+            self._msgtime_mutex.release()
+
+            # A handler may have reconnected (e.g. protocol downgrade), which
+            # replaces the receive buffer.
+            if rc != MQTT_ERR_SUCCESS or self._in_buffer is not buf:
+                break
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
-
-        while self._in_packet['to_process'] > 0:
-            try:
-                if self._ssl:
-                    data = self._ssl.read(self._in_packet['to_process'])
-                else:
-                    data = self._sock.recv(self._in_packet['to_process'])
-            except socket.error as err:
-                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                    return MQTT_ERR_AGAIN
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-            else:
-                self._in_packet['to_process'] = self._in_packet['to_process'] - len(data)
-                self._in_packet['packet'] = self._in_packet['packet'] + data
-
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
-        rc = self._packet_handle()
-
-        # Free data and reset values
-        self._in_packet = dict(
-            command=0,
-            have_remaining=0,
-            remaining_count=[],
-            remaining_mult=1,
-            remaining_length=0,
-            packet=b"",
-            to_process=0,
-            pos=0)
-
-        self._msgtime_mutex.acquire()
-        self._last_msg_in = time.time()
-        self._msgtime_mutex.release()
+        # Free handled data, keeping any partial packet for the next read
+        if pos > 0 and self._in_buffer is buf:
+            del buf[:pos]
         return rc
 
     def _packet_write(self):
-        self._current_out_packet_mutex.acquire()
-        while self._current_out_packet:
-            packet = self._current_out_packet
+        # Queued packets are gathered into a batch of up to _max_write_batch_size
+        # bytes and written with a single sendmsg() for plain sockets, or as one
+        # joined buffer for SSL/WebSocket. The batch is kept until it has been
+        # completely written so that a retried SSL write sees the same data.
+        self._current_out_batch_mutex.acquire()
+        while True:
+            if not self._current_out_batch:
+                self._out_packet_mutex.acquire()
+                self._current_out_batch = self._out_packet_gather()
+                self._out_packet_mutex.release()
+                if not self._current_out_batch:
+                    break
+            batch = self._current_out_batch
 
             try:
-                if self._ssl:
-                    write_length = self._ssl.write(packet['packet'][packet['pos']:])
-                else:
-                    write_length = self._sock.send(packet['packet'][packet['pos']:])
+                write_length = self._packet_write_batch(batch)
             except AttributeError:
-                self._current_out_packet_mutex.release()
+                self._current_out_batch_mutex.release()
                 return MQTT_ERR_SUCCESS
             except socket.error as err:
-                self._current_out_packet_mutex.release()
+                self._current_out_batch_mutex.release()
                 if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                     return MQTT_ERR_AGAIN
                 if err.errno == EAGAIN:
@@ -1576,24 +1993,31 @@ class Client(object):
                 return 1
 
             if write_length > 0:
-                packet['to_process'] = packet['to_process'] - write_length
-                packet['pos'] = packet['pos'] + write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
+                completed = 0
+                for packet in batch:
+                    written = min(write_length, packet.to_process)
+                    packet.to_process = packet.to_process - written
+                    packet.pos = packet.pos + written
+                    write_length = write_length - written
+                    if packet.to_process > 0:
+                        break
+                    completed = completed + 1
+
+                    if (packet.command & 0xF0) == PUBLISH and packet.qos == 0:
                         self._callback_mutex.acquire()
                         if self.on_publish:
                             self._in_callback = True
-                            self.on_publish(self, self._userdata, packet['mid'])
+                            self.on_publish(self, self._userdata, packet.mid)
                             self._in_callback = False
 
                         self._callback_mutex.release()
 
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._current_out_packet_mutex.release()
+                    if (packet.command & 0xF0) == DISCONNECT:
+                        del batch[:completed]
+                        self._current_out_batch_mutex.release()
 
                         self._msgtime_mutex.acquire()
-                        self._last_msg_out = time.time()
+                        self._last_msg_out = time_func()
                         self._msgtime_mutex.release()
 
                         self._callback_mutex.acquire()
@@ -1603,70 +2027,212 @@ class Client(object):
                             self._in_callback = False
                         self._callback_mutex.release()
 
-                        if self._ssl:
-                            self._ssl.close()
-                            self._ssl = None
-                        if self._sock:
-                            self._sock.close()
-                            self._sock = None
+                        self._sock_close()
                         return MQTT_ERR_SUCCESS
 
-                    self._out_packet_mutex.acquire()
-                    if len(self._out_packet) > 0:
-                        self._current_out_packet = self._out_packet.pop(0)
-                    else:
-                        self._current_out_packet = None
-                    self._out_packet_mutex.release()
+                del batch[:completed]
+                if batch and batch[0].pos == 0:
+                    self._out_packet_preempt(batch)
             else:
                 pass  # FIXME
 
-        self._current_out_packet_mutex.release()
+        self._current_out_batch_mutex.release()
 
         self._msgtime_mutex.acquire()
-        self._last_msg_out = time.time()
+        self._last_msg_out = time_func()
         self._msgtime_mutex.release()
         return MQTT_ERR_SUCCESS
 
+    def _out_packet_gather(self):
+        # Take queued packets, highest priority first and oldest first within a
+        # priority, while they fit in the write batch. The first packet is
+        # always taken, however large it is.
+        # Must be called with _out_packet_mutex held.
+        batch = []
+        batch_size = 0
+        while self._out_packet:
+            packet = self._out_packet.peek()
+            if batch and (batch_size + packet.to_process > self._max_write_batch_size
+                          or len(batch) >= WRITE_BATCH_PACKETS):
+                break
+            batch.append(self._out_packet.popleft())
+            batch_size = batch_size + packet.to_process
+        return batch
+
+    def _out_packet_preempt(self, batch):
+        # At a packet boundary, put the unsent rest of the batch back in the
+        # queue if higher priority packets were queued meanwhile, so that they
+        # are gathered first. Not done after a failed write, an SSL write must
+        # be retried with the same data.
+        self._out_packet_mutex.acquire()
+        if self._out_packet.has_priority_above(max(packet.priority for packet in batch)):
+            for packet in reversed(batch):
+                self._out_packet.appendleft(packet)
+            del batch[:]
+        self._out_packet_mutex.release()
+
+    def _packet_write_batch(self, batch):
+        # Write the unsent part of every packet in the batch in one call and
+        # return the number of bytes written.
+        if self._ssl:
+            return self._ssl.write(self._packet_join(batch))
+        elif HAVE_SENDMSG:
+            return self._sock.sendmsg([memoryview(packet.packet)[packet.pos:] for packet in batch])
+        else:
+            return self._sock.send(self._packet_join(batch))
+
+    def _packet_join(self, batch):
+        if len(batch) == 1 and batch[0].pos == 0:
+            return batch[0].packet
+        return bytearray().join([packet.packet[packet.pos:] for packet in batch])
+
     def _easy_log(self, level, buf):
         if self.on_log:
             self.on_log(self, self._userdata, level, buf)
 
     def _check_keepalive(self):
-        now = time.time()
+        # Keepalive timer callback. Sends a PINGREQ when nothing has been sent
+        # or received for the keepalive interval, and drops the connection when
+        # the PINGRESP does not arrive in time. Then re-arms itself for the next
+        # keepalive deadline.
+        self._keepalive_timer = None
+        if self._sock is None and self._ssl is None:
+            return
+
+        now = time_func()
         self._msgtime_mutex.acquire()
         last_msg_out = self._last_msg_out
         last_msg_in = self._last_msg_in
         self._msgtime_mutex.release()
-        if (self._sock is not None or self._ssl is not None) and (now - last_msg_out >= self._keepalive or now - last_msg_in >= self._keepalive):
+        if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
+            # client->ping_t != 0 means we are waiting for a pingresp.
+            # This hasn't happened in the keepalive time so we should disconnect.
+            self._keepalive_disconnect()
+            return
+        if now - last_msg_out >= self._keepalive or now - last_msg_in >= self._keepalive:
             if self._state == mqtt_cs_connected and self._ping_t == 0:
                 self._send_pingreq()
                 self._msgtime_mutex.acquire()
                 self._last_msg_out = now
                 self._last_msg_in = now
                 self._msgtime_mutex.release()
+                last_msg_out = now
+                last_msg_in = now
             else:
-                if self._ssl:
-                    self._ssl.close()
-                    self._ssl = None
-                elif self._sock:
-                    self._sock.close()
-                    self._sock = None
-
-                if self._state == mqtt_cs_disconnecting:
-                    rc = MQTT_ERR_SUCCESS
-                else:
-                    rc = 1
-                self._callback_mutex.acquire()
-                if self.on_disconnect:
-                    self._in_callback = True
-                    self.on_disconnect(self, self._userdata, rc)
-                    self._in_callback = False
-                self._callback_mutex.release()
+                self._keepalive_disconnect()
+                return
+
+        next_check = min(last_msg_out, last_msg_in) + self._keepalive
+        if self._ping_t > 0:
+            next_check = min(next_check, self._ping_t + self._keepalive)
+        self._keepalive_timer = self._scheduler.schedule(max(0.0, next_check - now), self._check_keepalive)
+
+    def _keepalive_disconnect(self):
+        self._sock_close()
+
+        if self._state == mqtt_cs_disconnecting:
+            rc = MQTT_ERR_SUCCESS
+        else:
+            rc = 1
+            self._inflight_window_loss_pending = True
+
+        self._callback_mutex.acquire()
+        if self.on_disconnect:
+            self._in_callback = True
+            self.on_disconnect(self, self._userdata, rc)
+            self._in_callback = False
+        self._callback_mutex.release()
+
+    def _backoff_wait(self):
+        # Wait for the reconnect back off time on the scheduler, running any
+        # other timer that falls due meanwhile. disconnect() and loop_stop()
+        # cut the wait short.
+        self._backoff_pending = True
+        backoff_timer = self._scheduler.schedule(self._backoffCore.nextBackOffTimeSecond(), self._backoff_elapsed)
+        while self._backoff_pending and not self._thread_terminate and self._state != mqtt_cs_disconnecting:
+            try:
+                socklist = select.select([self._sockpairR], [], [], self._scheduler.getNextTimeoutSecond())
+            except (TypeError, ValueError, select.error):
+                socklist = ([], [], [])
+                time.sleep(self._scheduler.getNextTimeoutSecond() or 0)
+            if self._sockpairR in socklist[0]:
+                self._wakeup_clear()
+            self._scheduler.runDue()
+        self._scheduler.cancel(backoff_timer)
+        self._backoff_pending = False
+
+    def _backoff_elapsed(self):
+        self._backoff_pending = False
+
+    def _sock_close(self):
+        # Close the connection to the broker, dropping its selector registration
+        self._out_packet_mutex.acquire()
+        self._selector_unregister()
+        self._out_packet_mutex.release()
+        if self._ssl:
+            self._ssl.close()
+            self._ssl = None
+            self._sock = None
+        elif self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _selector_set(self, sock, events):
+        # Register sock with the selector, or change the events it is watched
+        # for. Must be called with _out_packet_mutex held.
+        if sock is not self._selector_sock:
+            self._selector_unregister()
+            self._selector.register(sock, events)
+            self._selector_sock = sock
+            self._selector_events = events
+        elif events != self._selector_events:
+            self._selector.modify(sock, events)
+            self._selector_events = events
+
+    def _selector_unregister(self):
+        # Must be called with _out_packet_mutex held.
+        if self._selector_sock is not None:
+            try:
+                self._selector.unregister(self._selector_sock)
+            except (KeyError, ValueError, EnvironmentError):
+                pass
+            self._selector_sock = None
+            self._selector_events = 0
+
+    def _wakeup(self):
+        # Write a single byte to sockpairW (connected to sockpairR) to break
+        # out of select() if in threaded mode.
+        try:
+            self._sockpairW.send(sockpair_data)
+        except socket.error as err:
+            if err.errno != EAGAIN:
+                raise
+
+    def _wakeup_clear(self):
+        try:
+            self._sockpairR.recv(READ_BUFFER_SIZE)
+        except socket.error as err:
+            if err.errno != EAGAIN:
+                raise
+
+    def _ssl_pending(self):
+        # Number of bytes already read from the socket and decrypted, but
+        # not yet returned by read()
+        if self._ssl is None:
+            return 0
+        try:
+            return self._ssl.pending()
+        except (AttributeError, socket.error):
+            return 0
 
     def _mid_generate(self):
-        self._last_mid = self._last_mid + 1
-        if self._last_mid == 65536:
-            self._last_mid = 1
+        # Skip mids that still belong to unacknowledged outgoing messages
+        for i in range(65535):
+            self._last_mid = self._last_mid + 1
+            if self._last_mid == 65536:
+                self._last_mid = 1
+            if self._last_mid not in self._out_messages:
+                break
         return self._last_mid
 
     def _topic_wildcard_len_check(self, topic):
@@ -1682,7 +2248,7 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Sending PINGREQ")
         rc = self._send_simple_command(PINGREQ)
         if rc == MQTT_ERR_SUCCESS:
-            self._ping_t = time.time()
+            self._ping_t = time_func()
         return rc
 
     def _send_pingresp(self):
@@ -1698,19 +2264,8 @@ class Client(object):
         return self._send_command_with_mid(PUBCOMP, mid, False)
 
     def _pack_remaining_length(self, packet, remaining_length):
-        remaining_bytes = []
-        while True:
-            byte = remaining_length % 128
-            remaining_length = remaining_length // 128
-            # If there are more digits to encode, set the top bit of this digit
-            if remaining_length > 0:
-                byte = byte | 0x80
-
-            remaining_bytes.append(byte)
-            packet.extend(struct.pack("!B", byte))
-            if remaining_length == 0:
-                # FIXME - this doesn't deal with incorrectly large payloads
-                return packet
+        packet.extend(_encode_remaining_length(remaining_length))
+        return packet
 
     def _pack_str16(self, packet, data):
         if sys.version_info[0] < 3:
@@ -1738,54 +2293,62 @@ class Client(object):
             else:
                 raise TypeError
 
-    def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False):
+    def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False, priority=PRIORITY_NORMAL):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
-        utopic = topic.encode('utf-8')
+        topic_field = self._publish_topic_field(topic)
         command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
-        packet = bytearray()
-        packet.extend(struct.pack("!B", command))
         if payload is None:
-            remaining_length = 2+len(utopic)
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
+            upayload = None
+            payloadlen = 0
+        elif isinstance(payload, bytearray):
+            upayload = payload
+            payloadlen = len(payload)
+        elif isinstance(payload, str) or (sys.version_info[0] < 3 and isinstance(payload, unicode)):
+            upayload = payload.encode('utf-8')
+            payloadlen = len(upayload)
         else:
-            if isinstance(payload, str):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-            elif isinstance(payload, bytearray):
-                payloadlen = len(payload)
-            elif isinstance(payload, unicode):
-                upayload = payload.encode('utf-8')
-                payloadlen = len(upayload)
-
-            remaining_length = 2+len(utopic) + payloadlen
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
+            raise TypeError('payload must be a string, unicode or a bytearray.')
+
+        if self.on_log:
+            if payload is None:
+                self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
+            else:
+                self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
 
+        remaining_length = len(topic_field) + payloadlen
         if qos > 0:
             # For message id
             remaining_length = remaining_length + 2
-
-        self._pack_remaining_length(packet, remaining_length)
-        self._pack_str16(packet, topic)
-
+        remaining_length_field = _encode_remaining_length(remaining_length)
+
+        # Build the packet in place, copying the payload only once
+        packet = bytearray(1 + len(remaining_length_field) + remaining_length)
+        packet[0] = command
+        pos = 1 + len(remaining_length_field)
+        packet[1:pos] = remaining_length_field
+        packet[pos:pos+len(topic_field)] = topic_field
+        pos = pos + len(topic_field)
         if qos > 0:
-            # For message id
-            packet.extend(struct.pack("!H", mid))
-
-        if payload is not None:
-            if isinstance(payload, str):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            elif isinstance(payload, bytearray):
-                packet.extend(payload)
-            elif isinstance(payload, unicode):
-                pack_format = str(payloadlen) + "s"
-                packet.extend(struct.pack(pack_format, upayload))
-            else:
-                raise TypeError('payload must be a string, unicode or a bytearray.')
-
-        return self._packet_queue(PUBLISH, packet, mid, qos)
+            _struct_uint16.pack_into(packet, pos, mid)
+            pos = pos + 2
+        if payloadlen > 0:
+            packet[pos:] = upayload
+
+        return self._packet_queue(PUBLISH, packet, mid, qos, priority)
+
+    def _publish_topic_field(self, topic):
+        # Length prefixed UTF-8 topic of a PUBLISH packet, cached as a small
+        # set of topics is usually published to again and again
+        topic_field = self._publish_topic_cache.get(topic)
+        if topic_field is None:
+            utopic = topic.encode('utf-8')
+            topic_field = _struct_uint16.pack(len(utopic)) + utopic
+            if len(self._publish_topic_cache) >= PUBLISH_TOPIC_CACHE_SIZE:
+                self._publish_topic_cache.clear()
+            self._publish_topic_cache[topic] = topic_field
+        return topic_field
 
     def _send_pubrec(self, mid):
         self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: "+str(mid)+")")
@@ -1896,61 +2459,148 @@ class Client(object):
             self._pack_str16(packet, t)
         return (self._packet_queue(command, packet, local_mid, 1), local_mid)
 
-    def _message_retry_check_actual(self, messages, mutex):
+    def _ack_rtt_sample(self, m, window=True):
+        # Feed the RTT of an acked packet to the retry timeout estimate and, if
+        # window, to the adaptive in-flight window. Packets retransmitted on
+        # this connection are skipped (Karn's rule), their ack can't be matched
+        # to a transmission. Must be called with _out_message_mutex held.
+        self._inflight_window_loss_apply()
+        if m._retry_count > 0:
+            return
+        rtt = time_func() - m.timestamp
+        self._retransmission_timeout.onRttSample(rtt)
+        if window and self._inflight_window is not None:
+            self._inflight_window.onAck(rtt)
+            self._max_inflight_messages = self._inflight_window.getWindow()
+
+    def _inflight_window_loss(self):
+        # Must be called with _out_message_mutex held.
+        if self._inflight_window is not None:
+            self._inflight_window.onLoss()
+            self._max_inflight_messages = self._inflight_window.getWindow()
+
+    def _inflight_window_loss_apply(self):
+        # Apply a connection loss recorded in _inflight_window_loss_pending.
+        # Must be called with _out_message_mutex held.
+        if self._inflight_window_loss_pending:
+            self._inflight_window_loss_pending = False
+            self._inflight_window_loss()
+
+    def _message_retry_arm(self, m, messages, mutex):
+        # (Re)start the retry timer of a message that is waiting for an ack.
+        # Called with mutex held.
+        self._scheduler.cancel(m._retry_timer)
+        timeout = self._retransmission_timeout.getTimeoutSecond(m._retry_count)
+        m._retry_timer = self._scheduler.schedule(timeout, self._message_retry_fire, m, messages, mutex)
+
+    def _message_retry_cancel(self, m):
+        self._scheduler.cancel(m._retry_timer)
+        m._retry_timer = None
+
+    def _message_retry_fire(self, m, messages, mutex):
+        # Retry timer callback, resends the packet the message is waiting on
         mutex.acquire()
-        now = time.time()
-        for m in messages:
-            if m.timestamp + self._message_retry < now:
-                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                elif m.state == mqtt_ms_wait_for_pubrel:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrec(m.mid)
-                elif m.state == mqtt_ms_wait_for_pubcomp:
-                    m.timestamp = now
-                    m.dup = True
-                    self._send_pubrel(m.mid, True)
+        m._retry_timer = None
+        if messages.get(m.mid) is not m or (self._sock is None and self._ssl is None):
+            # Acknowledged meanwhile, or resent on CONNACK after reconnecting
+            mutex.release()
+            return
+        if messages is self._out_messages and self._message_expired(m, time_func()):
+            self._message_expire(m)
+            if self._max_inflight_messages > 0:
+                self._update_inflight()
+            mutex.release()
+            self._messages_expired_notify()
+            return
+        m._retry_count = m._retry_count + 1
+        self._retransmit_count = self._retransmit_count + 1
+        if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+            self._inflight_window_loss()
+            m.timestamp = time_func()
+            m.dup = True
+            self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup, m.priority)
+            self._message_retry_arm(m, messages, mutex)
+        elif m.state == mqtt_ms_wait_for_pubrel:
+            m.timestamp = time_func()
+            m.dup = True
+            self._send_pubrec(m.mid)
+            self._message_retry_arm(m, messages, mutex)
+        elif m.state == mqtt_ms_wait_for_pubcomp:
+            m.timestamp = time_func()
+            m.dup = True
+            self._send_pubrel(m.mid, True)
+            self._message_retry_arm(m, messages, mutex)
         mutex.release()
 
-    def _message_retry_check(self):
-        self._message_retry_check_actual(self._out_messages, self._out_message_mutex)
-        self._message_retry_check_actual(self._in_messages, self._in_message_mutex)
+    def _message_expired(self, m, now):
+        # Only messages the broker may not have yet expire. Those waiting for
+        # PUBREL/PUBCOMP are already delivered.
+        return m.expiry_time is not None and now >= m.expiry_time and m.state in (
+            mqtt_ms_publish, mqtt_ms_queued, mqtt_ms_wait_for_puback, mqtt_ms_wait_for_pubrec)
+
+    def _message_expire(self, m):
+        # Drop an outgoing message instead of (re)sending it. Must be called
+        # with _out_message_mutex held, and followed by
+        # _messages_expired_notify() once it is released.
+        self._message_retry_cancel(m)
+        if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+            self._inflight_messages = self._inflight_messages - 1
+        m.state = mqtt_ms_invalid
+        if self._out_messages.get(m.mid) is m:
+            del self._out_messages[m.mid]
+        self._expired_messages.append(m)
+        self._easy_log(MQTT_LOG_DEBUG, "Dropped expired PUBLISH (Mid: "+str(m.mid)+")")
+
+    def _messages_expired_notify(self):
+        self._out_message_mutex.acquire()
+        expired_messages = self._expired_messages
+        self._expired_messages = []
+        self._out_message_mutex.release()
+        if not expired_messages:
+            return
+        self._callback_mutex.acquire()
+        if self.on_publish_expire:
+            self._in_callback = True
+            for m in expired_messages:
+                self.on_publish_expire(self, self._userdata, m.mid)
+            self._in_callback = False
+        self._callback_mutex.release()
 
     def _messages_reconnect_reset_out(self):
         self._out_message_mutex.acquire()
+        self._inflight_window_loss_apply()
         self._inflight_messages = 0
-        for m in self._out_messages:
+        self._out_message_queue.clear()
+        window = 0
+        for m in self._out_messages.values():
             m.timestamp = 0
-            if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
-                if m.qos == 0:
-                    m.state = mqtt_ms_publish
-                elif m.qos == 1:
-                    #self._inflight_messages = self._inflight_messages + 1
-                    if m.state == mqtt_ms_wait_for_puback:
-                        m.dup = True
-                    m.state = mqtt_ms_publish
-                elif m.qos == 2:
-                    #self._inflight_messages = self._inflight_messages + 1
-                    if m.state == mqtt_ms_wait_for_pubcomp:
-                        m.state = mqtt_ms_resend_pubrel
-                        m.dup = True
-                    else:
-                        if m.state == mqtt_ms_wait_for_pubrec:
-                            m.dup = True
-                        m.state = mqtt_ms_publish
+            m._retry_count = 0
+            self._message_retry_cancel(m)
+            if m.qos == 2 and (m.state == mqtt_ms_wait_for_pubcomp or m.state == mqtt_ms_resend_pubrel):
+                # The broker already has this message, only the release is outstanding
+                m.state = mqtt_ms_resend_pubrel
+                m.dup = True
+                window = window + 1
             else:
-                m.state = mqtt_ms_queued
+                if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+                    m.dup = True
+                if self._max_inflight_messages == 0 or window < self._max_inflight_messages:
+                    # Counted into _inflight_messages again as it is resent on CONNACK
+                    m.state = mqtt_ms_publish
+                    window = window + 1
+                else:
+                    m.state = mqtt_ms_queued
+                    self._out_message_queue.append(m)
         self._out_message_mutex.release()
 
     def _messages_reconnect_reset_in(self):
         self._in_message_mutex.acquire()
-        for m in self._in_messages:
+        for mid, m in list(self._in_messages.items()):
             m.timestamp = 0
+            m._retry_count = 0
+            self._message_retry_cancel(m)
             if m.qos != 2:
-                self._in_messages.pop(self._in_messages.index(m))
+                del self._in_messages[mid]
             else:
                 # Preserve current state
                 pass
@@ -1960,30 +2610,23 @@ class Client(object):
         self._messages_reconnect_reset_out()
         self._messages_reconnect_reset_in()
 
-    def _packet_queue(self, command, packet, mid, qos):
-        mpkt = dict(
-            command = command,
-            mid = mid,
-            qos = qos,
-            pos = 0,
-            to_process = len(packet),
-            packet = packet)
+    def _packet_queue(self, command, packet, mid, qos, priority=PRIORITY_CONTROL):
+        if command == DISCONNECT:
+            # After everything queued before it
+            priority = PRIORITY_LOW
+        mpkt = _OutPacket(command, mid, qos, packet, priority)
 
         self._out_packet_mutex.acquire()
         self._out_packet.append(mpkt)
-        if self._current_out_packet_mutex.acquire(False):
-            if self._current_out_packet is None and len(self._out_packet) > 0:
-                self._current_out_packet = self._out_packet.pop(0)
-            self._current_out_packet_mutex.release()
+        # Only wake the network loop if it is blocked in select() and has not
+        # been woken up already
+        wakeup = self._loop_waiting and not self._wakeup_pending
+        if wakeup:
+            self._wakeup_pending = True
         self._out_packet_mutex.release()
 
-        # Write a single byte to sockpairW (connected to sockpairR) to break
-        # out of select() if in threaded mode.
-        try:
-            self._sockpairW.send(sockpair_data)
-        except socket.error as err:
-            if err.errno != EAGAIN:
-                raise
+        if wakeup:
+            self._wakeup()
 
         if not self._in_callback and self._thread is None:
             return self.loop_write()
@@ -1991,7 +2634,7 @@ class Client(object):
             return MQTT_ERR_SUCCESS
 
     def _packet_handle(self):
-        cmd = self._in_packet['command']&0xF0
+        cmd = self._in_packet.command&0xF0
         if cmd == PINGREQ:
             return self._handle_pingreq()
         elif cmd == PINGRESP:
@@ -2019,7 +2662,7 @@ class Client(object):
 
     def _handle_pingreq(self):
         if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 0:
+            if self._in_packet.remaining_length != 0:
                 return MQTT_ERR_PROTOCOL
 
         self._easy_log(MQTT_LOG_DEBUG, "Received PINGREQ")
@@ -2027,7 +2670,7 @@ class Client(object):
 
     def _handle_pingresp(self):
         if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 0:
+            if self._in_packet.remaining_length != 0:
                 return MQTT_ERR_PROTOCOL
 
         # No longer waiting for a PINGRESP.
@@ -2037,13 +2680,13 @@ class Client(object):
 
     def _handle_connack(self):
         if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
+            if self._in_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        if len(self._in_packet['packet']) != 2:
+        if len(self._in_packet.packet) != 2:
             return MQTT_ERR_PROTOCOL
 
-        (flags, result) = struct.unpack("!BB", self._in_packet['packet'])
+        (flags, result) = struct.unpack("!BB", self._in_packet.packet)
         if result == CONNACK_REFUSED_PROTOCOL_VERSION and self._protocol == MQTTv311:
             self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+"), attempting downgrade to MQTT v3.1.")
             # Downgrade to MQTT v3.1
@@ -2077,52 +2720,65 @@ class Client(object):
 
         if result == 0:
             rc = 0
+            now = time_func()
+            self._in_message_mutex.acquire()
+            for m in self._in_messages.values():
+                if m.state == mqtt_ms_wait_for_pubrel:
+                    # Retry timers were cancelled on reconnect, PUBREC is resent
+                    # until the broker releases the message
+                    m.timestamp = now
+                    self._message_retry_arm(m, self._in_messages, self._in_message_mutex)
+            self._in_message_mutex.release()
             self._out_message_mutex.acquire()
-            for m in self._out_messages:
-                m.timestamp = time.time()
+            for m in list(self._out_messages.values()):
+                m.timestamp = now
                 if m.state == mqtt_ms_queued:
-                    self.loop_write()  # Process outgoing messages that have just been queued up
-                    self._out_message_mutex.release()
-                    return MQTT_ERR_SUCCESS
+                    # Sent from _out_message_queue as the inflight window frees up
+                    continue
+                if self._message_expired(m, now):
+                    self._message_expire(m)
+                    continue
 
                 if m.qos == 0:
                     self._in_callback = True # Don't call loop_write after _send_publish()
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup, m.priority)
                     self._in_callback = False
                     if rc != 0:
-                        self._out_message_mutex.release()
-                        return rc
+                        break
                 elif m.qos == 1:
                     if m.state == mqtt_ms_publish:
                         self._inflight_messages = self._inflight_messages + 1
                         m.state = mqtt_ms_wait_for_puback
+                        self._message_retry_arm(m, self._out_messages, self._out_message_mutex)
                         self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup, m.priority)
                         self._in_callback = False
                         if rc != 0:
-                            self._out_message_mutex.release()
-                            return rc
+                            break
                 elif m.qos == 2:
                     if m.state == mqtt_ms_publish:
                         self._inflight_messages = self._inflight_messages + 1
                         m.state = mqtt_ms_wait_for_pubrec
+                        self._message_retry_arm(m, self._out_messages, self._out_message_mutex)
                         self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup, m.priority)
                         self._in_callback = False
                         if rc != 0:
-                            self._out_message_mutex.release()
-                            return rc
+                            break
                     elif m.state == mqtt_ms_resend_pubrel:
                         self._inflight_messages = self._inflight_messages + 1
                         m.state = mqtt_ms_wait_for_pubcomp
+                        self._message_retry_arm(m, self._out_messages, self._out_message_mutex)
                         self._in_callback = True # Don't call loop_write after _send_pubrel()
                         rc = self._send_pubrel(m.mid, m.dup)
                         self._in_callback = False
                         if rc != 0:
-                            self._out_message_mutex.release()
-                            return rc
+                            break
+            if rc == 0:
                 self.loop_write() # Process outgoing messages that have just been queued up
             self._out_message_mutex.release()
+            # Also after a failed resend, for the messages expired before it
+            self._messages_expired_notify()
             return rc
         elif result > 0 and result < 6:
             return MQTT_ERR_CONN_REFUSED
@@ -2131,8 +2787,8 @@ class Client(object):
 
     def _handle_suback(self):
         self._easy_log(MQTT_LOG_DEBUG, "Received SUBACK")
-        pack_format = "!H" + str(len(self._in_packet['packet'])-2) + 's'
-        (mid, packet) = struct.unpack(pack_format, self._in_packet['packet'])
+        pack_format = "!H" + str(len(self._in_packet.packet)-2) + 's'
+        (mid, packet) = struct.unpack(pack_format, self._in_packet.packet)
         pack_format = "!" + "B"*len(packet)
         granted_qos = struct.unpack(pack_format, packet)
 
@@ -2148,37 +2804,46 @@ class Client(object):
     def _handle_publish(self):
         rc = 0
 
-        header = self._in_packet['command']
+        header = self._in_packet.command
         message = MQTTMessage()
         message.dup = (header & 0x08)>>3
         message.qos = (header & 0x06)>>1
         message.retain = (header & 0x01)
 
-        pack_format = "!H" + str(len(self._in_packet['packet'])-2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = '!' + str(slen) + 's' + str(len(packet)-slen) + 's'
-        (message.topic, packet) = struct.unpack(pack_format, packet)
-
-        if len(message.topic) == 0:
+        # Decode the topic and mid by offset, without copying the payload
+        packet = self._in_packet.packet
+        if len(packet) < 2:
+            return MQTT_ERR_PROTOCOL
+        (slen,) = _struct_uint16.unpack_from(packet, 0)
+        pos = 2 + slen
+        if slen == 0 or len(packet) < pos:
             return MQTT_ERR_PROTOCOL
+        message.topic = packet[2:pos]
 
         if sys.version_info[0] >= 3:
             message.topic = message.topic.decode('utf-8')
 
         if message.qos > 0:
-            pack_format = "!H" + str(len(packet)-2) + 's'
-            (message.mid, packet) = struct.unpack(pack_format, packet)
-
-        message.payload = packet
+            if len(packet) < pos + 2:
+                return MQTT_ERR_PROTOCOL
+            (message.mid,) = _struct_uint16.unpack_from(packet, pos)
+            pos = pos + 2
 
-        self._easy_log(
-            MQTT_LOG_DEBUG,
-            "Received PUBLISH (d"+str(message.dup)+
-            ", q"+str(message.qos)+", r"+str(message.retain)+
-            ", m"+str(message.mid)+", '"+message.topic+
-            "', ...  ("+str(len(message.payload))+" bytes)")
+        if self._zero_copy_payload:
+            # Read-only view over the received packet
+            message.payload = memoryview(packet)[pos:]
+        else:
+            message.payload = packet[pos:]
 
-        message.timestamp = time.time()
+        if self.on_log:
+            self._easy_log(
+                MQTT_LOG_DEBUG,
+                "Received PUBLISH (d"+str(message.dup)+
+                ", q"+str(message.qos)+", r"+str(message.retain)+
+                ", m"+str(message.mid)+", '"+message.topic+
+                "', ...  ("+str(len(message.payload))+" bytes)")
+
+        message.timestamp = time_func()
         if message.qos == 0:
             self._handle_on_message(message)
             return MQTT_ERR_SUCCESS
@@ -2190,7 +2855,8 @@ class Client(object):
             rc = self._send_pubrec(message.mid)
             message.state = mqtt_ms_wait_for_pubrel
             self._in_message_mutex.acquire()
-            self._in_messages.append(message)
+            self._in_messages[message.mid] = message
+            self._message_retry_arm(message, self._in_messages, self._in_message_mutex)
             self._in_message_mutex.release()
             return rc
         else:
@@ -2198,82 +2864,91 @@ class Client(object):
 
     def _handle_pubrel(self):
         if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
+            if self._in_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        if len(self._in_packet['packet']) != 2:
+        if len(self._in_packet.packet) != 2:
             return MQTT_ERR_PROTOCOL
 
-        mid = struct.unpack("!H", self._in_packet['packet'])
+        mid = struct.unpack("!H", self._in_packet.packet)
         mid = mid[0]
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: "+str(mid)+")")
 
         self._in_message_mutex.acquire()
-        for i in range(len(self._in_messages)):
-            if self._in_messages[i].mid == mid:
-
-                # Only pass the message on if we have removed it from the queue - this
-                # prevents multiple callbacks for the same message.
-                self._handle_on_message(self._in_messages[i])
-                self._in_messages.pop(i)
-                self._inflight_messages = self._inflight_messages - 1
-                if self._max_inflight_messages > 0:
-                    self._out_message_mutex.acquire()
-                    rc = self._update_inflight()
-                    self._out_message_mutex.release()
-                    if rc != MQTT_ERR_SUCCESS:
-                        self._in_message_mutex.release()
-                        return rc
+        message = self._in_messages.get(mid)
+        if message is not None:
+            # Only pass the message on if we have removed it from the queue - this
+            # prevents multiple callbacks for the same message.
+            self._message_retry_cancel(message)
+            self._handle_on_message(message)
+            del self._in_messages[mid]
+            self._inflight_messages = self._inflight_messages - 1
+            if self._max_inflight_messages > 0:
+                self._out_message_mutex.acquire()
+                rc = self._update_inflight()
+                self._out_message_mutex.release()
+                self._messages_expired_notify()
+                if rc != MQTT_ERR_SUCCESS:
+                    self._in_message_mutex.release()
+                    return rc
 
-                self._in_message_mutex.release()
-                return self._send_pubcomp(mid)
+            self._in_message_mutex.release()
+            return self._send_pubcomp(mid)
 
         self._in_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _update_inflight(self):
         # Dont lock message_mutex here
-        for m in self._out_messages:
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages = self._inflight_messages + 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    if rc != 0:
-                        return rc
-            else:
-                return MQTT_ERR_SUCCESS
+        while self._out_message_queue and self._inflight_messages < self._max_inflight_messages:
+            m = self._out_message_queue.popleft()
+            if m.state != mqtt_ms_queued or self._out_messages.get(m.mid) is not m:
+                continue  # No longer waiting for the window
+            if self._message_expired(m, time_func()):
+                self._message_expire(m)
+                continue
+            self._inflight_messages = self._inflight_messages + 1
+            if m.qos == 1:
+                m.state = mqtt_ms_wait_for_puback
+            elif m.qos == 2:
+                m.state = mqtt_ms_wait_for_pubrec
+            m.timestamp = time_func()
+            self._message_retry_arm(m, self._out_messages, self._out_message_mutex)
+            rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup, m.priority)
+            if rc != 0:
+                return rc
         return MQTT_ERR_SUCCESS
 
     def _handle_pubrec(self):
         if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
+            if self._in_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        mid = struct.unpack("!H", self._in_packet['packet'])
+        mid = struct.unpack("!H", self._in_packet.packet)
         mid = mid[0]
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: "+str(mid)+")")
 
         self._out_message_mutex.acquire()
-        for m in self._out_messages:
-            if m.mid == mid:
-                m.state = mqtt_ms_wait_for_pubcomp
-                m.timestamp = time.time()
-                self._out_message_mutex.release()
-                return self._send_pubrel(mid, False)
+        m = self._out_messages.get(mid)
+        if m is not None and m.state == mqtt_ms_wait_for_pubrec:
+            self._ack_rtt_sample(m)
+        if m is not None:
+            m.state = mqtt_ms_wait_for_pubcomp
+            m.timestamp = time_func()
+            m._retry_count = 0
+            self._message_retry_arm(m, self._out_messages, self._out_message_mutex)
+            self._out_message_mutex.release()
+            return self._send_pubrel(mid, False)
 
         self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _handle_unsuback(self):
         if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
+            if self._in_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        mid = struct.unpack("!H", self._in_packet['packet'])
+        mid = struct.unpack("!H", self._in_packet.packet)
         mid = mid[0]
         self._easy_log(MQTT_LOG_DEBUG, "Received UNSUBACK (Mid: "+str(mid)+")")
         self._callback_mutex.acquire()
@@ -2286,53 +2961,76 @@ class Client(object):
 
     def _handle_pubackcomp(self, cmd):
         if self._strict_protocol:
-            if self._in_packet['remaining_length'] != 2:
+            if self._in_packet.remaining_length != 2:
                 return MQTT_ERR_PROTOCOL
 
-        mid = struct.unpack("!H", self._in_packet['packet'])
+        mid = struct.unpack("!H", self._in_packet.packet)
         mid = mid[0]
         self._easy_log(MQTT_LOG_DEBUG, "Received "+cmd+" (Mid: "+str(mid)+")")
 
         self._out_message_mutex.acquire()
-        for i in range(len(self._out_messages)):
-            try:
-                if self._out_messages[i].mid == mid:
-                    # Only inform the client the message has been sent once.
-                    self._callback_mutex.acquire()
-                    if self.on_publish:
-                        self._out_message_mutex.release()
-                        self._in_callback = True
-                        self.on_publish(self, self._userdata, mid)
-                        self._in_callback = False
-                        self._out_message_mutex.acquire()
-
-                    self._callback_mutex.release()
-                    self._out_messages.pop(i)
-                    self._inflight_messages = self._inflight_messages - 1
-                    if self._max_inflight_messages > 0:
-                        rc = self._update_inflight()
-                        if rc != MQTT_ERR_SUCCESS:
-                            self._out_message_mutex.release()
-                            return rc
+        message = self._out_messages.get(mid)
+        if message is not None:
+            self._message_retry_cancel(message)
+            if message.state == mqtt_ms_wait_for_puback:
+                self._ack_rtt_sample(message)
+            elif message.state == mqtt_ms_wait_for_pubcomp:
+                self._ack_rtt_sample(message, window=False)
+            # Only inform the client the message has been sent once.
+            self._callback_mutex.acquire()
+            if self.on_publish:
+                self._out_message_mutex.release()
+                self._in_callback = True
+                self.on_publish(self, self._userdata, mid)
+                self._in_callback = False
+                self._out_message_mutex.acquire()
+
+            self._callback_mutex.release()
+            if self._out_messages.get(mid) is message:
+                del self._out_messages[mid]
+            self._inflight_messages = self._inflight_messages - 1
+            if self._max_inflight_messages > 0:
+                rc = self._update_inflight()
+                if rc != MQTT_ERR_SUCCESS:
                     self._out_message_mutex.release()
-                    return MQTT_ERR_SUCCESS
-            except IndexError:
-                # Have removed item so i>count.
-                # Not really an error.
-                pass
+                    self._messages_expired_notify()
+                    return rc
+            self._out_message_mutex.release()
+            self._messages_expired_notify()
+            return MQTT_ERR_SUCCESS
 
         self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
+    def _message_filters_update(self):
+        # Must be called with _callback_mutex held.
+        self._message_filters = TopicFilterIndex()
+        for (sub, callback) in self.on_message_filtered:
+            self._message_filters.add(sub)
+        self._message_filter_callbacks = dict(self.on_message_filtered)
+        self._message_filter_cache.clear()
+
+    def _message_filters_match(self, topic):
+        # Return the topic specific callbacks matching topic, in registration
+        # order. Must be called with _callback_mutex held.
+        if not self._message_filters:
+            return []
+        callbacks = self._message_filter_cache.pop(topic, None)
+        if callbacks is None:
+            callbacks = [self._message_filter_callbacks[sub] for sub in self._message_filters.match(topic)]
+            if len(self._message_filter_cache) >= MESSAGE_FILTER_CACHE_SIZE:
+                self._message_filter_cache.popitem(last=False)
+        self._message_filter_cache[topic] = callbacks  # Most recently used last
+        return callbacks
+
     def _handle_on_message(self, message):
         self._callback_mutex.acquire()
         matched = False
-        for t in self.on_message_filtered:
-            if topic_matches_sub(t[0], message.topic):
-                self._in_callback = True
-                t[1](self, self._userdata, message)
-                self._in_callback = False
-                matched = True
+        for callback in self._message_filters_match(message.topic):
+            self._in_callback = True
+            callback(self, self._userdata, message)
+            self._in_callback = False
+            matched = True
 
         if matched == False and self.on_message:
             self._in_callback = True
@@ -2349,7 +3047,8 @@ class Client(object):
         else:
             self._state_mutex.release()
 
-        self.loop_forever()
+        # Wait on the sockets and the timer scheduler only, no polling
+        self.loop_forever(timeout=None)
 
     def _host_matches_cert(self, host, cert_host):
         if cert_host[0:2] == "*.":
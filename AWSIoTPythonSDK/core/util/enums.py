@@ -17,3 +17,15 @@
 class DropBehaviorTypes(object):
     DROP_OLDEST = 0
     DROP_NEWEST = 1
+
+
+class StoreSyncPolicies(object):
+    SYNC_NONE = 0  # Leave flushing to the OS
+    SYNC_ALWAYS = 1  # Flush to disk on every write
+    SYNC_BATCHED = 2  # Flush to disk every batch size writes or interval seconds
+
+
+class LanePolicyTypes(object):
+    BACKLOG_FIRST = 0  # Live requests queue up behind the offline backlog
+    LIVE_FIRST = 1  # Live publishes go out right away, ahead of the backlog
+    WEIGHTED = 2  # Live publishes interleave with the backlog, by weight